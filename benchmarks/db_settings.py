@@ -0,0 +1,90 @@
+#!/usr/bin/env python3
+"""Benchmark the Hub's sqlite database settings
+
+Measures the database work of logins and spawns on a sqlite file
+with the journal and sync settings that JupyterHub can configure
+(`JupyterHub.sqlite_journal_mode`, `JupyterHub.sqlite_synchronous`, etc.).
+
+usage:
+
+    python benchmarks/db_settings.py [-n 500] [--users 1000] [--dir .]
+
+Run it with --dir on the disk that holds your jupyterhub.sqlite:
+the difference between settings is mostly the cost of fsync,
+which is close to zero on a tmpfs.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import argparse
+import os
+from tempfile import TemporaryDirectory
+import time
+
+from jupyterhub import orm
+from jupyterhub.utils import new_token
+
+SETTINGS = [
+    ("default", {}),
+    ("wal", {'journal_mode': 'wal'}),
+    ("wal, synchronous=normal", {'journal_mode': 'wal', 'synchronous': 'normal'}),
+    ("wal, normal, cache, mmap", {
+        'journal_mode': 'wal',
+        'synchronous': 'normal',
+        'cache_size': -16000,
+        'mmap_size': 2**28,
+    }),
+]
+
+
+def login(db, name):
+    """The database work of a login: look up the user and set a new cookie id"""
+    user = orm.User.find(db, name)
+    user.cookie_id = new_token()
+    db.commit()
+
+
+def spawn(db, name):
+    """The database work of User.spawn: add the server, a token, then store the state"""
+    user = orm.User.find(db, name)
+    user.server = orm.Server(cookie_name='jupyter-hub-token-%s' % name)
+    db.commit()
+    user.new_api_token()
+    db.commit()
+    user.state = {'pid': 1234}
+    db.commit()
+
+
+def run(label, pragmas, args):
+    with TemporaryDirectory(dir=args.dir) as td:
+        url = 'sqlite:///' + os.path.join(td, 'jupyterhub.sqlite')
+        db = orm.new_session_factory(url, sqlite_pragmas=pragmas)()
+        orm.APIToken.hash_key = os.urandom(32)
+        names = [ 'user-%i' % i for i in range(args.users) ]
+        db.add_all([ orm.User(name=name) for name in names ])
+        db.commit()
+        results = []
+        for action in (login, spawn):
+            tic = time.perf_counter()
+            for i in range(args.n):
+                action(db, names[i % len(names)])
+            results.append(args.n / (time.perf_counter() - tic))
+        db.close()
+    print("{label:<28} {:10.0f} {:10.0f}".format(*results, label=label))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=500, help="logins and spawns per setting")
+    parser.add_argument('--users', type=int, default=1000, help="users in the database")
+    parser.add_argument('--dir', default=None, help="directory for the test databases")
+    args = parser.parse_args()
+
+    print("{:<28} {:>10} {:>10}".format("sqlite settings", "logins/s", "spawns/s"))
+    for label, pragmas in SETTINGS:
+        run(label, pragmas, args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""Benchmark the proxy backends
+
+Compares the in-process TornadoProxy with configurable-http-proxy:
+the latency and throughput of requests proxied to a single-user server,
+and how fast routes can be added.
+
+usage:
+
+    python benchmarks/proxy.py [-n 2000] [-c 10] [--routes 1000]
+
+configurable-http-proxy must be on your PATH, or given with --chp.
+The upstream server and each proxy run in their own process,
+so the client doesn't compete with the proxy for the CPU.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import argparse
+import os
+import sys
+import time
+from subprocess import Popen
+
+from tornado import gen, web
+from tornado.httpclient import AsyncHTTPClient
+from tornado.ioloop import IOLoop
+
+from jupyterhub import orm
+from jupyterhub.proxy import ConfigurableHTTPProxy, TornadoProxy
+from jupyterhub.utils import new_token, random_port, wait_for_http_server
+
+
+def server(port):
+    return orm.Server(proto='http', ip='127.0.0.1', port=port, base_url='/')
+
+
+def route(i):
+    return '/user/user-%i' % i
+
+
+class UpstreamHandler(web.RequestHandler):
+    def get(self, path):
+        self.write(self.settings['body'])
+
+
+def serve_upstream(args):
+    """Run the single-user server stand-in"""
+    web.Application([(r'(.*)', UpstreamHandler)], body=b'x' * args.size).listen(args.port, '127.0.0.1')
+    IOLoop.current().start()
+
+
+@gen.coroutine
+def _serve_tornado(args):
+    proxy = orm.Proxy(public_server=server(args.port))
+    hub = orm.Hub(server=server(args.upstream_port))
+    backend = TornadoProxy(proxy=proxy, hub=hub)
+    yield backend.start()
+    target = hub.server.host
+    for i in range(args.routes):
+        yield backend.add_route(route(i), target, {'user': 'user-%i' % i})
+
+
+def serve_tornado(args):
+    """Run TornadoProxy, with routes for every user"""
+    IOLoop.current().run_sync(lambda : _serve_tornado(args))
+    IOLoop.current().start()
+
+
+@gen.coroutine
+def add_routes(backend, n, target):
+    """Add n routes, returning routes added per second"""
+    tic = time.perf_counter()
+    for i in range(n):
+        yield backend.add_route(route(i), target, {'user': 'user-%i' % i})
+    return n / (time.perf_counter() - tic)
+
+
+@gen.coroutine
+def load(url, args):
+    """Make args.n requests, args.c at a time
+
+    Returns (requests/s, median latency, 99th percentile latency), in ms.
+    """
+    client = AsyncHTTPClient(force_instance=True, max_clients=args.c)
+    latencies = []
+    requests = iter(range(args.n))
+
+    @gen.coroutine
+    def worker():
+        for i in requests:
+            tic = time.perf_counter()
+            yield client.fetch(url + route(i % args.routes) + '/api/status')
+            latencies.append(time.perf_counter() - tic)
+
+    tic = time.perf_counter()
+    yield [ worker() for i in range(args.c) ]
+    elapsed = time.perf_counter() - tic
+    client.close()
+    latencies.sort()
+    return (
+        args.n / elapsed,
+        1e3 * latencies[len(latencies) // 2],
+        1e3 * latencies[int(len(latencies) * 0.99)],
+    )
+
+
+def start(*cmd, **kwargs):
+    return Popen([sys.executable, __file__] + list(cmd), **kwargs)
+
+
+@gen.coroutine
+def bench(args):
+    upstream = server(random_port())
+    processes = [start('--serve', 'upstream', '--port', str(upstream.port), '--size', str(args.size))]
+    yield wait_for_http_server(upstream.url)
+    target = upstream.host
+    results = []
+    try:
+        # configurable-http-proxy
+        proxy = orm.Proxy(public_server=server(random_port()), api_server=server(random_port()))
+        proxy.api_server.base_url = '/api/routes/'
+        proxy.auth_token = new_token()
+        env = os.environ.copy()
+        env['CONFIGPROXY_AUTH_TOKEN'] = proxy.auth_token
+        processes.append(Popen(args.chp.split() + [
+            '--ip', '127.0.0.1',
+            '--port', str(proxy.public_server.port),
+            '--api-ip', '127.0.0.1',
+            '--api-port', str(proxy.api_server.port),
+            '--default-target', target,
+        ], env=env))
+        yield wait_for_http_server(proxy.public_server.url)
+        chp = ConfigurableHTTPProxy(proxy=proxy)
+        routes_per_s = yield add_routes(chp, args.routes, target)
+        stats = yield load(proxy.public_server.url.rstrip('/'), args)
+        results.append(("configurable-http-proxy", routes_per_s) + stats)
+
+        # TornadoProxy
+        public_server = server(random_port())
+        processes.append(start('--serve', 'tornado',
+            '--port', str(public_server.port),
+            '--upstream-port', str(upstream.port),
+            '--routes', str(args.routes),
+        ))
+        yield wait_for_http_server(public_server.url)
+        in_memory = TornadoProxy(proxy=orm.Proxy(public_server=public_server))
+        routes_per_s = yield add_routes(in_memory, args.routes, target)
+        stats = yield load(public_server.url.rstrip('/'), args)
+        results.append(("TornadoProxy", routes_per_s) + stats)
+    finally:
+        for p in processes:
+            p.terminate()
+
+    print("{:<24} {:>10} {:>10} {:>10} {:>10}".format("proxy", "routes/s", "req/s", "p50 ms", "p99 ms"))
+    for result in results:
+        print("{:<24} {:10.0f} {:10.0f} {:10.2f} {:10.2f}".format(*result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=2000, help="requests per proxy")
+    parser.add_argument('-c', type=int, default=10, help="concurrent requests")
+    parser.add_argument('--routes', type=int, default=1000, help="user routes in the proxy")
+    parser.add_argument('--size', type=int, default=1024, help="size (bytes) of each response")
+    parser.add_argument('--chp', default='configurable-http-proxy', help="command for configurable-http-proxy")
+    # used to run the upstream server and TornadoProxy in subprocesses
+    parser.add_argument('--serve', choices=['upstream', 'tornado'], help=argparse.SUPPRESS)
+    parser.add_argument('--port', type=int, help=argparse.SUPPRESS)
+    parser.add_argument('--upstream-port', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.serve == 'upstream':
+        serve_upstream(args)
+    elif args.serve == 'tornado':
+        serve_tornado(args)
+    else:
+        IOLoop.current().run_sync(lambda : bench(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+"""Microbenchmark for the proxy's RouteTable
+
+Times adding, matching, removing, and replacing routes in a table of
+user, service, and host-prefixed routes,
+and compares matching with walking up the path one prefix at a time in a dict.
+
+usage:
+
+    python benchmarks/route_table.py [--routes 100000] [-n 100000]
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import argparse
+import random
+import time
+import tracemalloc
+
+from jupyterhub.routetable import Route, RouteTable
+
+
+def make_routes(n):
+    """n routes: mostly users, some services, and some host-prefixed users"""
+    routes = [Route('/', 'http://127.0.0.1:8081')]
+    for i in range(n - 1):
+        if i % 100 == 0:
+            prefix = '/services/service-%i' % i
+        elif i % 10 == 0:
+            prefix = '/user-%i.hub.example.com/user/user-%i' % (i, i)
+        else:
+            prefix = '/user/user-%i' % i
+        routes.append(Route(prefix, 'http://10.0.%i.%i:8888' % (i // 250 % 250, i % 250), user='user-%i' % i))
+    return routes
+
+
+def dict_match(routes, path):
+    """Longest-prefix match by looking up each parent of path in a dict"""
+    path = path.rstrip('/') or '/'
+    while True:
+        route = routes.get(path)
+        if route is not None:
+            return route
+        if path == '/':
+            return None
+        path = path.rsplit('/', 1)[0] or '/'
+
+
+def bench(label, f, items):
+    tic = time.perf_counter()
+    for item in items:
+        f(item)
+    per_op = (time.perf_counter() - tic) / len(items)
+    print("{label:<36} {usec:10.2f} us/op".format(label=label, usec=1e6 * per_op))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--routes', type=int, default=100000, help="routes in the table")
+    parser.add_argument('-n', type=int, default=100000, help="lookups per run")
+    args = parser.parse_args()
+
+    routes = make_routes(args.routes)
+    paths = [
+        route.prefix + '/api/contents/notebooks/analysis.ipynb'
+        for route in random.sample(routes, min(args.n, len(routes)))
+    ]
+    paths = (paths * (args.n // len(paths) + 1))[:args.n]
+    misses = [ '/user/nobody-%i/tree' % i for i in range(len(paths)) ]
+
+    print("%i routes" % len(routes))
+    tracemalloc.start()
+    table = RouteTable()
+    bench("add", table.add, routes)
+    size, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print("{:<36} {:10.0f} bytes/route".format("trie memory", size / len(routes)))
+
+    by_prefix = { route.prefix: route for route in routes }
+    bench("match (RouteTable)", table.match, paths)
+    bench("match (dict, by parent prefix)", lambda path: dict_match(by_prefix, path), paths)
+    bench("match miss (RouteTable)", table.match, misses)
+    bench("match miss (dict, by parent prefix)", lambda path: dict_match(by_prefix, path), misses)
+
+    tic = time.perf_counter()
+    table.replace(routes)
+    print("{:<36} {:10.2f} ms".format("replace all", 1e3 * (time.perf_counter() - tic)))
+    bench("remove", table.remove, [ route.prefix for route in routes ])
+    assert len(table) == 0
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""Microbenchmark for API token hashing
+
+Compares the per-request cost of checking a token stored with
+the salted `sha512:16384` scheme against the single-pass `hmac-sha256` scheme.
+
+usage:
+
+    python benchmarks/token_hash.py [-n 200]
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import argparse
+import os
+import timeit
+
+from jupyterhub.orm import APIToken
+from jupyterhub.utils import new_token, hash_token, hmac_token, compare_token
+
+
+def bench(label, stmt, n):
+    seconds = min(timeit.repeat(stmt, number=n, repeat=3))
+    print("{label:<32} {usec:10.1f} us/token".format(label=label, usec=1e6 * seconds / n))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-n', type=int, default=200, help="tokens checked per run")
+    args = parser.parse_args()
+
+    key = os.urandom(32)
+    token = new_token()
+    legacy = hash_token(token,
+        rounds=APIToken.rounds, salt=APIToken.salt_bytes, algorithm=APIToken.algorithm,
+    )
+    fast = hmac_token(token, key)
+
+    print("Checking a token (compare_token):")
+    bench("sha512, %i rounds" % APIToken.rounds, lambda : compare_token(legacy, token), args.n)
+    bench("hmac-sha256", lambda : compare_token(fast, token, key=key), args.n)
+    print("Hashing a new token:")
+    bench("sha512, %i rounds" % APIToken.rounds, lambda : hash_token(token,
+        rounds=APIToken.rounds, salt=APIToken.salt_bytes, algorithm=APIToken.algorithm,
+    ), args.n)
+    bench("hmac-sha256", lambda : hmac_token(token, key), args.n)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+#!/usr/bin/env python3
+"""Benchmark user lookups by cookie and by last activity
+
+Times the queries that the users.cookie_id and users.last_activity indexes serve:
+finding the user for a login cookie, and finding the most recently active users.
+
+usage:
+
+    python benchmarks/user_lookup.py [--users 50000] [-n 20]
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+import argparse
+from datetime import datetime, timedelta
+import timeit
+
+from jupyterhub import orm
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=50000, help="users in the database")
+    parser.add_argument('-n', type=int, default=20, help="lookups per run")
+    args = parser.parse_args()
+
+    db = orm.new_session_factory('sqlite:///:memory:')()
+    n = args.users
+    start = datetime(2017, 1, 1)
+    db.execute(orm.User.__table__.insert(), [
+        {
+            'name': 'user-%i' % i,
+            'cookie_id': 'cookie-%i' % i,
+            'last_activity': start + timedelta(seconds=i),
+        } for i in range(n)
+    ])
+    db.commit()
+
+    def find_by_cookie():
+        return db.query(orm.User).filter(orm.User.cookie_id == 'cookie-%i' % (n // 2)).first()
+
+    def most_recent():
+        return db.query(orm.User).order_by(orm.User.last_activity.desc()).first()
+
+    assert find_by_cookie().name == 'user-%i' % (n // 2)
+    assert most_recent().name == 'user-%i' % (n - 1)
+    print("%i users" % n)
+    for lookup in (find_by_cookie, most_recent):
+        per_lookup = min(timeit.repeat(lookup, number=args.n, repeat=5)) / args.n
+        print("{:<20} {:10.3f} ms".format(lookup.__name__, 1e3 * per_lookup))
+
+
+if __name__ == '__main__':
+    main()
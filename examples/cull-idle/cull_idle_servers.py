@@ -45,11 +45,13 @@ def cull_idle(url, api_token, timeout):
     auth_header = {
             'Authorization': 'token %s' % api_token
         }
-    req = HTTPRequest(url=url + '/users',
-        headers=auth_header,
-    )
     now = datetime.datetime.utcnow()
     cull_limit = now - datetime.timedelta(seconds=timeout)
+    # only ask for users with running servers that have been idle too long
+    req = HTTPRequest(url=url + '/users?state=running&last_activity_before=%s' % (
+            cull_limit.strftime('%Y-%m-%dT%H:%M:%S.%fZ')),
+        headers=auth_header,
+    )
     client = AsyncHTTPClient()
     resp = yield client.fetch(req)
     users = json.loads(resp.body.decode('utf8', 'replace'))
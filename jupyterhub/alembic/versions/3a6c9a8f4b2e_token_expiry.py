@@ -0,0 +1,30 @@
+"""token expiry
+
+Adds an indexed expires_at column to api_tokens.
+Existing tokens don't expire.
+
+Revision ID: 3a6c9a8f4b2e
+Revises: c9dd4614b512
+Create Date: 2017-01-31 14:05:12.318276
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '3a6c9a8f4b2e'
+down_revision = 'c9dd4614b512'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('api_tokens', sa.Column('expires_at', sa.DateTime, nullable=True))
+    op.create_index('ix_api_tokens_expires_at', 'api_tokens', ['expires_at'])
+
+
+def downgrade():
+    op.drop_index('ix_api_tokens_expires_at', 'api_tokens')
+    # sqlite cannot downgrade because of limited ALTER TABLE support (no DROP COLUMN)
+    op.drop_column('api_tokens', 'expires_at')
@@ -0,0 +1,34 @@
+"""token server
+
+Adds api_tokens.server_id, the server a token was issued to by spawn.
+Existing tokens aren't tied to a server.
+
+Revision ID: 5e6d4f1c2b7a
+Revises: 8f2ab5a2d4c1
+Create Date: 2017-02-09 16:42:03.118245
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '5e6d4f1c2b7a'
+down_revision = '8f2ab5a2d4c1'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    # batch mode, since sqlite can't add a foreign key to an existing table
+    with op.batch_alter_table('api_tokens') as batch_op:
+        batch_op.add_column(sa.Column('server_id', sa.Integer, nullable=True))
+        batch_op.create_foreign_key('fk_api_tokens_server_id', 'servers',
+            ['server_id'], ['id'], ondelete='CASCADE',
+        )
+
+
+def downgrade():
+    with op.batch_alter_table('api_tokens') as batch_op:
+        batch_op.drop_constraint('fk_api_tokens_server_id', type_='foreignkey')
+        batch_op.drop_column('server_id')
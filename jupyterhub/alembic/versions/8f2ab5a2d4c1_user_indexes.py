@@ -0,0 +1,28 @@
+"""user indexes
+
+Indexes users.cookie_id, for cookie authentication,
+and users.last_activity, for sorting and culling idle users.
+
+Revision ID: 8f2ab5a2d4c1
+Revises: 3a6c9a8f4b2e
+Create Date: 2017-02-07 11:27:40.582213
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = '8f2ab5a2d4c1'
+down_revision = '3a6c9a8f4b2e'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+
+
+def upgrade():
+    op.create_index('ix_users_cookie_id', 'users', ['cookie_id'])
+    op.create_index('ix_users_last_activity', 'users', ['last_activity'])
+
+
+def downgrade():
+    op.drop_index('ix_users_last_activity', 'users')
+    op.drop_index('ix_users_cookie_id', 'users')
@@ -0,0 +1,42 @@
+"""token fingerprint
+
+Adds an indexed fingerprint column to api_tokens for exact-match lookup,
+backfilled from tokens already hashed with a keyed scheme.
+Also indexes the token prefix.
+
+Revision ID: c9dd4614b512
+Revises: af4cbdb2d13c
+Create Date: 2017-01-24 10:12:31.742211
+
+"""
+
+# revision identifiers, used by Alembic.
+revision = 'c9dd4614b512'
+down_revision = 'af4cbdb2d13c'
+branch_labels = None
+depends_on = None
+
+from alembic import op
+import sqlalchemy as sa
+
+
+def upgrade():
+    op.add_column('api_tokens', sa.Column('fingerprint', sa.Unicode(64)))
+    op.create_index('ix_api_tokens_fingerprint', 'api_tokens', ['fingerprint'])
+    op.create_index('ix_api_tokens_prefix', 'api_tokens', ['prefix'])
+    # keyed hashes are `scheme:digest`, where the digest is the fingerprint.
+    # Salted `algorithm:rounds:salt:digest` hashes have no fingerprint.
+    scheme = 'hmac-sha256:'
+    op.execute(
+        sa.text(
+            "UPDATE api_tokens SET fingerprint = substr(hashed, :start)"
+            " WHERE hashed LIKE :pattern"
+        ).bindparams(start=len(scheme) + 1, pattern=scheme + '%')
+    )
+
+
+def downgrade():
+    op.drop_index('ix_api_tokens_prefix', 'api_tokens')
+    op.drop_index('ix_api_tokens_fingerprint', 'api_tokens')
+    # sqlite cannot downgrade because of limited ALTER TABLE support (no DROP COLUMN)
+    op.drop_column('api_tokens', 'fingerprint')
@@ -6,16 +6,21 @@
 import json
 from urllib.parse import quote
 
+from sqlalchemy.orm import joinedload
 from tornado import web, gen
+from tornado.escape import utf8
 from .. import orm
-from ..utils import token_authenticated
+from ..utils import token_authenticated, chunks, service_identity_name
 from .base import APIHandler
 
 
 class TokenAPIHandler(APIHandler):
     @token_authenticated
+    @gen.coroutine
     def get(self, token):
-        orm_token = orm.APIToken.find(self.db, token)
+        orm_token = yield orm.APIToken.find_async(self.db, token,
+            executor=self.token_hash_executor,
+        )
         if orm_token is None:
             raise web.HTTPError(404)
         self.write(json.dumps(self.user_model(self.users[orm_token.user])))
@@ -28,7 +33,9 @@ class TokenAPIHandler(APIHandler):
           if username is None:
             raise web.HTTPError(403)
           user = self.find_user(username)
-          api_token = user.new_api_token()
+          api_token = yield orm.APIToken.new_async(user=user.orm_user,
+            executor=self.token_hash_executor,
+          )
           self.write(json.dumps({"Authentication":api_token}))
         else:
           raise web.HTTPError(404)
@@ -45,11 +52,107 @@ class CookieAPIHandler(APIHandler):
         user = self._user_for_cookie(cookie_name, cookie_value)
         if user is None:
             raise web.HTTPError(404)
-        self.write(json.dumps(self.user_model(user)))
+        model = self.user_model(user)
+        # a fresh signed identity, for the caller to set as a cookie
+        key_name = cookie_name
+        if cookie_name == 'jupyterhub-services':
+            # services share the login cookie, but not the identity key
+            owner = self.get_current_user_token()
+            key_name = service_identity_name(owner.name) if isinstance(owner, orm.Service) else None
+        identity = self.sign_identity(user, key_name, cookie_value) if key_name else None
+        if identity:
+            model['identity'] = identity
+        self.write(json.dumps(model))
+
+
+class BatchAuthorizationAPIHandler(APIHandler):
+    """Identify the users for many cookies and tokens in one request
+
+    Request body::
+
+        {
+            "cookies": [{"name": "jupyterhub-services", "value": "..."}],
+            "tokens": ["..."]
+        }
+
+    Replies with the user model, or null if not found,
+    for each cookie and token in the same order::
+
+        {"cookies": [{"name": "kaylee", ...}, null], "tokens": [{"name": "mal", ...}]}
+    """
+    @token_authenticated
+    @gen.coroutine
+    def post(self):
+        data = self.get_json_body() or {}
+        cookies = data.get('cookies', [])
+        tokens = data.get('tokens', [])
+        if not isinstance(cookies, list) or not all(
+            isinstance(c, dict) and isinstance(c.get('name'), str) and isinstance(c.get('value'), str)
+            for c in cookies
+        ):
+            raise web.HTTPError(400, "cookies must be a list of {'name': name, 'value': value}")
+        if not isinstance(tokens, list) or not all(isinstance(t, str) for t in tokens):
+            raise web.HTTPError(400, "tokens must be a list of strings")
+
+        cookie_users = self._users_for_cookies(cookies)
+        token_users = yield self._users_for_tokens(tokens)
+        self.write(json.dumps({
+            'cookies': [ self.user_model(user) if user else None for user in cookie_users ],
+            'tokens': [ self.user_model(user) if user else None for user in token_users ],
+        }))
+
+    def _users_for_cookies(self, cookies):
+        """Get the User for each cookie, in one query for cookies that aren't cached"""
+        users = [None] * len(cookies)
+        cookie_ids = {}
+        for i, cookie in enumerate(cookies):
+            cache_key = (cookie['name'], utf8(cookie['value']))
+            users[i] = self._user_for_cached_cookie(cache_key)
+            if users[i] is not None:
+                continue
+            cookie_id = self.get_secure_cookie(cookie['name'], cookie['value'],
+                max_age_days=self.cookie_max_age_days,
+            )
+            if cookie_id is not None:
+                cookie_ids[i] = cookie_id.decode('utf8', 'replace')
+
+        by_cookie_id = {}
+        for chunk in chunks(sorted(set(cookie_ids.values()))):
+            query = self.db.query(orm.User).filter(orm.User.cookie_id.in_(chunk))
+            for orm_user in query.options(joinedload(orm.User.groups)):
+                by_cookie_id[orm_user.cookie_id] = orm_user
+        for i, cookie_id in cookie_ids.items():
+            orm_user = by_cookie_id.get(cookie_id)
+            if orm_user is not None:
+                users[i] = self._user_from_orm(orm_user)
+                self._remember_cookie((cookies[i]['name'], utf8(cookies[i]['value'])), users[i])
+        return users
+
+    @gen.coroutine
+    def _users_for_tokens(self, tokens):
+        """Get the User for each user token, in one query for the tokens and one for their owners"""
+        found = yield orm.APIToken.find_many_async(self.db, tokens,
+            executor=self.token_hash_executor,
+        )
+        user_ids = sorted({ t.user_id for t in found.values() if t.user_id is not None })
+        by_id = {}
+        for chunk in chunks(user_ids):
+            query = self.db.query(orm.User).filter(orm.User.id.in_(chunk))
+            for orm_user in query.options(joinedload(orm.User.groups)):
+                by_id[orm_user.id] = orm_user
+        users = []
+        for token in tokens:
+            orm_token = found.get(token)
+            if orm_token is None or orm_token.user_id not in by_id:
+                users.append(None)
+            else:
+                users.append(self._user_from_orm(by_id[orm_token.user_id]))
+        return users
 
 
 default_handlers = [
     (r"/api/authorizations/cookie/([^/]+)(?:/([^/]+))?", CookieAPIHandler),
     (r"/api/authorizations/token/([^/]+)", TokenAPIHandler),
     (r"/api/authorizations/token", TokenAPIHandler),
+    (r"/api/authorizations/batch", BatchAuthorizationAPIHandler),
 ]
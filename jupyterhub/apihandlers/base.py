@@ -102,6 +102,44 @@ class APIHandler(BaseHandler):
             model['pending'] = 'stop'
         return model
 
+    @staticmethod
+    def user_data(orm_user):
+        """Get the database fields of a user model as plain data
+
+        Safe to call on the db executor, and pass back to the IOLoop.
+        """
+        return {
+            'id': orm_user.id,
+            'name': orm_user.name,
+            'admin': orm_user.admin,
+            'groups': [ g.name for g in orm_user.groups ],
+            'server': orm_user.server is not None,
+            'last_activity': orm_user.last_activity,
+        }
+
+    def user_model_from_data(self, data):
+        """Get the JSON model for a user from user_data
+
+        Like user_model, without loading anything from the database
+        for users the Hub already has in memory.
+        """
+        user = self.users[data['id']]
+        model = {
+            'name': data['name'],
+            'admin': data['admin'],
+            'groups': data['groups'],
+            'server': None,
+            'pending': None,
+            'last_activity': data['last_activity'].isoformat(),
+        }
+        if user.spawn_pending:
+            model['pending'] = 'spawn'
+        elif user.stop_pending:
+            model['pending'] = 'stop'
+        elif data['server']:
+            model['server'] = user.url
+        return model
+
     def group_model(self, group):
         """Get the JSON model for a Group object"""
         return {
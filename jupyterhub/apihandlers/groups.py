@@ -5,6 +5,7 @@
 
 import json
 
+from sqlalchemy.orm import subqueryload
 from tornado import gen, web
 
 from .. import orm
@@ -36,9 +37,13 @@ class _GroupAPIHandler(APIHandler):
 
 class GroupListAPIHandler(_GroupAPIHandler):
     @admin_only
+    @gen.coroutine
     def get(self):
         """List groups"""
-        data = [ self.group_model(g) for g in self.db.query(orm.Group) ]
+        def list_groups(db):
+            groups = db.query(orm.Group).options(subqueryload(orm.Group.users))
+            return [ self.group_model(g) for g in groups ]
+        data = yield self.db_executor.run(list_groups)
         self.write(json.dumps(data))
 
 
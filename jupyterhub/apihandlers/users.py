@@ -3,21 +3,142 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from datetime import datetime
 import json
+from urllib.parse import urlencode
 
 from tornado import gen, web
 
 from .. import orm
-from ..utils import admin_only
+from ..utils import admin_only, ISO8601_ms, ISO8601_s
 from .base import APIHandler
 
 
 class UserListAPIHandler(APIHandler):
+    # number of users loaded and written per flush
+    page_size = 100
+
+    _states = ('running', 'pending', 'stopped')
+
+    def _get_datetime_argument(self, name):
+        value = self.get_argument(name, None)
+        if value is None:
+            return None
+        for fmt in (ISO8601_ms, ISO8601_s, ISO8601_ms[:-1], ISO8601_s[:-1]):
+            try:
+                return datetime.strptime(value, fmt)
+            except ValueError:
+                pass
+        raise web.HTTPError(400, "%s must be an ISO8601 timestamp, not %r" % (name, value))
+
     @admin_only
+    @gen.coroutine
     def get(self):
-        users = [ self._user_from_orm(u) for u in self.db.query(orm.User) ]
-        data = [ self.user_model(u) for u in users ]
-        self.write(json.dumps(data))
+        """List users, ordered by id
+
+        Optional query arguments:
+
+        - offset, limit: pagination
+        - after: only users after this cursor, instead of an offset
+        - state: only users whose server is running, pending, or stopped
+        - last_activity_before: only users inactive since this (UTC) ISO8601 time
+
+        The list is written out a page at a time,
+        so the whole user list is never held in memory.
+
+        When more users follow the last one within `limit`, the URL of the next page is given
+        in a `Link: <url>; rel="next"` header, with the cursor as `after`.
+        Paging by cursor is stable as users are added and deleted.
+        Responses with a limit are sent whole, so that header can be set.
+        """
+        offset = self.get_int_argument('offset', 0, minimum=0)
+        limit = self.get_int_argument('limit', minimum=1)
+        after = self.get_int_argument('after', minimum=0)
+        if offset and after is not None:
+            raise web.HTTPError(400, "offset and after cannot be used together")
+        state = self.get_argument('state', None)
+        if state is not None and state not in self._states:
+            raise web.HTTPError(400, "state must be one of %s, not %r" % (
+                ', '.join(self._states), state))
+        last_activity_before = self._get_datetime_argument('last_activity_before')
+
+        page_size = self.page_size
+        def load_page(db, last_id, offset):
+            """Load a page of users as plain data, on the db executor"""
+            query = orm.User.query_with_models(db)
+            if state == 'stopped':
+                query = query.filter(orm.User._server_id == None)
+            elif state:
+                # running vs pending is only known in memory
+                query = query.filter(orm.User._server_id != None)
+            if last_activity_before is not None:
+                query = query.filter(orm.User.last_activity < last_activity_before)
+            query = query.order_by(orm.User.id)
+            if last_id is None:
+                query = query.offset(offset)
+            else:
+                # continue by id, which is stable as users come and go
+                query = query.filter(orm.User.id > last_id)
+            return [ self.user_data(orm_user) for orm_user in query.limit(page_size) ]
+
+        def selected(model):
+            if state == 'running':
+                return bool(model['server'])
+            elif state == 'pending':
+                return bool(model['pending'])
+            return True
+
+        if state in {'running', 'pending'}:
+            # offset must count users after checking their state
+            skip, offset = offset, 0
+        else:
+            skip = 0
+
+        self.write('[')
+        sep = ''
+        # continue from the cursor, if there is one
+        last_id = after
+        # id of the last user written
+        cursor = None
+        remaining = limit
+        # whether another selected user follows the limit
+        more = False
+        while True:
+            page = yield self.db_executor.run(load_page, last_id, offset)
+            for data in page:
+                model = self.user_model_from_data(data)
+                if not selected(model):
+                    continue
+                if skip:
+                    skip -= 1
+                    continue
+                if remaining == 0:
+                    more = True
+                    break
+                self.write(sep + json.dumps(model))
+                sep = ','
+                cursor = data['id']
+                if remaining is not None:
+                    remaining -= 1
+            if more or len(page) < page_size:
+                break
+            last_id = page[-1]['id']
+            if limit is None:
+                yield self.flush()
+        if more:
+            self.set_header('Link', '<%s>; rel="next"' % self._next_url(cursor))
+        self.write(']')
+
+    def _next_url(self, cursor):
+        """The URL of the next page of this request, continuing after cursor"""
+        args = [
+            (name, value.decode('utf8', 'replace'))
+            for name, values in self.request.query_arguments.items()
+            if name not in {'offset', 'after'}
+            for value in values
+        ]
+        args.append(('after', str(cursor)))
+        return '%s?%s' % (self.request.path, urlencode(args))
     
     @admin_only
     @gen.coroutine
@@ -6,16 +6,18 @@
 
 import atexit
 import binascii
+from concurrent.futures import Executor, ThreadPoolExecutor
+import hashlib
+import hmac
 import logging
 import os
 import shutil
 import signal
-import socket
 import sys
 import threading
-from datetime import datetime
+import time
+from datetime import datetime, timedelta
 from getpass import getuser
-from subprocess import Popen
 from urllib.parse import urlparse
 
 if sys.version_info[:2] < (3,3):
@@ -28,14 +30,13 @@ from sqlalchemy.orm import scoped_session
 
 import tornado.httpserver
 import tornado.options
-from tornado.httpclient import HTTPError
 from tornado.ioloop import IOLoop, PeriodicCallback
 from tornado.log import app_log, access_log, gen_log
 from tornado import gen, web
 
 from traitlets import (
     Unicode, Integer, Dict, TraitError, List, Bool, Any,
-    Type, Set, Instance, Bytes, Float,
+    Type, Set, Instance, Bytes, Float, CaselessStrEnum,
     observe, default,
 )
 from traitlets.config import Application, catch_config_error
@@ -45,6 +46,7 @@ here = os.path.dirname(__file__)
 import jupyterhub
 from . import handlers, apihandlers
 from .handlers.static import CacheControlStaticFilesHandler, LogoHandler
+from .proxy import ProxyBackend, ConfigurableHTTPProxy, TornadoProxy
 from .services.service import Service
 
 from . import dbutil, orm
@@ -54,7 +56,9 @@ from .log import CoroutineLogFormatter, log_request
 from .traitlets import URLPrefix, Command
 from .utils import (
     url_path_join,
-    ISO8601_ms, ISO8601_s,
+    parse_iso8601,
+    service_identity_name,
+    LRUCache, chunks,
 )
 # classes for config
 from .auth import Authenticator, PAMAuthenticator
@@ -221,6 +225,7 @@ class JupyterHub(Application):
         LocalProcessSpawner,
         Authenticator,
         PAMAuthenticator,
+        TornadoProxy,
     ])
     
     load_groups = Dict(List(Unicode()),
@@ -253,12 +258,53 @@ class JupyterHub(Application):
         Default is two weeks.
         """
     ).tag(config=True)
+    identity_max_age = Integer(600,
+        help="""Time (in seconds) for which a signed identity cookie is valid.
+
+        When the Hub sets login cookies for single-user servers and services,
+        it also sets a cookie with the user's name, admin status, and groups,
+        signed with a key that only the Hub and that server or service have.
+        Each server and each service has its own key.
+        HubAuth checks the signature itself instead of asking the Hub who the user is,
+        and asks the Hub for a fresh identity once it expires.
+
+        Identities are not revoked: until it expires, an identity is accepted
+        after the user logs out, and after changes to their admin status or groups.
+
+        Set to 0 to disable identity cookies.
+        """
+    ).tag(config=True)
     last_activity_interval = Integer(300,
         help="Interval (in seconds) at which to update last-activity timestamps."
     ).tag(config=True)
     proxy_check_interval = Integer(30,
         help="Interval (in seconds) at which to check if the proxy is running."
     ).tag(config=True)
+    proxy_route_concurrency = Integer(10,
+        help="""Maximum number of concurrent requests to the proxy API when updating routes.
+
+        This also limits how quickly routes are restored when the proxy is restarted.
+        """
+    ).tag(config=True)
+    proxy_route_priority_window = Integer(1800,
+        help="""Users active within this many seconds get their routes first when the proxy is restarted."""
+    ).tag(config=True)
+    proxy_api_max_clients = Integer(64,
+        help="""Maximum number of simultaneous connections to the proxy API.
+
+        The proxy API client keeps connections alive between requests
+        if pycurl is installed.
+        """
+    ).tag(config=True)
+    proxy_api_timeout = Float(20,
+        help="Timeout (in seconds) for each request to the proxy API."
+    ).tag(config=True)
+    proxy_api_retries = Integer(2,
+        help="""Number of times to retry a proxy API request that fails with a connection error or 5xx response.
+
+        Retries wait 0.1s, doubling after each attempt.
+        """
+    ).tag(config=True)
 
     data_files_path = Unicode(DATA_FILES_PATH,
         help="The location of jupyterhub data files (e.g. /usr/local/share/jupyter/hub)"
@@ -338,6 +384,14 @@ class JupyterHub(Application):
         help="Supply extra arguments that will be passed to Jinja environment."
     ).tag(config=True)
 
+    proxy_class = Type(ConfigurableHTTPProxy, ProxyBackend,
+        help="""The class to use for the proxy, which routes requests to the Hub and single-user servers.
+
+        Should be a subclass of ProxyBackend.
+        The default runs configurable-http-proxy.
+        `jupyterhub.proxy.TornadoProxy` is a proxy that runs in the Hub process.
+        """
+    ).tag(config=True)
     proxy_cmd = Command('configurable-http-proxy',
         help="""The command to start the http proxy.
 
@@ -412,6 +466,26 @@ class JupyterHub(Application):
         help="""File in which to store the cookie secret."""
     ).tag(config=True)
 
+    api_token_hash_key = Bytes(
+        help="""The key for hashing API tokens.
+
+        Loaded from the JUPYTERHUB_API_TOKEN_HASH_KEY env variable (hex) by default.
+
+        This is separate from the cookie secret,
+        so that rotating the cookie secret doesn't invalidate API tokens.
+        Changing this key invalidates every API token that has been hashed with it,
+        which includes tokens hashed with the slower scheme of older versions
+        once they have been used.
+        """
+    ).tag(
+        config=True,
+        env='JUPYTERHUB_API_TOKEN_HASH_KEY',
+    )
+
+    api_token_hash_key_file = Unicode('jupyterhub_api_token_hash_key',
+        help="""File in which to store the API token hash key."""
+    ).tag(config=True)
+
     api_tokens = Dict(Unicode(),
         help="""PENDING DEPRECATION: consider using service_tokens
         
@@ -431,6 +505,71 @@ class JupyterHub(Application):
             " let us know: https://github.com/jupyterhub/jupyterhub/issues"
         )
 
+    token_cache_max_age = Integer(300,
+        help="""Time (in seconds) that a verified API token is remembered.
+
+        Requests with a recently verified token skip re-hashing the token,
+        which is deliberately expensive.
+        Set to 0 to keep verified tokens until they are evicted by `token_cache_max_size`.
+        """
+    ).tag(config=True)
+    token_cache_max_size = Integer(10000,
+        help="""Maximum number of verified API tokens to remember.
+
+        Set to 0 to disable the verified-token cache.
+        """
+    ).tag(config=True)
+
+    cookie_cache_max_size = Integer(10000,
+        help="""Maximum number of verified login cookies to remember.
+
+        Requests with a recently verified cookie skip checking its signature
+        and looking up its user in the database.
+
+        Set to 0 to disable the login cookie cache.
+        """
+    ).tag(config=True)
+
+    token_reap_interval = Integer(300,
+        help="""Interval (in seconds) at which to delete expired and ownerless API tokens.
+
+        Set to 0 to disable the token reaper.
+        """
+    ).tag(config=True)
+    token_reap_batch_size = Integer(1000,
+        help="""Maximum number of API tokens to delete in a single statement.
+
+        The reaper yields to the Hub's other work between batches.
+        """
+    ).tag(config=True)
+
+    token_hash_workers = Integer(4,
+        help="""Number of workers for hashing API tokens.
+
+        Hashing tokens is deliberately slow.
+        Token lookups from request handlers and new tokens for spawning servers
+        are hashed on a pool of this many workers, so the Hub stays responsive
+        while tokens are being checked.
+
+        Set to 0 to hash tokens in the Hub's main thread.
+        """
+    ).tag(config=True)
+    token_hash_executor_class = Type(ThreadPoolExecutor, Executor,
+        help="""The concurrent.futures.Executor class to use for hashing API tokens.
+
+        ThreadPoolExecutor keeps the Hub responsive while hashing.
+        ProcessPoolExecutor also hashes tokens in parallel across CPUs,
+        at the cost of extra processes.
+        """
+    ).tag(config=True)
+    token_hash_executor = Any()
+
+    @default('token_hash_executor')
+    def _token_hash_executor_default(self):
+        if self.token_hash_workers <= 0:
+            return None
+        return self.token_hash_executor_class(self.token_hash_workers)
+
     service_tokens = Dict(Unicode(),
         help="""Dict of token:servicename to be loaded into the database.
 
@@ -507,13 +646,79 @@ class JupyterHub(Application):
         """
     ).tag(config=True)
 
+    db_pool_size = Integer(0,
+        help="""Number of connections to keep open in the database connection pool.
+
+        0 uses SQLAlchemy's default.
+        Not used for sqlite, which does not pool connections.
+        """
+    ).tag(config=True)
+
+    sqlite_journal_mode = CaselessStrEnum(
+        ['delete', 'truncate', 'persist', 'memory', 'wal', 'off'],
+        default_value=None, allow_none=True,
+        help="""Journal mode for a sqlite database (PRAGMA journal_mode).
+
+        'wal' lets readers proceed while a write is in progress,
+        and needs fewer fsyncs per commit than the default rollback journal.
+        Leave unset to keep sqlite's default ('delete').
+        """
+    ).tag(config=True)
+    sqlite_synchronous = CaselessStrEnum(
+        ['off', 'normal', 'full', 'extra'],
+        default_value=None, allow_none=True,
+        help="""How often sqlite waits for data to reach disk (PRAGMA synchronous).
+
+        'normal' is safe with the 'wal' journal mode and avoids an fsync on every commit.
+        Leave unset to keep sqlite's default ('full').
+        """
+    ).tag(config=True)
+    sqlite_cache_size = Integer(0,
+        help="""sqlite page cache size (PRAGMA cache_size).
+
+        Positive values are a number of pages, negative values a number of KiB.
+        0 keeps sqlite's default.
+        """
+    ).tag(config=True)
+    sqlite_mmap_size = Integer(0,
+        help="""Maximum number of bytes of a sqlite database to memory-map (PRAGMA mmap_size).
+
+        0 (the default) keeps sqlite's default, without setting the PRAGMA.
+        sqlite doesn't memory-map databases by default,
+        unless it was compiled with a different SQLITE_DEFAULT_MMAP_SIZE.
+        """
+    ).tag(config=True)
+
+    def _sqlite_pragmas(self):
+        """The PRAGMAs to set on sqlite connections"""
+        pragmas = {}
+        if self.sqlite_journal_mode:
+            pragmas['journal_mode'] = self.sqlite_journal_mode
+        if self.sqlite_synchronous:
+            pragmas['synchronous'] = self.sqlite_synchronous
+        if self.sqlite_cache_size:
+            pragmas['cache_size'] = self.sqlite_cache_size
+        if self.sqlite_mmap_size:
+            pragmas['mmap_size'] = self.sqlite_mmap_size
+        return pragmas
+
     reset_db = Bool(False,
         help="Purge and reset the database."
     ).tag(config=True)
     debug_db = Bool(False,
         help="log all database transactions. This has A LOT of output"
     ).tag(config=True)
+    db_commit_interval = Float(1,
+        help="""Interval (in seconds) at which low-priority database writes are committed.
+
+        Writes that can wait, such as last_activity updates from the proxy,
+        are collected and committed together in one transaction.
+        Other writes are committed immediately.
+        """
+    ).tag(config=True)
     session_factory = Any()
+    commit_scheduler = Any()
+    db_executor = Any()
 
     users = Instance(UserDict)
 
@@ -580,7 +785,7 @@ class JupyterHub(Application):
 
     _log_formatter_cls = CoroutineLogFormatter
     http_server = None
-    proxy_process = None
+    proxy_backend = None
     io_loop = None
 
     @default('log_level')
@@ -705,13 +910,18 @@ class JupyterHub(Application):
             self.log.error("%s cannot edit %s", user, path)
 
     def init_secrets(self):
-        trait_name = 'cookie_secret'
+        for trait_name in ('cookie_secret', 'api_token_hash_key'):
+            self._load_secret(trait_name)
+
+    def _load_secret(self, trait_name):
+        """Load a secret from config, env, or its file, or generate and store a new one"""
         trait = self.traits()[trait_name]
         env_name = trait.metadata.get('env')
+        file_trait_name = trait_name + '_file'
         secret_file = os.path.abspath(
-            os.path.expanduser(self.cookie_secret_file)
+            os.path.expanduser(getattr(self, file_trait_name))
         )
-        secret = self.cookie_secret
+        secret = getattr(self, trait_name)
         secret_from = 'config'
         # load priority: 1. config, 2. env, 3. file
         secret_env = os.environ.get(env_name)
@@ -725,15 +935,15 @@ class JupyterHub(Application):
             try:
                 perm = os.stat(secret_file).st_mode
                 if perm & 0o07:
-                    raise ValueError("cookie_secret_file can be read or written by anybody")
+                    raise ValueError("%s can be read or written by anybody" % file_trait_name)
                 with open(secret_file) as f:
                     b64_secret = f.read()
                 secret = binascii.a2b_base64(b64_secret)
             except Exception as e:
                 self.log.error(
-                    "Refusing to run JupyterHub with invalid cookie_secret_file. "
+                    "Refusing to run JupyterHub with invalid %s. "
                     "%s error was: %s",
-                    secret_file, e)
+                    file_trait_name, secret_file, e)
                 self.exit(1)
         if not secret:
             secret_from = 'new'
@@ -751,7 +961,22 @@ class JupyterHub(Application):
             except OSError:
                 self.log.warning("Failed to set permissions on %s", secret_file)
         # store the loaded trait value
-        self.cookie_secret = secret
+        setattr(self, trait_name, secret)
+
+    def _derive_secret(self, purpose):
+        """Derive a secret key for a given purpose from the cookie secret"""
+        return hmac.new(self.cookie_secret, b'jupyterhub:' + purpose, hashlib.sha256).digest()
+
+    def identity_key(self, cookie_name):
+        """The key for signing identities that accompany a login cookie
+
+        Each cookie (a user's server, or services) has its own key,
+        so one server can't sign identities that another will accept.
+
+        Returns None if identity cookies are disabled.
+        """
+        if self.identity_max_age:
+            return self._derive_secret(b'identity:' + cookie_name.encode('utf8'))
 
     # thread-local storage of db objects
     _local = Instance(threading.local, ())
@@ -791,18 +1016,53 @@ class JupyterHub(Application):
     def proxy(self, proxy):
         self._local.proxy = proxy
 
+    @property
+    def proxy_process(self):
+        """The configurable-http-proxy process, if the Hub started it"""
+        return getattr(self.proxy_backend, 'process', None)
+
     def init_db(self):
         """Create the database connection"""
         self.log.debug("Connecting to db: %s", self.db_url)
+        db_kwargs = dict(self.db_kwargs)
+        if self.db_pool_size and not self.db_url.startswith('sqlite'):
+            db_kwargs.setdefault('pool_size', self.db_pool_size)
         try:
             self.session_factory = orm.new_session_factory(
                 self.db_url,
                 reset=self.reset_db,
                 echo=self.debug_db,
-                **self.db_kwargs
+                sqlite_pragmas=self._sqlite_pragmas(),
+                **db_kwargs
             )
             # trigger constructing thread local db property
             _ = self.db
+            if self.db_url.startswith('sqlite') and self.db_url.endswith(':memory:'):
+                # every session shares the one in-memory connection,
+                # so database work can't move to another thread,
+                # and a separate session wouldn't have a transaction of its own
+                scheduler_db_factory = lambda : self.db
+                self.db_executor = dbutil.DatabaseExecutor(db_factory=lambda : self.db)
+            else:
+                # queued writes get a session of their own,
+                # so a failed flush can't roll back a request's changes
+                scheduler_db = self.session_factory()
+                scheduler_db_factory = lambda : scheduler_db
+                self.db_executor = dbutil.DatabaseExecutor(self.session_factory)
+            self.commit_scheduler = dbutil.CommitScheduler(
+                scheduler_db_factory,
+                session_factory=self.session_factory,
+                interval=self.db_commit_interval,
+                statsd=self.statsd,
+                log=self.log,
+            )
+            orm.APIToken.cache = LRUCache(
+                max_size=self.token_cache_max_size,
+                max_age=self.token_cache_max_age,
+            )
+            orm.User.cookie_cache = LRUCache(max_size=self.cookie_cache_max_size)
+            orm.APIToken.hash_key = self.api_token_hash_key or None
+            orm.APIToken.commit_scheduler = self.commit_scheduler
         except OperationalError as e:
             self.log.error("Failed to connect to db: %s", self.db_url)
             self.log.debug("Database error was:", exc_info=True)
@@ -943,8 +1203,14 @@ class JupyterHub(Application):
         db.commit()
     
     @gen.coroutine
-    def _add_tokens(self, token_dict, kind):
-        """Add tokens for users or services to the database"""
+    def _add_tokens(self, token_dict, kind, executor=None):
+        """Add tokens for users or services to the database
+
+        All new tokens are hashed together on `executor`
+        and added in a single transaction.
+        Configured tokens never expire, so existing ones that would are renewed,
+        rather than added again.
+        """
         if kind == 'user':
             Class = orm.User
         elif kind == 'service':
@@ -953,6 +1219,7 @@ class JupyterHub(Application):
             raise ValueError("kind must be user or service, not %r" % kind)
 
         db = self.db
+        names = {}
         for token, name in token_dict.items():
             if kind == 'user':
                 name = self.authenticator.normalize_username(name)
@@ -960,34 +1227,47 @@ class JupyterHub(Application):
                     raise ValueError("Token name %r is not in whitelist" % name)
                 if not self.authenticator.validate_username(name):
                     raise ValueError("Token name %r is not valid" % name)
-            orm_token = orm.APIToken.find(db, token)
-            if orm_token is None:
-                obj = Class.find(db, name)
-                created = False
-                if obj is None:
-                    created = True
-                    self.log.debug("Adding %s %r to database", kind, name)
-                    obj = Class(name=name)
-                    db.add(obj)
-                    db.commit()
-                self.log.info("Adding API token for %s: %s", kind, name)
-                try:
-                    obj.new_api_token(token)
-                except Exception:
-                    if created:
-                        # don't allow bad tokens to create users
-                        db.delete(obj)
-                        db.commit()
-                        raise
+            names[token] = name
+
+        existing = yield orm.APIToken.find_many_async(db, names, executor=executor,
+            include_expired=True,
+        )
+        for orm_token in existing.values():
+            if orm_token.expires_at is not None:
+                self.log.info("Configured API token %s no longer expires", orm_token)
+                orm_token.expires_at = None
             else:
                 self.log.debug("Not duplicating token %s", orm_token)
         db.commit()
+        new_names = { token: name for token, name in names.items() if token not in existing }
+        if not new_names:
+            return
+
+        objs = {}
+        for chunk in chunks(sorted(set(new_names.values()))):
+            for obj in db.query(Class).filter(Class.name.in_(chunk)):
+                objs[obj.name] = obj
+        owners = {}
+        for token, name in new_names.items():
+            if name not in objs:
+                self.log.debug("Adding %s %r to database", kind, name)
+                objs[name] = Class(name=name)
+                db.add(objs[name])
+            self.log.info("Adding API token for %s: %s", kind, name)
+            owners[token] = objs[name]
+        try:
+            yield orm.APIToken.new_many_async(db, owners, executor=executor)
+        except Exception:
+            # don't allow bad tokens to create users
+            db.rollback()
+            raise
     
     @gen.coroutine
     def init_api_tokens(self):
         """Load predefined API tokens (for services) into database"""
-        yield self._add_tokens(self.service_tokens, kind='service')
-        yield self._add_tokens(self.api_tokens, kind='user')
+        executor = self.token_hash_executor
+        yield self._add_tokens(self.service_tokens, kind='service', executor=executor)
+        yield self._add_tokens(self.api_tokens, kind='user', executor=executor)
     
     def init_services(self):
         self._service_map.clear()
@@ -1021,6 +1301,9 @@ class JupyterHub(Application):
                 if key not in traits:
                     raise AttributeError("No such service field: %s" % key)
                 setattr(service, key, value)
+            identity_key = self.identity_key(service_identity_name(name))
+            if identity_key:
+                service.identity_key = binascii.b2a_hex(identity_key).decode('ascii')
 
             if service.url:
                 parsed = urlparse(service.url)
@@ -1114,6 +1397,10 @@ class JupyterHub(Application):
             self.db.commit()
         self.proxy.auth_token = self.proxy_auth_token # not persisted
         self.proxy.log = self.log
+        self.proxy.statsd = self.statsd
+        self.proxy.http_client_factory = self._proxy_http_client
+        self.proxy.api_timeout = self.proxy_api_timeout
+        self.proxy.api_retries = self.proxy_api_retries
         self.proxy.public_server.ip = self.ip
         self.proxy.public_server.port = self.port
         self.proxy.public_server.base_url = self.base_url
@@ -1122,101 +1409,71 @@ class JupyterHub(Application):
         self.proxy.api_server.base_url = '/api/routes/'
         self.db.commit()
 
-    @gen.coroutine
-    def start_proxy(self):
-        """Actually start the configurable-http-proxy"""
-        # check for proxy
-        if self.proxy.public_server.is_up() or self.proxy.api_server.is_up():
-            # check for *authenticated* access to the proxy (auth token can change)
-            try:
-                routes = yield self.proxy.get_routes()
-            except (HTTPError, OSError, socket.error) as e:
-                if isinstance(e, HTTPError) and e.code == 403:
-                    msg = "Did CONFIGPROXY_AUTH_TOKEN change?"
-                else:
-                    msg = "Is something else using %s?" % self.proxy.public_server.bind_url
-                self.log.error("Proxy appears to be running at %s, but I can't access it (%s)\n%s",
-                    self.proxy.public_server.bind_url, e, msg)
-                self.exit(1)
-                return
-            else:
-                self.log.info("Proxy already running at: %s", self.proxy.public_server.bind_url)
-                yield self.proxy.check_routes(self.users, self._service_map, routes)
-            self.proxy_process = None
-            return
+        backend_kwargs = dict(
+            parent=self,
+            log=self.log,
+            proxy=self.proxy,
+            hub=self.hub,
+            statsd=self.statsd,
+            host_routing=bool(self.subdomain_host),
+            ssl_key=self.ssl_key,
+            ssl_cert=self.ssl_cert,
+        )
+        if issubclass(self.proxy_class, ConfigurableHTTPProxy):
+            backend_kwargs.update(
+                command=self.proxy_cmd,
+                debug=self.debug_proxy,
+                statsd_host=self.statsd_host,
+                statsd_port=self.statsd_port,
+                statsd_prefix=self.statsd_prefix,
+            )
+        self.proxy.backend = self.proxy_backend = self.proxy_class(**backend_kwargs)
 
-        env = os.environ.copy()
-        env['CONFIGPROXY_AUTH_TOKEN'] = self.proxy.auth_token
-        cmd = self.proxy_cmd + [
-            '--ip', self.proxy.public_server.ip,
-            '--port', str(self.proxy.public_server.port),
-            '--api-ip', self.proxy.api_server.ip,
-            '--api-port', str(self.proxy.api_server.port),
-            '--default-target', self.hub.server.host,
-            '--error-target', url_path_join(self.hub.server.url, 'error'),
-        ]
-        if self.subdomain_host:
-            cmd.append('--host-routing')
-        if self.debug_proxy:
-            cmd.extend(['--log-level', 'debug'])
-        if self.ssl_key:
-            cmd.extend(['--ssl-key', self.ssl_key])
-        if self.ssl_cert:
-            cmd.extend(['--ssl-cert', self.ssl_cert])
-        if self.statsd_host:
-            cmd.extend([
-                '--statsd-host', self.statsd_host,
-                '--statsd-port', str(self.statsd_port),
-                '--statsd-prefix', self.statsd_prefix + '.chp'
-            ])
-        # Warn if SSL is not used
-        if ' --ssl' not in ' '.join(cmd):
-            self.log.warning("Running JupyterHub without SSL."
-                "  I hope there is SSL termination happening somewhere else...")
-        self.log.info("Starting proxy @ %s", self.proxy.public_server.bind_url)
-        self.log.debug("Proxy cmd: %s", cmd)
+    def _proxy_http_client(self):
+        """Create an HTTP client for the proxy API
+
+        Uses tornado's curl client if available, which reuses connections.
+        """
         try:
-            self.proxy_process = Popen(cmd, env=env, start_new_session=True)
-        except FileNotFoundError as e:
-            self.log.error(
-                "Failed to find proxy %r\n"
-                "The proxy can be installed with `npm install -g configurable-http-proxy`"
-                 % self.proxy_cmd
-            )
-            self.exit(1)
-        def _check():
-            status = self.proxy_process.poll()
-            if status is not None:
-                e = RuntimeError("Proxy failed to start with exit code %i" % status)
-                # py2-compatible `raise e from None`
-                e.__cause__ = None
-                raise e
-
-        for server in (self.proxy.public_server, self.proxy.api_server):
-            for i in range(10):
-                _check()
-                try:
-                    yield server.wait_up(1)
-                except TimeoutError:
-                    continue
-                else:
-                    break
-            yield server.wait_up(1)
-        self.log.debug("Proxy started and appears to be up")
+            from tornado.curl_httpclient import CurlAsyncHTTPClient as client_class
+        except ImportError:
+            from tornado.simple_httpclient import SimpleAsyncHTTPClient as client_class
+        return client_class(force_instance=True, max_clients=self.proxy_api_max_clients)
+
+    @gen.coroutine
+    def start_proxy(self):
+        """Start the proxy, or connect to one that is already running"""
+        yield self.proxy_backend.start()
+        if not self.proxy_backend.managed:
+            yield self.check_routes()
 
     @gen.coroutine
     def check_proxy(self):
-        if self.proxy_process.poll() is None:
+        if self.proxy_backend.is_running():
             return
         self.log.error("Proxy stopped with exit code %r",
             'unknown' if self.proxy_process is None else self.proxy_process.poll()
         )
         yield self.start_proxy()
         self.log.info("Setting up routes on new proxy")
-        yield self.proxy.add_all_users(self.users)
-        yield self.proxy.add_all_services(self.services)
+        yield self.restore_routes()
         self.log.info("New proxy back up, and good to go")
 
+    @gen.coroutine
+    def restore_routes(self):
+        """Add routes for all running users and services to a new proxy
+
+        Recently active users are restored first.
+        """
+        active_since = datetime.utcnow() - timedelta(seconds=self.proxy_route_priority_window)
+        yield self.proxy.add_all_users(self.users,
+            concurrency=self.proxy_route_concurrency,
+            active_since=active_since,
+        )
+        yield self.proxy.add_all_services(self._service_map,
+            concurrency=self.proxy_route_concurrency,
+        )
+
     def init_tornado_settings(self):
         """Set up the tornado settings dict."""
         base_url = self.hub.server.base_url
@@ -1265,6 +1522,10 @@ class JupyterHub(Application):
             subdomain_host=self.subdomain_host,
             domain=self.domain,
             statsd=self.statsd,
+            token_hash_executor=self.token_hash_executor,
+            db_executor=self.db_executor,
+            identity_key=self.identity_key,
+            identity_max_age=self.identity_max_age,
         )
         # allow configured settings to have priority
         settings.update(self.tornado_settings)
@@ -1339,13 +1600,8 @@ class JupyterHub(Application):
 
         # clean up proxy while single-user servers are shutting down
         if self.cleanup_proxy:
-            if self.proxy_process:
-                self.log.info("Cleaning up proxy[%i]...", self.proxy_process.pid)
-                if self.proxy_process.poll() is None:
-                    try:
-                        self.proxy_process.terminate()
-                    except Exception as e:
-                        self.log.error("Failed to terminate proxy process: %s", e)
+            if self.proxy_backend.managed:
+                self.proxy_backend.stop()
             else:
                 self.log.info("I didn't start the proxy, I can't clean it up")
         else:
@@ -1359,8 +1615,14 @@ class JupyterHub(Application):
             except Exception as e:
                 self.log.error("Failed to stop user: %s", e)
 
+        self.commit_scheduler.flush()
         self.db.commit()
 
+        if self.token_hash_executor is not None:
+            self.token_hash_executor.shutdown(wait=False)
+        if self.db_executor is not None:
+            self.db_executor.shutdown(wait=False)
+
         if self.pid_file and os.path.exists(self.pid_file):
             self.log.info("Cleaning up PID file %s", self.pid_file)
             os.remove(self.pid_file)
@@ -1402,30 +1664,80 @@ class JupyterHub(Application):
     def update_last_activity(self):
         """Update User.last_activity timestamps from the proxy"""
         routes = yield self.proxy.get_routes()
-        users_count = 0
-        active_users_count = 0
+        tic = time.perf_counter()
+        # most recent activity from the proxy, by user name
+        activity = {}
         for prefix, route in routes.items():
             if 'user' not in route:
                 # not a user route, ignore it
                 continue
-            user = orm.User.find(self.db, route['user'])
-            if user is None:
-                self.log.warning("Found no user for route: %s", route)
-                continue
             try:
-                dt = datetime.strptime(route['last_activity'], ISO8601_ms)
-            except Exception:
-                dt = datetime.strptime(route['last_activity'], ISO8601_s)
-            user.last_activity = max(user.last_activity, dt)
+                dt = parse_iso8601(route['last_activity'])
+            except (KeyError, ValueError):
+                self.log.warning("Ignoring invalid last_activity for route: %s", route)
+                continue
+            name = route['user']
+            if name not in activity or dt > activity[name]:
+                activity[name] = dt
+
+        def load_activity(db, names):
+            found = {}
+            for chunk in chunks(names):
+                q = db.query(orm.User.id, orm.User.name, orm.User.last_activity)
+                found.update(
+                    (name, (user_id, last_activity))
+                    for user_id, name, last_activity in q.filter(orm.User.name.in_(chunk))
+                )
+            return found
+        found = yield self.db_executor.run(load_activity, list(activity))
+
+        users_count = 0
+        active_users_count = 0
+        now = datetime.now()
+        for name, dt in activity.items():
+            if name not in found:
+                self.log.warning("Found no user for route: %s", name)
+                continue
+            user_id, last_activity = found[name]
+            if dt > last_activity:
+                self.commit_scheduler.advance_soon(orm.User, user_id, 'last_activity', dt)
             # FIXME: Make this configurable duration. 30 minutes for now!
-            if (datetime.now() - user.last_activity).total_seconds() < 30 * 60:
+            if (now - max(last_activity, dt)).total_seconds() < 30 * 60:
                 active_users_count += 1
             users_count += 1
         self.statsd.gauge('users.running', users_count)
         self.statsd.gauge('users.active', active_users_count)
+        self.statsd.gauge('proxy.routes', len(routes))
+        self.statsd.timing('last_activity.update', 1e3 * (time.perf_counter() - tic))
 
-        self.db.commit()
-        yield self.proxy.check_routes(self.users, self._service_map, routes)
+        yield self.check_routes(routes)
+
+    @gen.coroutine
+    def check_routes(self, routes=None):
+        """Reconcile the proxy's routes with the running users and services"""
+        counts = yield self.proxy.check_routes(self.users, self._service_map, routes,
+            concurrency=self.proxy_route_concurrency,
+        )
+        for action, count in counts.items():
+            if count:
+                self.statsd.incr('proxy.routes.%s' % action, count)
+
+    @gen.coroutine
+    def reap_tokens(self):
+        """Delete expired API tokens and tokens whose owner no longer exists"""
+        for kind in ('expired', 'ownerless'):
+            reaped = 0
+            while True:
+                deleted = orm.APIToken.reap(self.db, kind, batch_size=self.token_reap_batch_size)
+                reaped += deleted
+                if deleted < self.token_reap_batch_size:
+                    break
+                # let requests be handled between batches
+                yield gen.moment
+            if reaped:
+                self.log.info("Deleted %i %s API tokens", reaped, kind)
+            self.statsd.incr('tokens.reaped.%s' % kind, reaped)
+        self.statsd.gauge('tokens.total', self.db.query(orm.APIToken).count())
 
     @gen.coroutine
     def start(self):
@@ -1468,10 +1780,9 @@ class JupyterHub(Application):
                 self.log.critical("Failed to start service %s", service_name, exc_info=True)
                 self.exit(1)
 
-        loop.add_callback(self.proxy.add_all_users, self.users)
-        loop.add_callback(self.proxy.add_all_services, self._service_map)
+        loop.add_callback(self.restore_routes)
 
-        if self.proxy_process:
+        if self.proxy_backend.managed:
             # only check / restart the proxy if we started it in the first place.
             # this means a restarted Hub cannot restart a Proxy that its
             # predecessor started.
@@ -1482,6 +1793,11 @@ class JupyterHub(Application):
             pc = PeriodicCallback(self.update_last_activity, 1e3 * self.last_activity_interval)
             pc.start()
 
+        if self.token_reap_interval:
+            loop.add_callback(self.reap_tokens)
+            pc = PeriodicCallback(self.reap_tokens, 1e3 * self.token_reap_interval)
+            pc.start()
+
         self.log.info("JupyterHub is now running at %s", self.proxy.public_server.url)
         # register cleanup on both TERM and INT
         atexit.register(self.atexit)
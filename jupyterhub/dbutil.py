@@ -4,11 +4,19 @@
 
 # Based on pgcontents.utils.migrate, used under the Apache license.
 
+from concurrent.futures import Future, ThreadPoolExecutor
 from contextlib import contextmanager
 import os
 from subprocess import check_call
 import sys
 from tempfile import TemporaryDirectory
+import time
+
+from sqlalchemy import bindparam, event, or_
+from tornado.ioloop import IOLoop
+from tornado.log import app_log
+
+from .emptyclass import EmptyClass
 
 _here = os.path.abspath(os.path.dirname(__file__))
 
@@ -88,6 +96,189 @@ def _alembic(*args):
         )
 
 
+class CommitScheduler:
+    """Coalesce low-priority writes into one transaction per tick
+
+    Correctness-critical writes still call `db.commit()` directly.
+    Writes that can wait are queued with `update_soon()`,
+    or with `advance_soon()` for timestamps such as last_activity,
+    and written together `interval` seconds after the first one is queued.
+
+    Queued values are held here rather than in the session,
+    so they survive the rollback at the end of each request.
+    They are written with the session from `db_factory()`,
+    which should be one of the scheduler's own,
+    so that a failed write only rolls back the queued updates.
+
+    Every commit on sessions from `session_factory` is timed
+    and reported to statsd as `db.commit`.
+    """
+
+    def __init__(self, db_factory, session_factory=None, interval=1, statsd=None, log=None):
+        self.db_factory = db_factory
+        self.interval = interval
+        self.statsd = statsd or EmptyClass()
+        self.log = log or app_log
+        # {model class: {id: {column: value}}}
+        self._pending = {}
+        # {(model class, column): {id: value}}
+        self._advances = {}
+        self._timeout = None
+        if session_factory is not None:
+            event.listen(session_factory, 'before_commit', self._before_commit)
+            event.listen(session_factory, 'after_commit', self._after_commit)
+
+    @property
+    def db(self):
+        return self.db_factory()
+
+    def _before_commit(self, session):
+        session.info['commit_start'] = time.perf_counter()
+
+    def _after_commit(self, session):
+        start = session.info.pop('commit_start', None)
+        if start is not None:
+            self.statsd.timing('db.commit', 1e3 * (time.perf_counter() - start))
+
+    @property
+    def pending(self):
+        """The number of queued row updates"""
+        return (
+            sum(len(updates) for updates in self._pending.values())
+            + sum(len(values) for values in self._advances.values())
+        )
+
+    def update_soon(self, model, id, **values):
+        """Queue an update of the `model` row with primary key `id`
+
+        Later updates to the same row replace earlier values.
+        """
+        self._pending.setdefault(model, {}).setdefault(id, {}).update(values)
+        self._schedule()
+
+    def advance_soon(self, model, id, column, value):
+        """Queue moving `column` of the `model` row with primary key `id` forward to `value`
+
+        The write is skipped if the stored value is already as new,
+        such as a last_activity set by a direct commit after this was queued.
+        Of several values queued for the same row, the newest is written.
+        """
+        values = self._advances.setdefault((model, column), {})
+        if id not in values or value > values[id]:
+            values[id] = value
+        self._schedule()
+
+    def _schedule(self):
+        if self._timeout is None:
+            loop = IOLoop.current()
+            self._timeout = loop.call_later(self.interval, self.flush)
+
+    def flush(self):
+        """Write all queued updates in a single transaction"""
+        if self._timeout is not None:
+            IOLoop.current().remove_timeout(self._timeout)
+            self._timeout = None
+        if not self._pending and not self._advances:
+            return
+        count = self.pending
+        pending, self._pending = self._pending, {}
+        advances, self._advances = self._advances, {}
+        db = self.db
+        try:
+            for model, updates in pending.items():
+                db.bulk_update_mappings(model, [
+                    dict(values, id=id) for id, values in updates.items()
+                ])
+            for (model, column), values in advances.items():
+                table = model.__table__
+                stored = table.c[column]
+                db.execute(
+                    table.update()
+                    .where(table.c.id == bindparam('_id'))
+                    .where(or_(stored == None, stored < bindparam('_value')))
+                    .values({column: bindparam('_value')}),
+                    [ {'_id': id, '_value': value} for id, value in values.items() ],
+                )
+            db.commit()
+        except Exception:
+            self.log.error("Failed to write %i queued db updates, dropping them: %s",
+                count, self._describe(pending, advances), exc_info=True)
+            db.rollback()
+        else:
+            self.statsd.incr('db.coalesced', count)
+
+    @staticmethod
+    def _describe(pending, advances):
+        """Describe queued updates for the log, e.g. `User 1 (last_activity)`"""
+        updates = [
+            '%s %s (%s)' % (model.__name__, id, ', '.join(sorted(values)))
+            for model, updates in pending.items()
+            for id, values in updates.items()
+        ]
+        updates.extend(
+            '%s %s (%s)' % (model.__name__, id, column)
+            for (model, column), values in advances.items()
+            for id in values
+        )
+        return ', '.join(updates)
+
+
+class DatabaseExecutor:
+    """Run database work off the IOLoop
+
+    `run(func, *args)` calls `func(db, *args)` on a single dedicated thread,
+    with a session of its own, and returns a Future for the result.
+    A single thread serializes writes, as sqlite requires.
+    The transaction is ended after each call,
+    so functions that write must commit themselves.
+
+    Objects loaded in the executor's session must not be used on other threads:
+    functions should return plain data (ids, names, dicts),
+    rather than ORM objects.
+
+    If `session_factory` is None, functions are called right away
+    with the session from `db_factory()`.
+    This is used for in-memory sqlite databases,
+    where every session shares a single connection.
+    """
+
+    def __init__(self, session_factory=None, db_factory=None):
+        self.session_factory = session_factory
+        self.db_factory = db_factory
+        if session_factory is None:
+            self._executor = None
+        else:
+            self._executor = ThreadPoolExecutor(1)
+        # the executor thread's session
+        self._db = None
+
+    def _call(self, func, args, kwargs):
+        if self._db is None:
+            self._db = self.session_factory()
+        try:
+            return func(self._db, *args, **kwargs)
+        finally:
+            self._db.rollback()
+
+    def run(self, func, *args, **kwargs):
+        """Call func(db, *args, **kwargs) on the database thread
+
+        Returns a Future.
+        """
+        if self._executor is not None:
+            return self._executor.submit(self._call, func, args, kwargs)
+        f = Future()
+        try:
+            f.set_result(func(self.db_factory(), *args, **kwargs))
+        except Exception as e:
+            f.set_exception(e)
+        return f
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.submit(lambda : self._db and self._db.close())
+            self._executor.shutdown(wait=wait)
+
+
 if __name__ == '__main__':
-    import sys
     _alembic(*sys.argv[1:])
@@ -4,12 +4,14 @@
 # Distributed under the terms of the Modified BSD License.
 
 import re
+import time
 from datetime import timedelta
 from http.client import responses
 from urllib.parse import urlparse
 
 from jinja2 import TemplateNotFound
 
+from tornado.escape import utf8
 from tornado.log import app_log
 from tornado.httputil import url_concat
 from tornado.ioloop import IOLoop
@@ -17,9 +19,10 @@ from tornado.web import RequestHandler
 from tornado import gen, web
 
 from .. import orm
+from ..dbutil import DatabaseExecutor
 from ..user import User
 from ..spawner import LocalProcessSpawner
-from ..utils import url_path_join
+from ..utils import url_path_join, sign_identity, service_identity_name
 
 # pattern for the authentication token header
 auth_header_pat = re.compile(r'^token\s+([^\s]+)$')
@@ -87,6 +90,31 @@ class BaseHandler(RequestHandler):
     def authenticator(self):
         return self.settings.get('authenticator', None)
 
+    @property
+    def token_hash_executor(self):
+        return self.settings.get('token_hash_executor', None)
+
+    @property
+    def db_executor(self):
+        settings = self.settings
+        if settings.get('db_executor') is None:
+            # no database thread, run on the Hub's own session
+            settings['db_executor'] = DatabaseExecutor(db_factory=lambda : settings['db'])
+        return settings['db_executor']
+
+    @gen.coroutine
+    def prepare(self):
+        """Identify the Authorization token and login cookie before handling the request.
+
+        The token is hashed on the token_hash_executor,
+        and the database is queried on the db_executor,
+        so the IOLoop is not blocked by token and cookie lookups.
+        """
+        self._token_user = yield self.get_current_user_token_async()
+        self._token_user_resolved = True
+        if self._token_user is None:
+            yield self._verify_cookie_async(self.hub.server.cookie_name)
+
     def finish(self, *args, **kwargs):
         """Roll back any uncommitted transactions from the handler."""
         self.db.rollback()
@@ -137,21 +165,60 @@ class BaseHandler(RequestHandler):
     def cookie_max_age_days(self):
         return self.settings.get('cookie_max_age_days', None)
 
-    def get_current_user_token(self):
-        """get_current_user from Authorization header token"""
+    def get_auth_token(self):
+        """Get the token from the Authorization header, if any"""
         auth_header = self.request.headers.get('Authorization', '')
         match = auth_header_pat.match(auth_header)
         if not match:
             return None
-        token = match.group(1)
+        return match.group(1)
+
+    _token_user_resolved = False
+
+    def get_current_user_token(self):
+        """get_current_user from Authorization header token
+
+        Uses the token already identified in prepare, if available.
+        """
+        if self._token_user_resolved:
+            return self._token_user
+        token = self.get_auth_token()
+        if token is None:
+            return None
         orm_token = orm.APIToken.find(self.db, token)
         if orm_token is None:
             return None
         else:
             return orm_token.user or orm_token.service
 
+    @gen.coroutine
+    def get_current_user_token_async(self):
+        """get_current_user from Authorization header token, hashing on the token_hash_executor"""
+        token = self.get_auth_token()
+        if token is None:
+            return None
+        orm_token = yield orm.APIToken.find_async(self.db, token,
+            executor=self.token_hash_executor,
+            db_executor=self.db_executor,
+        )
+        if orm_token is None:
+            return None
+        else:
+            return orm_token.user or orm_token.service
+
     def _user_for_cookie(self, cookie_name, cookie_value=None):
-        """Get the User for a given cookie, if there is one"""
+        """Get the User for a given cookie, if there is one
+
+        Cookies verified recently are found in orm.User.cookie_cache,
+        without checking the signature or querying the database.
+        """
+        if cookie_value is None:
+            cookie_value = self.get_cookie(cookie_name)
+        if cookie_value is not None:
+            cache_key = (cookie_name, utf8(cookie_value))
+            user = self._user_for_cached_cookie(cache_key)
+            if user is not None:
+                return user
         cookie_id = self.get_secure_cookie(
             cookie_name,
             cookie_value,
@@ -172,8 +239,96 @@ class BaseHandler(RequestHandler):
             self.log.warning("Invalid cookie token")
             # have cookie, but it's not valid. Clear it and start over.
             clear()
+        else:
+            self._remember_cookie(cache_key, user)
         return user
 
+    _cookie_user_resolved = False
+
+    @gen.coroutine
+    def _verify_cookie_async(self, cookie_name):
+        """Look up a login cookie on the db_executor, and remember it if it is valid.
+
+        Once the cookie has been decided, valid or not,
+        get_current_user_cookie uses the result without verifying it again.
+        If a cookie_id changes during the lookup,
+        the cookie is left for the synchronous _user_for_cookie.
+        """
+        def resolve(user):
+            self._cookie_user = user
+            self._cookie_user_resolved = True
+
+        def clear(message):
+            self.log.warning(message)
+            self.clear_cookie(cookie_name, path=self.hub.server.base_url)
+            resolve(None)
+
+        cookie_value = self.get_cookie(cookie_name)
+        if cookie_value is None:
+            resolve(None)
+            return
+        cache_key = (cookie_name, utf8(cookie_value))
+        user = self._user_for_cached_cookie(cache_key)
+        if user is not None:
+            resolve(user)
+            return
+        cookie_id = self.get_secure_cookie(
+            cookie_name,
+            cookie_value,
+            max_age_days=self.cookie_max_age_days,
+        )
+        if cookie_id is None:
+            clear("Invalid or expired cookie token")
+            return
+        cookie_id = cookie_id.decode('utf8', 'replace')
+        def find_user_id(db):
+            return db.query(orm.User.id).filter(orm.User.cookie_id==cookie_id).scalar()
+        generation = orm.User.cookie_cache_generation
+        user_id = yield self.db_executor.run(find_user_id)
+        if orm.User.cookie_cache_generation != generation:
+            # a cookie_id changed while we were looking
+            return
+        if user_id is None:
+            clear("Invalid cookie token")
+            return
+        try:
+            user = self.users[user_id]
+        except KeyError:
+            return
+        self._remember_cookie(cache_key, user)
+        resolve(user)
+
+    def _user_for_cached_cookie(self, cache_key):
+        """Get the User for a cookie that was verified recently, if any"""
+        cached = orm.User.cookie_cache.get(cache_key)
+        if cached is None:
+            return
+        user_id, expires = cached
+        if expires <= time.time():
+            orm.User.cookie_cache.pop(cache_key)
+            return
+        if user_id in self.users:
+            return self.users[user_id]
+
+    def _remember_cookie(self, cache_key, user):
+        """Remember a verified cookie until it expires"""
+        cookie_value = cache_key[1]
+        # signed values are `2|key_version|timestamp|name|value|signature`
+        # or `value|timestamp|signature` for version 1
+        fields = cookie_value.split(b'|')
+        try:
+            if fields[0] == b'2':
+                timestamp = int(fields[2].split(b':', 1)[1])
+            else:
+                timestamp = int(fields[1])
+        except (IndexError, ValueError):
+            return
+        max_age_days = self.cookie_max_age_days
+        if max_age_days is None:
+            # tornado's default
+            max_age_days = 31
+        orm.User.cookie_cache.set(cache_key, (user.id, timestamp + max_age_days * 86400))
+
     def _user_from_orm(self, orm_user):
         """return User wrapper from orm.User object"""
         if orm_user is None:
@@ -181,7 +336,12 @@ class BaseHandler(RequestHandler):
         return self.users[orm_user]
 
     def get_current_user_cookie(self):
-        """get_current_user from a cookie token"""
+        """get_current_user from a cookie token
+
+        Uses the cookie already verified in prepare, if available.
+        """
+        if self._cookie_user_resolved:
+            return self._cookie_user
         return self._user_for_cookie(self.hub.server.cookie_name)
 
     def get_current_user(self):
@@ -191,13 +351,32 @@ class BaseHandler(RequestHandler):
             return user
         return self.get_current_user_cookie()
 
+    def get_int_argument(self, name, default=None, minimum=None):
+        """Get an integer query argument
+
+        Returns `default` if the argument is not given.
+        Raises 400 if it is not an integer, or is less than `minimum`.
+        """
+        value = self.get_argument(name, None)
+        if value is None:
+            return default
+        try:
+            value = int(value)
+        except ValueError:
+            raise web.HTTPError(400, "%s must be an integer, not %r" % (name, value))
+        if minimum is not None and value < minimum:
+            raise web.HTTPError(400, "%s must be at least %i" % (name, minimum))
+        return value
+
     def find_user(self, name):
         """Get a user by name
 
         return None if no such user
         """
-        orm_user = orm.User.find(db=self.db, name=name)
-        return self._user_from_orm(orm_user)
+        try:
+            return self.users[name]
+        except KeyError:
+            return None
 
     def user_from_username(self, username):
         """Get User for username, creating if it doesn't exist"""
@@ -221,10 +400,18 @@ class BaseHandler(RequestHandler):
             kwargs['domain'] = self.domain
         if user and user.server:
             self.clear_cookie(user.server.cookie_name, path=user.server.base_url, **kwargs)
+            self.clear_cookie(user.server.cookie_name + '-identity', path=user.server.base_url, **kwargs)
         self.clear_cookie(self.hub.server.cookie_name, path=self.hub.server.base_url, **kwargs)
         self.clear_cookie('jupyterhub-services', path=url_path_join(self.base_url, 'services'))
+        for service in self.services.values():
+            self.clear_cookie(service_identity_name(service.name) + '-identity', path=service.prefix)
+
+    def _set_user_cookie(self, user, server, identity=False):
+        """Set the login cookie for a server
 
-    def _set_user_cookie(self, user, server):
+        If `identity`, also set a signed identity cookie alongside it.
+        Returns the signed value of the login cookie.
+        """
         # tornado <4.2 have a bug that consider secure==True as soon as
         # 'secure' kwarg is passed to set_secure_cookie
         if  self.request.protocol == 'https':
@@ -234,23 +421,69 @@ class BaseHandler(RequestHandler):
         if self.subdomain_host:
             kwargs['domain'] = self.domain
         self.log.debug("Setting cookie for %s: %s, %s", user.name, server.cookie_name, kwargs)
-        self.set_secure_cookie(
+        # same as set_secure_cookie, but we need the signed value for the identity
+        cookie = self.create_signed_value(server.cookie_name, user.cookie_id)
+        self.set_cookie(
             server.cookie_name,
-            user.cookie_id,
+            cookie,
+            expires_days=30,
             path=server.base_url,
             **kwargs
         )
+        if identity:
+            self._set_identity_cookie(user, server.cookie_name, cookie, server.base_url, kwargs)
+        return cookie
+
+    def _set_identity_cookie(self, user, key_name, cookie, path, kwargs):
+        """Set the signed identity cookie `{key_name}-identity` for a login cookie"""
+        identity = self.sign_identity(user, key_name, cookie)
+        if identity:
+            self.set_cookie(key_name + '-identity', identity, path=path, **kwargs)
+
+    def sign_identity(self, user, key_name, cookie):
+        """Sign the identity of a user logged in with a cookie
+
+        key_name picks the signing key:
+        the cookie name for a single-user server,
+        or `service_identity_name(name)` for a service.
+
+        Returns None if identity cookies are disabled.
+        """
+        identity_key = self.settings.get('identity_key')
+        key = identity_key(key_name) if identity_key else None
+        if not key:
+            return None
+        if isinstance(cookie, bytes):
+            cookie = cookie.decode('utf8', 'replace')
+        model = {
+            'name': user.name,
+            'admin': user.admin,
+            'groups': [ g.name for g in user.groups ],
+        }
+        return sign_identity(model, key, cookie, self.settings['identity_max_age'])
 
     def set_service_cookie(self, user):
-        """set the login cookie for services"""
-        self._set_user_cookie(user, orm.Server(
+        """set the login cookie for services
+
+        All services share the login cookie,
+        but each gets its own identity cookie, signed with its own key,
+        so one service can't sign identities that another will accept.
+        """
+        cookie = self._set_user_cookie(user, orm.Server(
             cookie_name='jupyterhub-services',
             base_url=url_path_join(self.base_url, 'services')
         ))
+        kwargs = {'secure': True} if self.request.protocol == 'https' else {}
+        if self.subdomain_host:
+            kwargs['domain'] = self.domain
+        for service in self.services.values():
+            if service.identity_key and service.server:
+                self._set_identity_cookie(user, service_identity_name(service.name),
+                    cookie, service.prefix, kwargs)
 
     def set_server_cookie(self, user):
         """set the login cookie for the single-user server"""
-        self._set_user_cookie(user, user.server)
+        self._set_user_cookie(user, user.server, identity=True)
 
     def set_hub_cookie(self, user):
         """set the login cookie for the Hub"""
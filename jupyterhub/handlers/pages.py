@@ -4,6 +4,7 @@
 # Distributed under the terms of the Modified BSD License.
 
 from http.client import responses
+from urllib.parse import urlencode
 
 from jinja2 import TemplateNotFound
 from tornado import web, gen
@@ -129,7 +130,13 @@ class SpawnHandler(BaseHandler):
         self.redirect(url)
 
 class AdminHandler(BaseHandler):
-    """Render the admin page."""
+    """Render the admin page.
+
+    Users are shown a page at a time, selected with `offset` and `limit` arguments.
+    """
+
+    # number of users per page, if no limit is given
+    page_size = 100
 
     @admin_only
     def get(self):
@@ -146,6 +153,8 @@ class AdminHandler(BaseHandler):
         }
         sorts = self.get_arguments('sort') or default_sort
         orders = self.get_arguments('order')
+        offset = self.get_int_argument('offset', 0, minimum=0)
+        limit = self.get_int_argument('limit', self.page_size, minimum=1)
 
         for bad in set(sorts).difference(available):
             self.log.warning("ignoring invalid sort: %r", bad)
@@ -169,16 +178,28 @@ class AdminHandler(BaseHandler):
         cols = [ getattr(orm.User, mapping.get(c, c)) for c in sorts ]
         # get User.col.desc() order objects
         ordered = [ getattr(c, o)() for c, o in zip(cols, orders) ]
+        # break ties by id, so pages don't overlap
+        ordered.append(orm.User.id)
 
-        users = self.db.query(orm.User).order_by(*ordered)
+        total = self.db.query(orm.User).count()
+        running = self.db.query(orm.User).filter(orm.User._server_id != None).count()
+        users = orm.User.query_with_models(self.db).order_by(*ordered).offset(offset).limit(limit)
         users = [ self._user_from_orm(u) for u in users ]
-        running = [ u for u in users if u.running ]
+
+        def page_url(page_offset):
+            args = [ ('sort', s) for s in sorts ] + [ ('order', o) for o in orders ]
+            args.extend([('offset', page_offset), ('limit', limit)])
+            return '?' + urlencode(args)
 
         html = self.render_template('admin.html',
             user=self.get_current_user(),
             admin_access=self.settings.get('admin_access', False),
             users=users,
+            total=total,
             running=running,
+            offset=offset,
+            prev_url=page_url(max(offset - limit, 0)) if offset else None,
+            next_url=page_url(offset + limit) if offset + limit < total else None,
             sort={s:o for s,o in zip(sorts, orders)},
         )
         self.finish(html)
@@ -3,28 +3,37 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
-from datetime import datetime
+from datetime import datetime, timedelta
+from functools import partial
+import hashlib
 import json
+import time
+from urllib.parse import quote, unquote
+import warnings
+from weakref import WeakKeyDictionary
 
 from tornado import gen
+from tornado.ioloop import IOLoop
 from tornado.log import app_log
-from tornado.httpclient import HTTPRequest, AsyncHTTPClient
+from tornado.httpclient import HTTPRequest, AsyncHTTPClient, HTTPError
 
 from sqlalchemy.types import TypeDecorator, TEXT
 from sqlalchemy import (
-    inspect,
+    inspect, event,
     Column, Integer, ForeignKey, Unicode, Boolean,
     DateTime,
 )
 from sqlalchemy.ext.declarative import declarative_base, declared_attr
-from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.orm import sessionmaker, relationship, joinedload, subqueryload
 from sqlalchemy.pool import StaticPool
-from sqlalchemy.sql.expression import bindparam
 from sqlalchemy import create_engine, Table
 
+from .emptyclass import EmptyClass
+from .proxy import ConfigurableHTTPProxy
 from .utils import (
     random_port, url_path_join, wait_for_server, wait_for_http_server,
-    new_token, hash_token, compare_token, can_connect,
+    new_token, hash_token, hmac_token, token_hash_scheme, compare_token, can_connect,
+    LRUCache, chunks, run_bounded,
 )
 
 
@@ -119,10 +128,22 @@ class Proxy(Base):
 
     A proxy consists of the API server info and the public-facing server info,
     plus an auth token for configuring the proxy table.
+
+    Starting the proxy and changing its routes is delegated to `backend`,
+    a `jupyterhub.proxy.ProxyBackend`.
     """
     __tablename__ = 'proxies'
     id = Column(Integer, primary_key=True)
+    # not persisted, set by the Hub
     auth_token = None
+    _backend = None
+    statsd = EmptyClass()
+    # callable returning the AsyncHTTPClient for API requests,
+    # called once for each IOLoop
+    http_client_factory = None
+    api_timeout = 20
+    api_retries = 2
+    api_retry_delay = 0.1
     _public_server_id = Column(Integer, ForeignKey('servers.id'))
     public_server = relationship(Server, primaryjoin=_public_server_id == Server.id)
     _api_server_id = Column(Integer, ForeignKey('servers.id'))
@@ -136,25 +157,95 @@ class Proxy(Base):
         else:
             return "<%s [unconfigured]>" % self.__class__.__name__
 
+    @property
+    def backend(self):
+        """The ProxyBackend that manages routes, configurable-http-proxy by default"""
+        if self._backend is None:
+            self._backend = ConfigurableHTTPProxy(proxy=self, log=self.log)
+        return self._backend
+
+    @backend.setter
+    def backend(self, backend):
+        self._backend = backend
+
+    @property
+    def http_client(self):
+        """The HTTP client for API requests on the current IOLoop"""
+        if self.http_client_factory is None:
+            return AsyncHTTPClient()
+        if not hasattr(self, '_http_clients'):
+            self._http_clients = WeakKeyDictionary()
+        loop = IOLoop.current()
+        if loop not in self._http_clients:
+            self._http_clients[loop] = self.http_client_factory()
+        return self._http_clients[loop]
+
+    @gen.coroutine
     def api_request(self, path, method='GET', body=None, client=None):
-        """Make an authenticated API request of the proxy"""
-        client = client or AsyncHTTPClient()
+        """Make an authenticated API request of the proxy
+
+        Connection errors and 5xx responses are retried up to `api_retries` times,
+        waiting `api_retry_delay` seconds, doubling after each attempt.
+        The latency of each attempt is reported to statsd as `proxy.api.<method>`.
+        """
+        client = client or self.http_client
         url = url_path_join(self.api_server.url, path)
 
         if isinstance(body, dict):
             body = json.dumps(body)
-        self.log.debug("Fetching %s %s", method, url)
-        req = HTTPRequest(url,
-            method=method,
-            headers={'Authorization': 'token {}'.format(self.auth_token)},
-            body=body,
-        )
+        for attempt in range(self.api_retries + 1):
+            self.log.debug("Fetching %s %s", method, url)
+            req = HTTPRequest(url,
+                method=method,
+                headers={'Authorization': 'token {}'.format(self.auth_token)},
+                body=body,
+                connect_timeout=self.api_timeout,
+                request_timeout=self.api_timeout,
+            )
+            tic = time.perf_counter()
+            try:
+                resp = yield client.fetch(req)
+            except (HTTPError, OSError) as e:
+                retry = not isinstance(e, HTTPError) or e.code == 599 or e.code >= 500
+                if not retry or attempt == self.api_retries:
+                    raise
+                delay = self.api_retry_delay * 2 ** attempt
+                self.log.warning("Proxy API request %s %s failed (%s), retrying in %.1fs",
+                    method, url, e, delay)
+                yield gen.sleep(delay)
+            else:
+                return resp
+            finally:
+                self.statsd.timing('proxy.api.%s' % method.lower(),
+                    1e3 * (time.perf_counter() - tic))
+
+    @gen.coroutine
+    def add_route(self, routespec, target, data):
+        """Add a route for routespec to target, with extra data (the user or service)"""
+        yield self.backend.add_route(routespec, target, data)
 
-        return client.fetch(req)
+    @gen.coroutine
+    def delete_route(self, routespec):
+        """Remove the route for routespec"""
+        yield self.backend.delete_route(routespec)
+
+    @staticmethod
+    def _warn_client(method, client):
+        """Warn about the `client` argument, which proxy methods no longer use"""
+        if client is not None:
+            warnings.warn(
+                "Proxy.%s(client=...) is deprecated and ignored in JupyterHub 0.8:"
+                " requests are made by the proxy backend." % method,
+                DeprecationWarning, stacklevel=4,
+            )
 
     @gen.coroutine
     def add_service(self, service, client=None):
-        """Add a service's server to the proxy table."""
+        """Add a service's server to the proxy table.
+
+        `client` is deprecated and ignored.
+        """
+        self._warn_client('add_service', client)
         if not service.server:
             raise RuntimeError(
                 "Service %s does not have an http endpoint to add to the proxy.", service.name)
@@ -163,27 +254,25 @@ class Proxy(Base):
             service.name, service.proxy_path, service.server.host,
         )
 
-        yield self.api_request(service.proxy_path,
-            method='POST',
-            body=dict(
-                target=service.server.host,
-                service=service.name,
-            ),
-            client=client,
-        )
+        yield self.add_route(service.proxy_path, service.server.host, {'service': service.name})
 
     @gen.coroutine
     def delete_service(self, service, client=None):
-        """Remove a service's server from the proxy table."""
+        """Remove a service's server from the proxy table.
+
+        `client` is deprecated and ignored.
+        """
+        self._warn_client('delete_service', client)
         self.log.info("Removing service %s from proxy", service.name)
-        yield self.api_request(service.proxy_path,
-            method='DELETE',
-            client=client,
-        )
+        yield self.delete_route(service.proxy_path)
 
     @gen.coroutine
     def add_user(self, user, client=None):
-        """Add a user's server to the proxy table."""
+        """Add a user's server to the proxy table.
+
+        `client` is deprecated and ignored.
+        """
+        self._warn_client('add_user', client)
         self.log.info("Adding user %s to proxy %s => %s",
             user.name, user.proxy_path, user.server.host,
         )
@@ -192,98 +281,194 @@ class Proxy(Base):
             raise RuntimeError(
                 "User %s's spawn is pending, shouldn't be added to the proxy yet!", user.name)
 
-        yield self.api_request(user.proxy_path,
-            method='POST',
-            body=dict(
-                target=user.server.host,
-                user=user.name,
-            ),
-            client=client,
-        )
+        yield self.add_route(user.proxy_path, user.server.host, {'user': user.name})
 
     @gen.coroutine
     def delete_user(self, user, client=None):
-        """Remove a user's server from the proxy table."""
+        """Remove a user's server from the proxy table.
+
+        `client` is deprecated and ignored.
+        """
+        self._warn_client('delete_user', client)
         self.log.info("Removing user %s from proxy", user.name)
-        yield self.api_request(user.proxy_path,
-            method='DELETE',
-            client=client,
+        yield self.delete_route(user.proxy_path)
+
+    @gen.coroutine
+    def _replay_routes(self, kind, items, add, concurrency=10, priority=0):
+        """Add routes for `items` with at most `concurrency` requests at once
+
+        Progress is logged about every 10%,
+        and when the first `priority` items have their routes.
+        """
+        total = len(items)
+        if not total:
+            return
+        self.log.info("Restoring %i %s routes", total, kind)
+        tic = time.perf_counter()
+        done = 0
+        # jobs finish out of order, so count the priority items on their own
+        priority_done = 0
+        step = max(total // 10, 1)
+
+        def add_job(index, item):
+            @gen.coroutine
+            def job():
+                nonlocal done, priority_done
+                try:
+                    yield add(item)
+                finally:
+                    done += 1
+                    if index < priority:
+                        priority_done += 1
+                        if priority_done == priority and priority < total:
+                            self.log.info("Restored routes for %i recently active %ss", priority, kind)
+                    if done % step == 0 or done == total:
+                        self.log.info("Restored %i/%i %s routes", done, total, kind)
+            return job
+
+        failed = yield run_bounded(
+            (add_job(index, item) for index, item in enumerate(items)),
+            concurrency,
         )
+        for job, e in failed:
+            self.log.error("Failed to restore %s route: %s", kind, e)
+        self.statsd.timing('proxy.replay.%s' % kind, 1e3 * (time.perf_counter() - tic))
 
     @gen.coroutine
-    def add_all_services(self, service_dict):
+    def add_all_services(self, service_dict, concurrency=10):
         """Update the proxy table from the database.
 
         Used when loading up a new proxy.
+        At most `concurrency` proxy API requests are made at once.
         """
         db = inspect(self).session
-        futures = []
+        services = []
         for orm_service in db.query(Service):
             service = service_dict[orm_service.name]
             if service.server:
-                futures.append(self.add_service(service))
-        # wait after submitting them all
-        for f in futures:
-            yield f
+                services.append(service)
+        yield self._replay_routes('service', services, self.add_service, concurrency)
 
     @gen.coroutine
-    def add_all_users(self, user_dict):
+    def add_all_users(self, user_dict, concurrency=10, active_since=None):
         """Update the proxy table from the database.
 
         Used when loading up a new proxy.
+        At most `concurrency` proxy API requests are made at once,
+        and the most recently active users get their routes first.
+        If `active_since` is given, progress is logged
+        once every user active since then has a route.
         """
         db = inspect(self).session
-        futures = []
-        for orm_user in db.query(User):
+        users = []
+        running_users = db.query(User).options(joinedload(User.server)).filter(User._server_id != None)
+        for orm_user in running_users:
             user = user_dict[orm_user]
             if user.running:
-                futures.append(self.add_user(user))
-        # wait after submitting them all
-        for f in futures:
-            yield f
+                users.append(user)
+        users.sort(key=lambda user: user.last_activity or datetime.min, reverse=True)
+        priority = 0
+        if active_since is not None:
+            priority = sum(1 for user in users if user.last_activity and user.last_activity >= active_since)
+        yield self._replay_routes('user', users, self.add_user, concurrency, priority)
 
     @gen.coroutine
     def get_routes(self, client=None):
-        """Fetch the proxy's routes"""
-        resp = yield self.api_request('', client=client)
-        return json.loads(resp.body.decode('utf8', 'replace'))
-
-    @gen.coroutine
-    def check_routes(self, user_dict, service_dict, routes=None):
-        """Check that all users are properly routed on the proxy"""
-        if not routes:
-            routes = yield self.get_routes()
+        """Fetch the proxy's routes
 
-        user_routes = { r['user'] for r in routes.values() if 'user' in r }
-        futures = []
+        `client` is deprecated and ignored.
+        """
+        self._warn_client('get_routes', client)
+        routes = yield self.backend.get_all_routes()
+        return routes
+
+    @staticmethod
+    def _route_key(prefix):
+        """Normalize a route prefix for comparison with the proxy's route table"""
+        prefix = unquote(prefix)
+        if prefix != '/':
+            prefix = prefix.rstrip('/')
+        return prefix
+
+    def desired_routes(self, user_dict, service_dict):
+        """Compute the routes the proxy should have for users and services
+
+        Returns a dict of {prefix: (route, owner)},
+        where route is the data the proxy should have for prefix (target and user or service),
+        and owner is the User or Service the route is for.
+        """
         db = inspect(self).session
-        for orm_user in db.query(User):
+        desired = {}
+        running_users = db.query(User).options(joinedload(User.server)).filter(User._server_id != None)
+        for orm_user in running_users:
             user = user_dict[orm_user]
             if user.running:
-                if user.name not in user_routes:
-                    self.log.warning("Adding missing route for %s (%s)", user.name, user.server)
-                    futures.append(self.add_user(user))
-            else:
-                # User not running, make sure it's not in the table
-                if user.name in user_routes:
-                    self.log.warning("Removing route for not running %s", user.name)
-                    futures.append(self.delete_user(user))
-        
-        # check service routes
-        service_routes = { r['service'] for r in routes.values() if 'service' in r }
-        for orm_service in db.query(Service).filter(Service.server != None):
+                desired[self._route_key(user.proxy_path)] = (
+                    {'target': user.server.host, 'user': user.name}, user,
+                )
+        services = db.query(Service).options(joinedload(Service.server)).filter(Service._server_id != None)
+        for orm_service in services:
             service = service_dict[orm_service.name]
             if service.server is None:
                 # This should never be True, but seems to be on rare occasion.
                 # catch filter bug, either in sqlalchemy or my understanding of its behavior
                 self.log.error("Service %s has no server, but wasn't filtered out.", service)
                 continue
-            if service.name not in service_routes:
-                self.log.warning("Adding missing route for %s (%s)", service.name, service.server)
-                futures.append(self.add_service(service))
-        for f in futures:
-            yield f
+            desired[self._route_key(service.proxy_path)] = (
+                {'target': service.server.host, 'service': service.name}, service,
+            )
+        return desired
 
+    @gen.coroutine
+    def check_routes(self, user_dict, service_dict, routes=None, concurrency=10):
+        """Reconcile the proxy's route table with the running users and services
+
+        Routes are compared by prefix and target,
+        so routes left pointing at an old server (e.g. after a respawn) are updated.
+        User and service routes that shouldn't exist are removed.
+        At most `concurrency` proxy API requests are made at once.
+
+        Returns a dict with the number of routes added, removed, and retargeted.
+        """
+        if not routes:
+            routes = yield self.get_routes()
+        current = { self._route_key(prefix): route for prefix, route in routes.items() }
+        desired = self.desired_routes(user_dict, service_dict)
+        counts = {'added': 0, 'removed': 0, 'retargeted': 0}
+        jobs = []
+
+        for prefix, (route, owner) in desired.items():
+            existing = current.get(prefix)
+            if existing is None:
+                self.log.warning("Adding missing route for %s (%s)", owner.name, route['target'])
+                counts['added'] += 1
+            elif any(existing.get(key) != value for key, value in route.items()):
+                self.log.warning("Updating route for %s (%s -> %s)",
+                    owner.name, existing.get('target'), route['target'])
+                counts['retargeted'] += 1
+            else:
+                continue
+            if 'user' in route:
+                jobs.append(partial(self.add_user, owner))
+            else:
+                jobs.append(partial(self.add_service, owner))
+
+        for prefix, existing in current.items():
+            if prefix in desired:
+                continue
+            if 'user' in existing or 'service' in existing:
+                # route for a user or service that is not running
+                self.log.warning("Removing route for not running %s",
+                    existing.get('user') or existing.get('service'))
+                counts['removed'] += 1
+                jobs.append(partial(self.delete_route, quote(prefix, safe='/@')))
+
+        failed = yield run_bounded(jobs, concurrency)
+        for job, e in failed:
+            self.log.error("Failed to update proxy route: %s", e)
+        if jobs:
+            self.log.info("Proxy routes: %(added)i added, %(removed)i removed, %(retargeted)i retargeted", counts)
+        return counts
 
 
 class Hub(Base):
@@ -363,10 +548,10 @@ class User(Base):
     _server_id = Column(Integer, ForeignKey('servers.id', ondelete="SET NULL"))
     server = relationship(Server, primaryjoin=_server_id == Server.id)
     admin = Column(Boolean, default=False)
-    last_activity = Column(DateTime, default=datetime.utcnow)
+    last_activity = Column(DateTime, default=datetime.utcnow, index=True)
 
     api_tokens = relationship("APIToken", backref="user")
-    cookie_id = Column(Unicode(1023), default=new_token)
+    cookie_id = Column(Unicode(1023), default=new_token, index=True)
     # User.state is actually Spawner state
     # We will need to figure something else out if/when we have multiple spawners per user
     state = Column(JSONDict)
@@ -377,6 +562,21 @@ class User(Base):
 
     other_user_cookies = set([])
 
+    # verified login cookies: (cookie name, cookie value) -> (user id, expiry)
+    # lets the Hub skip checking the signature and looking up cookie_id
+    # for cookies seen recently.
+    # Entries are dropped when the user's cookie_id changes or the user is deleted.
+    cookie_cache = LRUCache(max_size=10000)
+    # incremented on every invalidation,
+    # so lookups that started before one can tell not to cache their result
+    cookie_cache_generation = 0
+
+    @classmethod
+    def invalidate_cookie_cache(cls, user_id):
+        """Drop cached login cookies for a user"""
+        cls.cookie_cache_generation += 1
+        cls.cookie_cache.discard_where(lambda entry: entry[0] == user_id)
+
     def __repr__(self):
         if self.server:
             return "<{cls}({name}@{ip}:{port})>".format(
@@ -391,12 +591,13 @@ class User(Base):
                 name=self.name,
             )
 
-    def new_api_token(self, token=None):
+    def new_api_token(self, token=None, expires_in=None):
         """Create a new API token
         
         If `token` is given, load that token.
+        If `expires_in` is given, the token expires after that many seconds.
         """
-        return APIToken.new(token=token, user=self)
+        return APIToken.new(token=token, user=self, expires_in=expires_in)
 
     @classmethod
     def find(cls, db, name):
@@ -406,6 +607,18 @@ class User(Base):
         """
         return db.query(cls).filter(cls.name==name).first()
 
+    @classmethod
+    def query_with_models(cls, db):
+        """Query users, eagerly loading the relationships used in user models.
+
+        Listing users this way issues a fixed number of queries,
+        rather than loading each user's server and groups one at a time.
+        """
+        return db.query(cls).options(
+            joinedload(cls.server),
+            subqueryload(cls.groups),
+        )
+
 
 class Service(Base):
     """A service run with JupyterHub
@@ -439,12 +652,13 @@ class Service(Base):
     server = relationship(Server, primaryjoin=_server_id == Server.id)
     pid = Column(Integer)
 
-    def new_api_token(self, token=None):
+    def new_api_token(self, token=None, expires_in=None):
         """Create a new API token
 
         If `token` is given, load that token.
+        If `expires_in` is given, the token expires after that many seconds.
         """
-        return APIToken.new(token=token, service=self)
+        return APIToken.new(token=token, service=self, expires_in=expires_in)
     
     @classmethod
     def find(cls, db, name):
@@ -468,13 +682,38 @@ class APIToken(Base):
     def service_id(cls):
         return Column(Integer, ForeignKey('services.id', ondelete="CASCADE"), nullable=True)
 
+    # the server a token was issued to by spawn.
+    # Once that is no longer the user's server, the token is deleted by the Hub's token reaper.
+    @declared_attr
+    def server_id(cls):
+        return Column(Integer, ForeignKey('servers.id', ondelete="CASCADE"), nullable=True)
+
     id = Column(Integer, primary_key=True)
     hashed = Column(Unicode(1023))
-    prefix = Column(Unicode(1023))
+    prefix = Column(Unicode(1023), index=True)
+    # exact-match lookup key, kept in sync with hashed
+    fingerprint = Column(Unicode(64), index=True)
+    # expired tokens are never found, and are deleted by the Hub's token reaper.
+    # None means the token doesn't expire.
+    expires_at = Column(DateTime, default=None, nullable=True, index=True)
     prefix_length = 4
     algorithm = "sha512"
     rounds = 16384
     salt_bytes = 8
+    # Server-side key for hashing tokens with a single HMAC-SHA256 pass.
+    # If set, new tokens use the `hmac-sha256` scheme,
+    # and tokens stored with the slow `algorithm:rounds:salt:hash` scheme
+    # are rehashed the first time they are found.
+    # Set by the Hub at startup.
+    hash_key = None
+    # CommitScheduler for writing rehashed tokens without committing mid-request.
+    # Set by the Hub at startup.
+    commit_scheduler = None
+
+    # recently verified tokens: sha256(token) -> (id, hashed, user_id, service_id)
+    # lets find skip the slow hash comparison for tokens seen recently.
+    # The row is always re-fetched by id, so a deleted token is never returned.
+    cache = LRUCache(max_size=10000, max_age=300)
 
     @property
     def token(self):
@@ -484,7 +723,19 @@ class APIToken(Base):
     def token(self, token):
         """Store the hashed value and prefix for a token"""
         self.prefix = token[:self.prefix_length]
-        self.hashed = hash_token(token, rounds=self.rounds, salt=self.salt_bytes, algorithm=self.algorithm)
+        self.hashed = self.hash(token)
+
+    @property
+    def expired(self):
+        """Has this token expired?"""
+        return self.expires_at is not None and self.expires_at <= datetime.utcnow()
+
+    @classmethod
+    def hash(cls, token):
+        """Hash a token for storage, using the preferred scheme"""
+        if cls.hash_key:
+            return hmac_token(token, cls.hash_key)
+        return hash_token(token, rounds=cls.rounds, salt=cls.salt_bytes, algorithm=cls.algorithm)
 
     def __repr__(self):
         if self.user is not None:
@@ -513,52 +764,447 @@ class APIToken(Base):
         `kind='user'` only returns API tokens for users
         `kind='service'` only returns API tokens for services
         """
+        found, orm_token = cls._find_cached(db, token, kind)
+        if found:
+            return orm_token
+        for orm_token in cls._find_candidates(db, token, kind):
+            if orm_token.match(token):
+                cls._upgrade_hash(db, token, orm_token)
+                cls._remember(token, orm_token)
+                return orm_token
+
+    @classmethod
+    @gen.coroutine
+    def find_async(cls, db, token, *, kind=None, executor=None, db_executor=None):
+        """Find a token object by value, hashing on an executor.
+
+        Like :meth:`find`, but the hash comparisons run on `executor`
+        (a :class:`concurrent.futures.Executor`),
+        so that the calling IOLoop is not blocked while tokens are hashed.
+        If `db_executor` (a :class:`~jupyterhub.dbutil.DatabaseExecutor`) is given,
+        the query for candidate tokens runs on it.
+
+        If no executor is given, this is the same as :meth:`find`.
+        """
+        if executor is None:
+            return cls.find(db, token, kind=kind)
+        found, orm_token = cls._find_cached(db, token, kind)
+        if found:
+            return orm_token
+        def find_candidates(db):
+            return [ (t.id, t.hashed) for t in cls._find_candidates(db, token, kind) ]
+        if db_executor is None:
+            candidates = find_candidates(db)
+        else:
+            candidates = yield db_executor.run(find_candidates)
+        matches = []
+        for _, hashed in candidates:
+            if token_hash_scheme(hashed) is None:
+                # slow scheme, hash on the executor
+                matches.append(executor.submit(compare_token, hashed, token))
+            else:
+                matches.append(gen.maybe_future(compare_token(hashed, token, key=cls.hash_key)))
+        matches = yield matches
+        for (token_id, hashed), matched in zip(candidates, matches):
+            if not matched:
+                continue
+            # re-fetch, since the session may have been used while we were waiting
+            orm_token = db.query(cls).get(token_id)
+            if orm_token is not None and orm_token.hashed == hashed:
+                cls._upgrade_hash(db, token, orm_token)
+                cls._remember(token, orm_token)
+                return orm_token
+
+    @classmethod
+    def _find_cached(cls, db, token, kind, include_expired=False):
+        """Look up a token in the verified-token cache
+
+        Returns (found, orm_token), where found is False if the cache can't answer.
+        """
+        if kind not in {'user', 'service', None}:
+            raise ValueError("kind must be 'user', 'service', or None, not %r" % kind)
+        cache_key = cls._cache_key(token)
+        cached = cls.cache.get(cache_key)
+        if cached is None:
+            return False, None
+        token_id, hashed = cached[:2]
+        orm_token = db.query(cls).get(token_id)
+        if orm_token is None or orm_token.hashed != hashed:
+            # token was deleted or replaced since it was cached
+            cls.cache.pop(cache_key)
+            return False, None
+        if orm_token.expired and not include_expired:
+            return True, None
+        if orm_token._is_kind(kind):
+            return True, orm_token
+        return True, None
+
+    @classmethod
+    def _find_candidates(cls, db, token, kind):
+        """Get the tokens that could match a token value
+
+        Tokens hashed with a keyed scheme are found by their fingerprint,
+        a single indexed lookup.
+        Tokens still stored with a salted scheme have no fingerprint,
+        and are found by prefix.
+        """
+        def of_kind(query):
+            query = cls._unexpired(query)
+            if kind == 'user':
+                return query.filter(cls.user_id != None)
+            elif kind == 'service':
+                return query.filter(cls.service_id != None)
+            return query
+
+        if cls.hash_key:
+            fingerprint = cls._fingerprint(cls.hash(token))
+            orm_token = of_kind(db.query(cls).filter(cls.fingerprint == fingerprint)).first()
+            if orm_token is not None:
+                return [orm_token]
         prefix = token[:cls.prefix_length]
-        # since we can't filter on hashed values, filter on prefix
+        # since we can't filter on salted hashes, filter on prefix
         # so we aren't comparing with all tokens
-        prefix_match = db.query(cls).filter(bindparam('prefix', prefix).startswith(cls.prefix))
+        return of_kind(db.query(cls).filter(
+            cls.fingerprint == None,
+            cls.prefix == prefix,
+        ))
+
+    @classmethod
+    @gen.coroutine
+    def find_many_async(cls, db, tokens, executor=None, include_expired=False):
+        """Find the tokens for many token values at once
+
+        Returns a dict of token value: APIToken for the tokens that exist.
+        Expired tokens are only included if `include_expired` is True.
+
+        Tokens in the verified-token cache are looked up by id.
+        Tokens hashed with a keyed scheme are found by fingerprint, in chunks.
+        Tokens still stored with a salted scheme are found by the prefixes
+        of the remaining token values, in chunks,
+        and compared on `executor` in parallel.
+        """
+        if include_expired:
+            unexpired = lambda query: query
+        else:
+            unexpired = cls._unexpired
+        found = {}
+        pending = set()
+        for token in set(tokens):
+            cached, orm_token = cls._find_cached(db, token, None, include_expired)
+            if not cached:
+                pending.add(token)
+            elif orm_token is not None:
+                found[token] = orm_token
+
+        if cls.hash_key and pending:
+            by_fingerprint = { cls._fingerprint(cls.hash(token)): token for token in pending }
+            for chunk in chunks(list(by_fingerprint)):
+                for orm_token in unexpired(db.query(cls).filter(cls.fingerprint.in_(chunk))):
+                    token = by_fingerprint[orm_token.fingerprint]
+                    found[token] = orm_token
+                    pending.discard(token)
+
+        # prefix map of the salted hashes that could match what's left
+        by_prefix = {}
+        prefixes = { token[:cls.prefix_length] for token in pending }
+        for chunk in chunks(list(prefixes)):
+            for orm_token in unexpired(db.query(cls).filter(
+                cls.fingerprint == None,
+                cls.prefix.in_(chunk),
+            )):
+                by_prefix.setdefault(orm_token.prefix, []).append(orm_token)
+        pairs = []
+        for token in pending:
+            for orm_token in by_prefix.get(token[:cls.prefix_length], []):
+                pairs.append((token, orm_token))
+        if executor is None:
+            matches = [ compare_token(orm_token.hashed, token) for token, orm_token in pairs ]
+        else:
+            matches = yield [
+                executor.submit(compare_token, orm_token.hashed, token)
+                for token, orm_token in pairs
+            ]
+        for (token, orm_token), matched in zip(pairs, matches):
+            if matched:
+                found[token] = orm_token
+        for token, orm_token in found.items():
+            cls._remember(token, orm_token)
+        return found
+
+    @classmethod
+    def _unexpired(cls, query):
+        """Filter a query on tokens to those that have not expired"""
+        return query.filter((cls.expires_at == None) | (cls.expires_at > datetime.utcnow()))
+
+    @staticmethod
+    def _fingerprint(hashed):
+        """The lookup fingerprint of a stored hash
+
+        For keyed schemes, the hash is deterministic and its digest is the fingerprint.
+        Salted hashes have no fingerprint.
+        """
+        if hashed and token_hash_scheme(hashed) is not None:
+            return hashed.split(':', 1)[1]
+
+    @classmethod
+    def _upgrade_hash(cls, db, token, orm_token):
+        """Rehash a matched token stored with the slow scheme, if we have a key
+
+        The new hash is queued on the commit scheduler, if there is one.
+        Otherwise it is left in the session for the caller to commit.
+        """
+        if cls.hash_key and token_hash_scheme(orm_token.hashed) is None:
+            cls.log.debug("Rehashing %s with hmac-sha256", orm_token)
+            hashed = hmac_token(token, cls.hash_key)
+            if cls.commit_scheduler is None:
+                orm_token.hashed = hashed
+            else:
+                cls.commit_scheduler.update_soon(cls, orm_token.id,
+                    hashed=hashed,
+                    fingerprint=cls._fingerprint(hashed),
+                )
+
+    @classmethod
+    def _remember(cls, token, orm_token):
+        """Store a verified token in the cache"""
+        cls.cache.set(cls._cache_key(token), (
+            orm_token.id, orm_token.hashed, orm_token.user_id, orm_token.service_id,
+        ))
+
+    @staticmethod
+    def _cache_key(token):
+        """Key for a token in the verified-token cache"""
+        return hashlib.sha256(token.encode('utf8', 'replace')).hexdigest()
+
+    def _is_kind(self, kind):
+        """Does this token belong to an owner of the given kind?"""
         if kind == 'user':
-            prefix_match = prefix_match.filter(cls.user_id != None)
+            return self.user_id is not None
         elif kind == 'service':
-            prefix_match = prefix_match.filter(cls.service_id != None)
-        elif kind is not None:
-            raise ValueError("kind must be 'user', 'service', or None, not %r" % kind)
-        for orm_token in prefix_match:
-            if orm_token.match(token):
-                return orm_token
+            return self.service_id is not None
+        return True
+
+    @classmethod
+    def invalidate_cache(cls, token_ids=(), user_id=None, service_id=None):
+        """Drop cached lookups for some tokens or for all tokens of an owner"""
+        token_ids = set(token_ids)
+        def match(entry):
+            _id, _hashed, _user_id, _service_id = entry
+            return (
+                _id in token_ids
+                or (user_id is not None and _user_id == user_id)
+                or (service_id is not None and _service_id == service_id)
+            )
+        cls.cache.discard_where(match)
 
     def match(self, token):
         """Is this my token?"""
-        return compare_token(self.hashed, token)
+        return compare_token(self.hashed, token, key=self.hash_key)
 
     @classmethod
-    def new(cls, token=None, user=None, service=None):
-        """Generate a new API token for a user or service"""
-        assert user or service
-        assert not (user and service)
-        db = inspect(user or service).session
+    def new(cls, token=None, user=None, service=None, expires_in=None, server=None):
+        """Generate a new API token for a user or service
+
+        If `expires_in` is given, the token expires after that many seconds.
+        If `server` is given, the token belongs to that server of its user,
+        and is reaped once the user no longer has that server.
+        """
+        db = cls._owner_session(user, service)
         if token is None:
             token = new_token()
         else:
-            if len(token) < 8:
-                raise ValueError("Tokens must be at least 8 characters, got %r" % token)
+            cls._check_new_token(token)
             found = APIToken.find(db, token)
             if found:
                 raise ValueError("Collision on token: %s..." % token[:4])
-        orm_token = APIToken(token=token)
+        orm_token = APIToken(token=token, expires_at=cls._expires_at(expires_in))
+        cls._add_for_owner(db, orm_token, user, service, server)
+        return token
+
+    @classmethod
+    @gen.coroutine
+    def new_async(cls, token=None, user=None, service=None, expires_in=None, server=None,
+            executor=None):
+        """Generate a new API token for a user or service, hashing on an executor.
+
+        Like :meth:`new`, but the token is hashed on `executor`
+        (a :class:`concurrent.futures.Executor`).
+
+        If no executor is given, this is the same as :meth:`new`.
+        """
+        if executor is None:
+            return cls.new(token=token, user=user, service=service, expires_in=expires_in,
+                server=server,
+            )
+        db = cls._owner_session(user, service)
+        if token is None:
+            token = new_token()
+        else:
+            cls._check_new_token(token)
+            found = yield cls.find_async(db, token, executor=executor)
+            if found:
+                raise ValueError("Collision on token: %s..." % token[:4])
+        if cls.hash_key:
+            # fast scheme, no need for the executor
+            hashed = cls.hash(token)
+        else:
+            hashed = yield executor.submit(hash_token, token,
+                rounds=cls.rounds, salt=cls.salt_bytes, algorithm=cls.algorithm,
+            )
+        orm_token = APIToken(prefix=token[:cls.prefix_length], hashed=hashed,
+            expires_at=cls._expires_at(expires_in),
+        )
+        cls._add_for_owner(db, orm_token, user, service, server)
+        return token
+
+    @classmethod
+    @gen.coroutine
+    def new_many_async(cls, db, owners, executor=None):
+        """Add many tokens at once, in a single transaction
+
+        `owners` is a dict of token value: User or Service.
+        Tokens are not checked for collisions;
+        use :meth:`find_many_async` to skip tokens that already exist.
+
+        Tokens are hashed on `executor` in parallel, if the scheme is slow.
+        Nothing is committed if any token is invalid.
+        """
+        tokens = list(owners)
+        for token in tokens:
+            cls._check_new_token(token)
+        if cls.hash_key or executor is None:
+            hashes = [ cls.hash(token) for token in tokens ]
+        else:
+            hashes = yield [
+                executor.submit(hash_token, token,
+                    rounds=cls.rounds, salt=cls.salt_bytes, algorithm=cls.algorithm,
+                )
+                for token in tokens
+            ]
+        # owners may be new, give them ids
+        db.flush()
+        for token, hashed in zip(tokens, hashes):
+            owner = owners[token]
+            orm_token = APIToken(prefix=token[:cls.prefix_length], hashed=hashed)
+            if isinstance(owner, Service):
+                orm_token.service_id = owner.id
+            else:
+                orm_token.user_id = owner.id
+            db.add(orm_token)
+        db.commit()
+
+    @staticmethod
+    def _expires_at(expires_in):
+        """Expiry timestamp for a token that expires in `expires_in` seconds"""
+        if expires_in is not None:
+            return datetime.utcnow() + timedelta(seconds=expires_in)
+
+    @classmethod
+    def reap(cls, db, kind, batch_size=1000):
+        """Delete one batch of expired or ownerless tokens
+
+        `kind='expired'` deletes tokens past their expiry.
+        `kind='ownerless'` deletes tokens whose user or service no longer exists,
+        and tokens issued to a server that is no longer its user's server.
+
+        Tokens are deleted with bulk SQL, not one by one through the session.
+        Returns the number of tokens deleted,
+        which is less than `batch_size` once there are no more to delete.
+        """
+        if kind == 'expired':
+            condition = cls.expires_at <= datetime.utcnow()
+        elif kind == 'ownerless':
+            condition = ((cls.user_id == None) & (cls.service_id == None)) | (
+                (cls.server_id != None)
+                & ~db.query(User).filter(User._server_id == cls.server_id).exists()
+            )
+        else:
+            raise ValueError("kind must be 'expired' or 'ownerless', not %r" % kind)
+        # select ids first, since not every db supports DELETE ... LIMIT
+        token_ids = [ token_id for (token_id,) in
+            db.query(cls.id).filter(condition).limit(batch_size)
+        ]
+        if not token_ids:
+            return 0
+        db.query(cls).filter(cls.id.in_(token_ids)).delete(synchronize_session=False)
+        db.commit()
+        # bulk deletes don't fire after_delete
+        cls.invalidate_cache(token_ids=token_ids)
+        return len(token_ids)
+
+    @staticmethod
+    def _owner_session(user, service):
+        """Get the db session of a new token's owner"""
+        assert user or service
+        assert not (user and service)
+        return inspect(user or service).session
+
+    @staticmethod
+    def _check_new_token(token):
+        if len(token) < 8:
+            raise ValueError("Tokens must be at least 8 characters, got %r" % token)
+
+    @staticmethod
+    def _add_for_owner(db, orm_token, user, service, server=None):
+        """Assign a new token to its owner and commit it"""
         if user:
             assert user.id is not None
             orm_token.user_id = user.id
+            if server is not None:
+                assert server.id is not None
+                orm_token.server_id = server.id
         else:
             assert service.id is not None
             orm_token.service_id = service.id
         db.add(orm_token)
         db.commit()
-        return token
 
 
-def new_session_factory(url="sqlite:///:memory:", reset=False, **kwargs):
-    """Create a new session at url"""
+@event.listens_for(APIToken.hashed, 'set')
+def _token_hashed_set(target, value, oldvalue, initiator):
+    target.fingerprint = APIToken._fingerprint(value)
+
+
+@event.listens_for(APIToken, 'after_delete')
+def _token_deleted(mapper, connection, target):
+    APIToken.invalidate_cache(token_ids=[target.id])
+
+
+@event.listens_for(User.cookie_id, 'set')
+def _user_cookie_id_set(target, value, oldvalue, initiator):
+    if target.id is not None:
+        User.invalidate_cookie_cache(target.id)
+
+
+@event.listens_for(User, 'after_delete')
+def _user_deleted(mapper, connection, target):
+    APIToken.invalidate_cache(user_id=target.id)
+    User.invalidate_cookie_cache(target.id)
+
+
+@event.listens_for(Service, 'after_delete')
+def _service_deleted(mapper, connection, target):
+    APIToken.invalidate_cache(service_id=target.id)
+
+
+def _set_sqlite_pragmas(engine, pragmas):
+    """Apply PRAGMA statements to each new connection of a sqlite engine"""
+    statements = [ "PRAGMA %s=%s" % (key, value) for key, value in pragmas.items() ]
+
+    @event.listens_for(engine, 'connect')
+    def _on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+        for statement in statements:
+            cursor.execute(statement)
+        cursor.close()
+
+
+def new_session_factory(url="sqlite:///:memory:", reset=False, sqlite_pragmas=None, **kwargs):
+    """Create a new session at url
+
+    sqlite_pragmas, if given, is a dict of PRAGMAs (e.g. `{'journal_mode': 'wal'}`)
+    set on every connection to a sqlite database.
+    """
     if url.startswith('sqlite'):
         kwargs.setdefault('connect_args', {'check_same_thread': False})
     elif url.startswith('mysql'):
@@ -570,6 +1216,8 @@ def new_session_factory(url="sqlite:///:memory:", reset=False, **kwargs):
         kwargs.setdefault('poolclass', StaticPool)
 
     engine = create_engine(url, **kwargs)
+    if sqlite_pragmas and url.startswith('sqlite'):
+        _set_sqlite_pragmas(engine, sqlite_pragmas)
     if reset:
         Base.metadata.drop_all(engine)
     Base.metadata.create_all(engine)
@@ -0,0 +1,558 @@
+"""Proxy backends: the processes that route requests to the Hub and single-user servers
+
+The Hub keeps its record of the proxy in `orm.Proxy`,
+which delegates starting the proxy and changing its routing table to a backend:
+
+- ConfigurableHTTPProxy runs configurable-http-proxy as a subprocess,
+  and manages its routes with its REST API.
+- TornadoProxy is a reverse proxy running in the Hub process itself.
+"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from datetime import datetime
+import json
+import os
+from subprocess import Popen
+from urllib.parse import quote, unquote
+
+from tornado import gen, httputil, web, websocket
+from tornado.httpclient import HTTPRequest, HTTPError
+from tornado.httpserver import HTTPServer
+from tornado.simple_httpclient import SimpleAsyncHTTPClient, _HTTPConnection
+
+from traitlets.config import LoggingConfigurable
+from traitlets import Any, Bool, Float, Instance, Integer, Unicode, default
+
+from .emptyclass import EmptyClass
+from .routetable import Route, RouteTable
+from .traitlets import Command
+from .utils import url_path_join, ISO8601_ms
+
+
+class ProxyBackend(LoggingConfigurable):
+    """Base class for proxy backends.
+
+    Subclass this, and override the following methods:
+
+    - start
+    - stop
+    - is_running
+    - add_route
+    - delete_route
+    - get_all_routes
+
+    A route's `routespec` is a URL path prefix, such as `User.proxy_path`.
+    When the Hub uses subdomains, the prefix starts with the host: `/host/path`.
+    """
+
+    proxy = Any(help="The orm.Proxy, with the public and API servers and the auth token")
+    hub = Any(help="The orm.Hub, the proxy's default target")
+    statsd = Any()
+    @default('statsd')
+    def _statsd_default(self):
+        return EmptyClass()
+
+    host_routing = Bool(False,
+        help="Whether routes are prefixed by host, when the Hub uses subdomains."
+    )
+    ssl_key = Unicode()
+    ssl_cert = Unicode()
+
+    # whether this Hub started the proxy,
+    # and so should check on it and stop it with the Hub
+    managed = False
+
+    @gen.coroutine
+    def start(self):
+        """Start the proxy, or connect to a proxy that is already running
+
+        Sets `managed` if the proxy was started by the Hub.
+        Raises RuntimeError if the proxy cannot be started.
+        """
+        raise NotImplementedError("Override in subclass. Must be a Tornado gen.coroutine.")
+
+    def stop(self):
+        """Stop the proxy, if it was started by the Hub"""
+        pass
+
+    def is_running(self):
+        """Whether the proxy started by the Hub is still running
+
+        If it is not, the Hub will start it again, and restore its routes.
+        """
+        return True
+
+    @gen.coroutine
+    def add_route(self, routespec, target, data):
+        """Add or replace the route for routespec
+
+        target is the URL to send requests to,
+        and data is a dict of extra information about the route (the user or service).
+        """
+        raise NotImplementedError("Override in subclass. Must be a Tornado gen.coroutine.")
+
+    @gen.coroutine
+    def delete_route(self, routespec):
+        """Remove the route for routespec"""
+        raise NotImplementedError("Override in subclass. Must be a Tornado gen.coroutine.")
+
+    @gen.coroutine
+    def get_all_routes(self):
+        """Fetch the routing table
+
+        Returns a dict of {prefix: route}, in the format of configurable-http-proxy:
+        each route is a dict with its target, data, and last_activity as an ISO8601 timestamp.
+        """
+        raise NotImplementedError("Override in subclass. Must be a Tornado gen.coroutine.")
+
+
+class ConfigurableHTTPProxy(ProxyBackend):
+    """Run configurable-http-proxy, and manage its routes with its REST API
+
+    This is the default backend.
+    """
+
+    command = Command('configurable-http-proxy',
+        help="""The command to start configurable-http-proxy.
+
+        Set from `JupyterHub.proxy_cmd`.
+        """
+    )
+    debug = Bool(False, help="show debug output in configurable-http-proxy")
+    statsd_host = Unicode()
+    statsd_port = Integer(8125)
+    statsd_prefix = Unicode('jupyterhub')
+
+    process = None
+
+    @gen.coroutine
+    def start(self):
+        public_server, api_server = self.proxy.public_server, self.proxy.api_server
+        if public_server.is_up() or api_server.is_up():
+            # check for *authenticated* access to the proxy (auth token can change)
+            try:
+                yield self.get_all_routes()
+            except (HTTPError, OSError) as e:
+                if isinstance(e, HTTPError) and e.code == 403:
+                    msg = "Did CONFIGPROXY_AUTH_TOKEN change?"
+                else:
+                    msg = "Is something else using %s?" % public_server.bind_url
+                raise RuntimeError("Proxy appears to be running at %s, but I can't access it (%s)\n%s" % (
+                    public_server.bind_url, e, msg))
+            self.log.info("Proxy already running at: %s", public_server.bind_url)
+            self.process = None
+            self.managed = False
+            return
+
+        env = os.environ.copy()
+        env['CONFIGPROXY_AUTH_TOKEN'] = self.proxy.auth_token
+        cmd = self.command + [
+            '--ip', public_server.ip,
+            '--port', str(public_server.port),
+            '--api-ip', api_server.ip,
+            '--api-port', str(api_server.port),
+            '--default-target', self.hub.server.host,
+            '--error-target', url_path_join(self.hub.server.url, 'error'),
+        ]
+        if self.host_routing:
+            cmd.append('--host-routing')
+        if self.debug:
+            cmd.extend(['--log-level', 'debug'])
+        if self.ssl_key:
+            cmd.extend(['--ssl-key', self.ssl_key])
+        if self.ssl_cert:
+            cmd.extend(['--ssl-cert', self.ssl_cert])
+        if self.statsd_host:
+            cmd.extend([
+                '--statsd-host', self.statsd_host,
+                '--statsd-port', str(self.statsd_port),
+                '--statsd-prefix', self.statsd_prefix + '.chp'
+            ])
+        # Warn if SSL is not used
+        if ' --ssl' not in ' '.join(cmd):
+            self.log.warning("Running JupyterHub without SSL."
+                "  I hope there is SSL termination happening somewhere else...")
+        self.log.info("Starting proxy @ %s", public_server.bind_url)
+        self.log.debug("Proxy cmd: %s", cmd)
+        try:
+            self.process = Popen(cmd, env=env, start_new_session=True)
+        except FileNotFoundError:
+            e = RuntimeError(
+                "Failed to find proxy %r\n"
+                "The proxy can be installed with `npm install -g configurable-http-proxy`"
+                 % self.command
+            )
+            e.__cause__ = None
+            raise e
+        self.managed = True
+
+        def _check():
+            status = self.process.poll()
+            if status is not None:
+                e = RuntimeError("Proxy failed to start with exit code %i" % status)
+                # py2-compatible `raise e from None`
+                e.__cause__ = None
+                raise e
+
+        for server in (public_server, api_server):
+            for i in range(10):
+                _check()
+                try:
+                    yield server.wait_up(1)
+                except TimeoutError:
+                    continue
+                else:
+                    break
+            yield server.wait_up(1)
+        self.log.debug("Proxy started and appears to be up")
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.log.info("Cleaning up proxy[%i]...", self.process.pid)
+        if self.process.poll() is None:
+            try:
+                self.process.terminate()
+            except Exception as e:
+                self.log.error("Failed to terminate proxy process: %s", e)
+
+    def is_running(self):
+        return self.process is not None and self.process.poll() is None
+
+    @gen.coroutine
+    def add_route(self, routespec, target, data):
+        body = dict(data)
+        body['target'] = target
+        yield self.proxy.api_request(routespec, method='POST', body=body)
+
+    @gen.coroutine
+    def delete_route(self, routespec):
+        yield self.proxy.api_request(routespec, method='DELETE')
+
+    @gen.coroutine
+    def get_all_routes(self):
+        resp = yield self.proxy.api_request('')
+        return json.loads(resp.body.decode('utf8', 'replace'))
+
+
+class _FlowControlHTTPConnection(_HTTPConnection):
+    """An HTTP client connection that waits on Futures returned by the streaming callback
+
+    The response body is not read any further until the Future resolves.
+    """
+
+    def data_received(self, chunk):
+        if self._should_follow_redirect():
+            return
+        if self.request.streaming_callback is not None:
+            return self.request.streaming_callback(chunk)
+        self.chunks.append(chunk)
+
+
+class FlowControlHTTPClient(SimpleAsyncHTTPClient):
+    """A SimpleAsyncHTTPClient whose streaming_callback can return a Future for flow control
+
+    so a proxied response is read from upstream no faster than it is sent to the client.
+    """
+
+    def _connection_class(self):
+        return _FlowControlHTTPConnection
+
+
+class TornadoProxy(ProxyBackend):
+    """A reverse proxy running on the Hub's own IOLoop
+
+    Routes are kept in memory and changed without any API requests,
+    and the last activity of each route is recorded as requests pass through it.
+    HTTP requests and websockets are proxied.
+
+    There is no separate process to survive a restart of the Hub,
+    so all routes are added again when the Hub starts.
+    """
+
+    max_clients = Integer(256,
+        help="Maximum number of simultaneous requests to single-user servers and services."
+    ).tag(config=True)
+    upstream_timeout = Float(300,
+        help="Timeout (in seconds) for an HTTP request to a single-user server or service."
+    ).tag(config=True)
+    max_body_size = Integer(100 * 1024 * 1024,
+        help="Largest request body (in bytes) to accept and forward."
+    ).tag(config=True)
+
+    routes = Instance(RouteTable, ())
+    server = None
+
+    @gen.coroutine
+    def start(self):
+        public_server = self.proxy.public_server
+        self.http_client = FlowControlHTTPClient(force_instance=True, max_clients=self.max_clients)
+        self.error_target = url_path_join(self.hub.server.url, 'error')
+        self.routes.replace([Route('/', self.hub.server.host)])
+
+        app = web.Application([
+            (r'.*', TornadoProxyHandler, {'backend': self}),
+        ], log_function=self._log_request)
+        ssl_options = None
+        if self.ssl_key or self.ssl_cert:
+            ssl_options = {'keyfile': self.ssl_key, 'certfile': self.ssl_cert}
+        else:
+            self.log.warning("Running JupyterHub without SSL."
+                "  I hope there is SSL termination happening somewhere else...")
+        self.server = HTTPServer(app,
+            ssl_options=ssl_options,
+            max_body_size=self.max_body_size,
+            decompress_request=False,
+        )
+        self.server.listen(public_server.port, address=public_server.ip)
+        self.managed = True
+        self.log.info("Proxy listening on %s", public_server.bind_url)
+
+    def stop(self):
+        if self.server is not None:
+            self.log.info("Stopping proxy on %s", self.proxy.public_server.bind_url)
+            self.server.stop()
+            self.server = None
+            self.http_client.close()
+
+    def _log_request(self, handler):
+        if handler.get_status() < 400:
+            log_method = self.log.debug
+        else:
+            log_method = self.log.warning
+        request = handler.request
+        request_time = 1e3 * request.request_time()
+        log_method("%s %s %s %.2fms", handler.get_status(), request.method, request.uri, request_time)
+        self.statsd.timing('proxy.request', request_time)
+
+    @staticmethod
+    def _route_key(routespec):
+        """Normalize a routespec to a prefix in the routing table"""
+        key = unquote(routespec)
+        if key != '/':
+            key = key.rstrip('/')
+        return key
+
+    @gen.coroutine
+    def add_route(self, routespec, target, data):
+        data = dict(data)
+        self.routes.add(Route(self._route_key(routespec), target,
+            user=data.pop('user', None),
+            service=data.pop('service', None),
+            data=data,
+        ))
+
+    @gen.coroutine
+    def delete_route(self, routespec):
+        self.routes.remove(self._route_key(routespec))
+
+    @gen.coroutine
+    def get_all_routes(self):
+        all_routes = {}
+        for route in self.routes:
+            model = dict(route.data or {})
+            model.update({
+                'target': route.target,
+                'last_activity': route.last_activity.strftime(ISO8601_ms),
+            })
+            if route.user is not None:
+                model['user'] = route.user
+            if route.service is not None:
+                model['service'] = route.service
+            all_routes[route.prefix] = model
+        return all_routes
+
+    def get_route(self, request):
+        """Find the Route for a request, by the longest matching prefix
+
+        Returns None if no route matches.
+        """
+        host = request.host.split(':')[0] if self.host_routing else None
+        return self.routes.match(unquote(request.path), host)
+
+
+# headers that apply to a single connection, and are not forwarded
+HOP_BY_HOP_HEADERS = {
+    'Connection', 'Keep-Alive', 'Proxy-Authenticate', 'Proxy-Authorization',
+    'Te', 'Trailer', 'Transfer-Encoding', 'Upgrade',
+}
+
+# headers of the websocket handshake, set by the websocket client
+WEBSOCKET_HEADERS = HOP_BY_HOP_HEADERS | {
+    'Sec-Websocket-Key', 'Sec-Websocket-Version', 'Sec-Websocket-Extensions',
+}
+
+
+class TornadoProxyHandler(websocket.WebSocketHandler):
+    """Proxy a request, or a websocket, to the target of its route"""
+
+    SUPPORTED_METHODS = ('GET', 'HEAD', 'POST', 'DELETE', 'PATCH', 'PUT', 'OPTIONS')
+
+    upstream = None
+    # upstream websocket messages that arrived before the client's websocket was open
+    _upstream_pending = None
+
+    def initialize(self, backend):
+        self.backend = backend
+
+    def prepare(self):
+        self.route = self.backend.get_route(self.request)
+        if self.route is None:
+            raise web.HTTPError(404)
+        self.route.last_activity = datetime.utcnow()
+
+    def upstream_url(self, scheme='http'):
+        url = self.route.target + self.request.uri
+        if scheme == 'ws':
+            url = 'ws' + url[len('http'):]
+        return url
+
+    def upstream_headers(self, skip):
+        headers = httputil.HTTPHeaders()
+        for name, value in self.request.headers.get_all():
+            if name not in skip:
+                headers.add(name, value)
+        remote_ip = self.request.remote_ip
+        if 'X-Forwarded-For' in headers:
+            headers['X-Forwarded-For'] += ', ' + remote_ip
+        else:
+            headers['X-Forwarded-For'] = remote_ip
+        headers.setdefault('X-Forwarded-Proto', self.request.protocol)
+        return headers
+
+    @gen.coroutine
+    def get(self, *args, **kwargs):
+        if self.request.headers.get('Upgrade', '').lower() == 'websocket':
+            yield self.open_upstream_websocket()
+            if self.upstream is not None:
+                # accept the websocket, now that the upstream one is open
+                super().get(*args, **kwargs)
+        else:
+            yield self.proxy_http()
+
+    def compute_etag(self):
+        # responses are passed through unchanged
+        return None
+
+    @gen.coroutine
+    def proxy_http(self):
+        body = self.request.body
+        if not body and self.request.method not in ('POST', 'PUT', 'PATCH'):
+            body = None
+        self._upstream_started = False
+        req = HTTPRequest(self.upstream_url(),
+            method=self.request.method,
+            headers=self.upstream_headers(HOP_BY_HOP_HEADERS | {'Expect'}),
+            body=body,
+            follow_redirects=False,
+            decompress_response=False,
+            allow_nonstandard_methods=True,
+            request_timeout=self.backend.upstream_timeout,
+            header_callback=self._on_upstream_header,
+            streaming_callback=self._on_upstream_chunk,
+        )
+        resp = yield self.backend.http_client.fetch(req, raise_error=False)
+        if not self._upstream_started:
+            self.backend.log.warning("Proxy error for %s: %s", self.request.uri, resp.error)
+            yield self.send_proxy_error(503)
+        elif not self._finished:
+            self.finish()
+
+    def _on_upstream_header(self, line):
+        """Relay the upstream response's status and headers, once they have all arrived"""
+        line = line.strip()
+        if line.startswith('HTTP/'):
+            self._upstream_start = httputil.parse_response_start_line(line)
+            self._upstream_headers = httputil.HTTPHeaders()
+        elif line:
+            self._upstream_headers.parse_line(line)
+        elif self._upstream_start.code != 100:
+            self.set_status(self._upstream_start.code, self._upstream_start.reason)
+            for name in ('Content-Type', 'Date', 'Server'):
+                self.clear_header(name)
+            for name, value in self._upstream_headers.get_all():
+                if name not in HOP_BY_HOP_HEADERS:
+                    self.add_header(name, value)
+            self._upstream_started = True
+
+    def _on_upstream_chunk(self, chunk):
+        """Relay a chunk of the upstream response
+
+        Returns the flush Future, so the upstream read waits until
+        the chunk has been written to the client.
+        """
+        self.write(chunk)
+        return self.flush()
+
+    post = put = patch = delete = head = options = proxy_http
+
+    @gen.coroutine
+    def send_proxy_error(self, status_code):
+        """Serve the Hub's error page for a request that couldn't be proxied"""
+        url = url_path_join(self.backend.error_target, str(status_code)) + '?url=' + quote(self.request.uri)
+        self.clear()
+        self.set_status(status_code)
+        try:
+            resp = yield self.backend.http_client.fetch(url)
+        except Exception as e:
+            self.backend.log.error("Failed to get error page %s: %s", url, e)
+        else:
+            self.set_header('Content-Type', resp.headers.get('Content-Type', 'text/html'))
+            self.write(resp.body)
+        self.finish()
+
+    # websockets
+
+    @gen.coroutine
+    def open_upstream_websocket(self):
+        req = HTTPRequest(self.upstream_url('ws'),
+            headers=self.upstream_headers(WEBSOCKET_HEADERS),
+            connect_timeout=self.backend.upstream_timeout,
+        )
+        self._upstream_pending = []
+        try:
+            self.upstream = yield websocket.websocket_connect(req,
+                on_message_callback=self.on_upstream_message,
+            )
+        except Exception as e:
+            self.backend.log.warning("Proxy error for websocket %s: %s", self.request.uri, e)
+            code = e.code if isinstance(e, HTTPError) and e.code != 599 else 503
+            yield self.send_proxy_error(code)
+
+    def select_subprotocol(self, subprotocols):
+        return self.upstream.headers.get('Sec-WebSocket-Protocol')
+
+    def check_origin(self, origin):
+        # origin is checked by the upstream server, which gets the same headers
+        return True
+
+    def open(self, *args, **kwargs):
+        # relay what upstream sent while the client's handshake was completing
+        pending, self._upstream_pending = self._upstream_pending, None
+        for message in pending:
+            self.on_upstream_message(message)
+
+    def on_message(self, message):
+        self.route.last_activity = datetime.utcnow()
+        self.upstream.write_message(message, binary=isinstance(message, bytes))
+
+    def on_upstream_message(self, message):
+        if self._upstream_pending is not None:
+            # client websocket isn't open yet
+            self._upstream_pending.append(message)
+            return
+        if message is None:
+            # upstream closed
+            self.close(self.upstream.close_code, self.upstream.close_reason)
+            return
+        self.route.last_activity = datetime.utcnow()
+        try:
+            self.write_message(message, binary=isinstance(message, bytes))
+        except websocket.WebSocketClosedError:
+            self.upstream.close()
+
+    def on_close(self):
+        if self.upstream is not None:
+            self.upstream.close(self.close_code, self.close_reason)
@@ -0,0 +1,156 @@
+"""A routing table for URL path prefixes, stored as a trie of path segments"""
+
+# Copyright (c) Jupyter Development Team.
+# Distributed under the terms of the Modified BSD License.
+
+from datetime import datetime
+
+
+class Route(object):
+    """A route: the target for requests under prefix, and who the route is for
+
+    Any other data stored with the route is kept in the `data` dict,
+    which is None if there is none.
+    """
+    __slots__ = ('prefix', 'target', 'user', 'service', 'last_activity', 'data')
+
+    def __init__(self, prefix, target, user=None, service=None, last_activity=None, data=None):
+        self.prefix = prefix
+        self.target = target
+        self.user = user
+        self.service = service
+        self.last_activity = last_activity or datetime.utcnow()
+        self.data = data or None
+
+    def __repr__(self):
+        return "<%s %s => %s>" % (self.__class__.__name__, self.prefix, self.target)
+
+
+class _Node(object):
+    __slots__ = ('children', 'route')
+
+    def __init__(self):
+        self.children = None
+        self.route = None
+
+
+def _segments(path):
+    """The segments of a path, ignoring empty ones from leading, trailing or repeated slashes"""
+    return [ segment for segment in path.split('/') if segment ]
+
+
+class RouteTable(object):
+    """Routes by path prefix, matched by the longest prefix of a path
+
+    Prefixes are `/`-separated paths, such as `/user/name`,
+    and only match whole segments: `/user/name` matches `/user/name/tree`,
+    but not `/user/names`.
+    Host-prefixed routes, for Hubs using subdomains, start with the host: `/host/user/name`.
+
+    Finding the route for a path walks the trie one segment at a time,
+    so it takes time proportional to the length of the path,
+    however many routes there are.
+    Each change replaces a single reference,
+    so lookups never see a partly applied add, remove, or replace.
+    """
+
+    def __init__(self, routes=()):
+        self._root = _Node()
+        self._count = 0
+        if routes:
+            self.replace(routes)
+
+    def __len__(self):
+        return self._count
+
+    def __contains__(self, prefix):
+        return self.get(prefix) is not None
+
+    def __iter__(self):
+        """Iterate through the routes"""
+        stack = [self._root]
+        while stack:
+            node = stack.pop()
+            if node.route is not None:
+                yield node.route
+            if node.children:
+                stack.extend(node.children.values())
+
+    def _find(self, prefix):
+        node = self._root
+        for segment in _segments(prefix):
+            if not node.children or segment not in node.children:
+                return None
+            node = node.children[segment]
+        return node
+
+    def get(self, prefix):
+        """Get the route for exactly prefix, or None"""
+        node = self._find(prefix)
+        return None if node is None else node.route
+
+    def add(self, route):
+        """Add route, replacing any route with the same prefix"""
+        node = self._root
+        for segment in _segments(route.prefix):
+            if node.children is None:
+                node.children = {}
+            child = node.children.get(segment)
+            if child is None:
+                child = node.children[segment] = _Node()
+            node = child
+        if node.route is None:
+            self._count += 1
+        node.route = route
+
+    def remove(self, prefix):
+        """Remove the route for prefix, returning it (or None if there wasn't one)"""
+        path = [self._root]
+        segments = _segments(prefix)
+        for segment in segments:
+            node = path[-1]
+            if not node.children or segment not in node.children:
+                return None
+            path.append(node.children[segment])
+        route = path[-1].route
+        if route is None:
+            return None
+        path[-1].route = None
+        self._count -= 1
+        # prune nodes that no longer lead to any route
+        for segment, parent, node in zip(reversed(segments), reversed(path[:-1]), reversed(path)):
+            if node.route is not None or node.children:
+                break
+            del parent.children[segment]
+        return route
+
+    def replace(self, routes):
+        """Replace all the routes with routes, at once"""
+        table = RouteTable()
+        for route in routes:
+            table.add(route)
+        self._root, self._count = table._root, table._count
+
+    def match(self, path, host=None):
+        """Find the route with the longest prefix matching path
+
+        If host is given, it is prepended to path, for host-prefixed routes.
+        Returns None if no route matches.
+        """
+        node = self._root
+        best = node.route
+        segments = path.split('/')
+        if host is not None:
+            segments.insert(0, host)
+        for segment in segments:
+            if not segment:
+                continue
+            children = node.children
+            if not children:
+                break
+            node = children.get(segment)
+            if node is None:
+                break
+            if node.route is not None:
+                best = node.route
+        return best
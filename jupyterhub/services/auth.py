@@ -1,77 +1,30 @@
 """Authenticating services with JupyterHub
 
 Cookies are sent to the Hub for verification, replying with a JSON model describing the authenticated user.
+If the Hub has given us a key for checking signed identity cookies,
+a valid identity cookie identifies the user without asking the Hub.
 
 HubAuth can be used in any application, even outside tornado.
 
 HubAuthenticated is a mixin class for tornado handlers that should authenticate with the Hub.
 """
 
+import json
 import os
 import socket
-import time
 from urllib.parse import quote
 
 import requests
 
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient, HTTPRequest
 from tornado.log import app_log
 from tornado.web import HTTPError
 
 from traitlets.config import Configurable
-from traitlets import Unicode, Integer, Instance, default
-
-from ..utils import url_path_join
-
-class _ExpiringDict(dict):
-    """Dict-like cache for Hub API requests
-
-    Values will expire after max_age seconds.
-
-    A monotonic timer is used (time.monotonic).
-
-    A max_age of 0 means cache forever.
-    """
-
-    max_age = 0
-
-    def __init__(self, max_age=0):
-        self.max_age = max_age
-        self.timestamps = {}
-        self.values = {}
-
-    def __setitem__(self, key, value):
-        """Store key and record timestamp"""
-        self.timestamps[key] = time.monotonic()
-        self.values[key] = value
-
-    def _check_age(self, key):
-        """Check timestamp for a key"""
-        if key not in self.values:
-            # not registered, nothing to do
-            return
-        now = time.monotonic()
-        timestamp = self.timestamps[key]
-        if self.max_age > 0 and timestamp + self.max_age < now:
-            self.values.pop(key)
-            self.timestamps.pop(key)
-
-    def __contains__(self, key):
-        """dict check for `key in dict`"""
-        self._check_age(key)
-        return key in self.values
-
-    def __getitem__(self, key):
-        """Check age before returning value"""
-        self._check_age(key)
-        return self.values[key]
-
-    def get(self, key, default=None):
-        """dict-like get:"""
-        try:
-            return self[key]
-        except KeyError:
-            return default
+from traitlets import Unicode, Integer, Instance, Dict, default
 
+from ..utils import url_path_join, LRUCache, verify_identity
 
 class HubAuth(Configurable):
     """A class for authenticating with JupyterHub
@@ -81,6 +34,8 @@ class HubAuth(Configurable):
     If using tornado, use via :class:`HubAuthenticated` mixin.
     If using manually, use the ``.user_for_cookie(cookie_value)`` method
     to identify the user corresponding to a given cookie value.
+    In a tornado application, ``.user_for_cookie_async(cookie_value)``
+    does the same without blocking the IOLoop.
 
     The following config must be set:
 
@@ -93,9 +48,16 @@ class HubAuth(Configurable):
       fetched from JUPYTERHUB_API_URL by default.
     - cookie_cache_max_age: the number of seconds responses
       from the Hub should be cached.
+    - cookie_cache_max_size: the number of responses from the Hub to cache.
     - login_url (the *public* ``/hub/login`` URL of the Hub).
     - cookie_name: the name of the cookie I should be using,
       if different from the default (unlikely).
+    - identity_key: the key for checking signed identity cookies,
+      fetched from JUPYTERHUB_IDENTITY_KEY by default.
+    - identity_cookie_name: the name of the identity cookie,
+      fetched from JUPYTERHUB_IDENTITY_COOKIE by default.
+    - identity_cookie_path: the path of the identity cookie,
+      when refreshing it.
 
     """
 
@@ -124,6 +86,45 @@ class HubAuth(Configurable):
     cookie_name = Unicode('jupyterhub-services',
         help="""The name of the cookie I should be looking for"""
     ).tag(config=True)
+
+    identity_key = Unicode(
+        help="""Hex-encoded key for checking signed identity cookies from the Hub.
+
+        The Hub sets an identity cookie, `identity_cookie_name`, with the login cookie.
+        If it has a valid signature, the user is identified without asking the Hub.
+
+        Default: JUPYTERHUB_IDENTITY_KEY env, set by the Hub for managed services.
+        If unspecified, every new cookie is checked with the Hub.
+        """
+    ).tag(config=True)
+    @default('identity_key')
+    def _identity_key(self):
+        return os.environ.get('JUPYTERHUB_IDENTITY_KEY', '')
+
+    identity_cookie_name = Unicode(
+        help="""The name of the signed identity cookie.
+
+        Default: JUPYTERHUB_IDENTITY_COOKIE env, set by the Hub for managed services,
+        or `{cookie_name}-identity`.
+        """
+    ).tag(config=True)
+    @default('identity_cookie_name')
+    def _identity_cookie_name(self):
+        return os.environ.get('JUPYTERHUB_IDENTITY_COOKIE') or self.cookie_name + '-identity'
+
+    identity_cookie_path = Unicode(
+        help="""The path to set a refreshed identity cookie on.
+
+        Default: the service's prefix, from JUPYTERHUB_SERVICE_PREFIX,
+        or the Hub's services prefix, from JUPYTERHUB_BASE_URL.
+        """
+    ).tag(config=True)
+    @default('identity_cookie_path')
+    def _identity_cookie_path(self):
+        prefix = os.environ.get('JUPYTERHUB_SERVICE_PREFIX')
+        if prefix:
+            return prefix.rstrip('/')
+        return url_path_join(os.environ.get('JUPYTERHUB_BASE_URL') or '/', 'services')
     cookie_cache_max_age = Integer(300,
         help="""The maximum time (in seconds) to cache the Hub's response for cookie authentication.
 
@@ -133,10 +134,80 @@ class HubAuth(Configurable):
         Default: 300 (five minutes)
         """
     ).tag(config=True)
-    cookie_cache = Instance(_ExpiringDict, allow_none=False)
+    cookie_cache_max_size = Integer(10000,
+        help="""The maximum number of the Hub's responses for cookie authentication to cache.
+
+        When the cache is full, the least recently used response is dropped.
+
+        Default: 10000
+        """
+    ).tag(config=True)
+    cookie_cache = Instance(LRUCache, allow_none=False)
     @default('cookie_cache')
     def _cookie_cache(self):
-        return _ExpiringDict(self.cookie_cache_max_age)
+        return LRUCache(max_size=self.cookie_cache_max_size, max_age=self.cookie_cache_max_age)
+
+    @property
+    def cookie_cache_stats(self):
+        """Size and hit/miss/eviction counts of the cookie cache"""
+        return self.cookie_cache.stats
+
+    http_client = Instance(AsyncHTTPClient,
+        help="""The tornado HTTP client for asynchronous requests to the Hub.
+
+        Created on first use, and reused for every request after that.
+        By default, this is a dedicated instance of tornado's curl client,
+        which keeps connections to the Hub open between requests.
+        If pycurl is not installed, tornado's simple client is used instead,
+        which opens a new connection for each request.
+        """
+    )
+    @default('http_client')
+    def _http_client(self):
+        try:
+            from tornado.curl_httpclient import CurlAsyncHTTPClient as client_class
+        except ImportError:
+            from tornado.simple_httpclient import SimpleAsyncHTTPClient as client_class
+        return client_class(force_instance=True)
+
+    # in-flight asynchronous cookie lookups: cookie -> Future
+    _pending_cookies = Dict()
+
+    def _cookie_url(self, encrypted_cookie):
+        """The Hub API url for identifying a cookie"""
+        return url_path_join(self.api_url,
+            "authorizations/cookie",
+            self.cookie_name,
+            quote(encrypted_cookie, safe=''),
+        )
+
+    def _connection_error(self):
+        """HTTPError to raise when the Hub can't be reached"""
+        msg = "Failed to connect to Hub API at %r." % self.api_url
+        msg += "  Is the Hub accessible at this URL (from host: %s)?" % socket.gethostname()
+        if '127.0.0.1' in self.api_url:
+            msg += "  Make sure to set c.JupyterHub.hub_ip to an IP accessible to" + \
+                   " single-user servers if the servers are not on the same host as the Hub."
+        return HTTPError(500, msg)
+
+    def _check_hub_response(self, status_code, reason):
+        """Check the status of a reply from the Hub
+
+        Returns True if the reply has a user model, False if the user was not found.
+        Raises HTTPError if the Hub couldn't answer.
+        """
+        if status_code == 404:
+            return False
+        elif status_code == 403:
+            app_log.error("I don't have permission to verify cookies, my auth token may have expired: [%i] %s", status_code, reason)
+            raise HTTPError(500, "Permission failure checking authorization, I may need a new token")
+        elif status_code >= 500:
+            app_log.error("Upstream failure verifying auth token: [%i] %s", status_code, reason)
+            raise HTTPError(502, "Failed to check authorization (upstream problem)")
+        elif status_code >= 400:
+            app_log.warning("Failed to check authorization: [%i] %s", status_code, reason)
+            raise HTTPError(500, "Failed to check authorization")
+        return True
 
     def user_for_cookie(self, encrypted_cookie, use_cache=True):
         """Ask the Hub to identify the user for a given cookie.
@@ -155,37 +226,105 @@ class HubAuth(Configurable):
             if cached is not None:
                 return cached
         try:
-            r = requests.get(
-                url_path_join(self.api_url,
-                              "authorizations/cookie",
-                              self.cookie_name,
-                              quote(encrypted_cookie, safe=''),
-                ),
+            r = requests.get(self._cookie_url(encrypted_cookie),
                 headers = {
                     'Authorization' : 'token %s' % self.api_token,
                 },
             )
         except requests.ConnectionError:
-            msg = "Failed to connect to Hub API at %r." % self.api_url
-            msg += "  Is the Hub accessible at this URL (from host: %s)?" % socket.gethostname()
-            if '127.0.0.1' in self.api_url:
-                msg += "  Make sure to set c.JupyterHub.hub_ip to an IP accessible to" + \
-                       " single-user servers if the servers are not on the same host as the Hub."
-            raise HTTPError(500, msg)
+            raise self._connection_error()
 
-        if r.status_code == 404:
+        if self._check_hub_response(r.status_code, r.reason):
+            data = r.json()
+        else:
             data = None
-        elif r.status_code == 403:
-            app_log.error("I don't have permission to verify cookies, my auth token may have expired: [%i] %s", r.status_code, r.reason)
-            raise HTTPError(500, "Permission failure checking authorization, I may need a new token")
-        elif r.status_code >= 500:
-            app_log.error("Upstream failure verifying auth token: [%i] %s", r.status_code, r.reason)
-            raise HTTPError(502, "Failed to check authorization (upstream problem)")
-        elif r.status_code >= 400:
-            app_log.warning("Failed to check authorization: [%i] %s", r.status_code, r.reason)
+        self.cookie_cache[encrypted_cookie] = data
+        return data
+
+    def users_for_cookies(self, encrypted_cookies, use_cache=True):
+        """Ask the Hub to identify the users for many cookies at once.
+
+        Cookies that aren't cached are sent to the Hub in a single request,
+        and the replies are cached.
+
+        Args:
+            encrypted_cookies (list): the cookie values
+            use_cache (bool): Specify use_cache=False to skip cached cookie values (default: True)
+
+        Returns:
+            user_models (dict): cookie value: user model, or None if authentication fails.
+        """
+        user_models = {}
+        missing = []
+        for encrypted_cookie in encrypted_cookies:
+            cached = self.cookie_cache.get(encrypted_cookie) if use_cache else None
+            if cached is not None:
+                user_models[encrypted_cookie] = cached
+            elif encrypted_cookie not in missing:
+                missing.append(encrypted_cookie)
+        if not missing:
+            return user_models
+        try:
+            r = requests.post(url_path_join(self.api_url, "authorizations/batch"),
+                headers = {
+                    'Authorization' : 'token %s' % self.api_token,
+                },
+                data=json.dumps({
+                    'cookies': [ {'name': self.cookie_name, 'value': c} for c in missing ],
+                }),
+            )
+        except requests.ConnectionError:
+            raise self._connection_error()
+        if r.status_code == 404:
+            # unknown users are null in the reply, so this is a Hub without the batch API
+            app_log.error("Hub API at %s has no batch authorization endpoint", self.api_url)
             raise HTTPError(500, "Failed to check authorization")
+        self._check_hub_response(r.status_code, r.reason)
+        for encrypted_cookie, data in zip(missing, r.json()['cookies']):
+            self.cookie_cache[encrypted_cookie] = data
+            user_models[encrypted_cookie] = data
+        return user_models
+
+    @gen.coroutine
+    def user_for_cookie_async(self, encrypted_cookie, use_cache=True):
+        """Ask the Hub to identify the user for a given cookie, without blocking.
+
+        Like :meth:`user_for_cookie`, but the request to the Hub is made with
+        :attr:`http_client`.
+        Concurrent lookups of the same cookie share a single request to the Hub.
+
+        Returns a Future for the user model.
+        """
+        if use_cache:
+            cached = self.cookie_cache.get(encrypted_cookie)
+            if cached is not None:
+                return cached
+        if encrypted_cookie in self._pending_cookies:
+            data = yield self._pending_cookies[encrypted_cookie]
+            return data
+        f = self._pending_cookies[encrypted_cookie] = self._fetch_user_for_cookie(encrypted_cookie)
+        try:
+            data = yield f
+        finally:
+            self._pending_cookies.pop(encrypted_cookie, None)
+        return data
+
+    @gen.coroutine
+    def _fetch_user_for_cookie(self, encrypted_cookie):
+        """Request the user for a cookie from the Hub, and cache the reply"""
+        req = HTTPRequest(self._cookie_url(encrypted_cookie),
+            headers = {
+                'Authorization' : 'token %s' % self.api_token,
+            },
+        )
+        r = yield self.http_client.fetch(req, raise_error=False)
+        if r.code == 599:
+            # tornado's code for errors without an HTTP reply
+            raise self._connection_error()
+        if self._check_hub_response(r.code, r.reason):
+            data = json.loads(r.body.decode('utf8', 'replace'))
         else:
-            data = r.json()
+            data = None
         self.cookie_cache[encrypted_cookie] = data
         return data
 
@@ -212,13 +351,65 @@ class HubAuth(Configurable):
         handler._cached_hub_user = None
         encrypted_cookie = handler.get_cookie(self.cookie_name)
         if encrypted_cookie:
-            user_model = self.user_for_cookie(encrypted_cookie)
+            user_model = self._user_for_identity(handler, encrypted_cookie)
+            if user_model is None:
+                user_model = self.user_for_cookie(encrypted_cookie)
+                self._refresh_identity(handler, user_model)
             handler._cached_hub_user = user_model
             return user_model
         else:
             app_log.debug("No token cookie")
             return None
 
+    @gen.coroutine
+    def get_user_async(self, handler):
+        """Get the Hub user for a given tornado handler, without blocking.
+
+        Like :meth:`get_user`, but uses :meth:`user_for_cookie_async`.
+
+        Returns a Future for the user model.
+        """
+        if hasattr(handler, '_cached_hub_user'):
+            return handler._cached_hub_user
+
+        encrypted_cookie = handler.get_cookie(self.cookie_name)
+        if not encrypted_cookie:
+            app_log.debug("No token cookie")
+            handler._cached_hub_user = None
+            return None
+        user_model = self._user_for_identity(handler, encrypted_cookie)
+        if user_model is None:
+            try:
+                user_model = yield self.user_for_cookie_async(encrypted_cookie)
+            except Exception:
+                handler._cached_hub_user = None
+                raise
+            self._refresh_identity(handler, user_model)
+        handler._cached_hub_user = user_model
+        return user_model
+
+    def _user_for_identity(self, handler, encrypted_cookie):
+        """Get the user model from a handler's signed identity cookie, if it is valid"""
+        if not self.identity_key:
+            return None
+        identity = handler.get_cookie(self.identity_cookie_name)
+        if not identity:
+            return None
+        user_model = verify_identity(identity, bytes.fromhex(self.identity_key), encrypted_cookie)
+        if user_model is None:
+            app_log.debug("Invalid or expired identity cookie")
+        return user_model
+
+    def _refresh_identity(self, handler, user_model):
+        """Set a fresh identity cookie from the Hub's reply, if it sent one"""
+        if not self.identity_key or not user_model or not user_model.get('identity'):
+            return
+        kwargs = {}
+        if handler.request.protocol == 'https':
+            kwargs['secure'] = True
+        handler.set_cookie(self.identity_cookie_name, user_model['identity'],
+            path=self.identity_cookie_path, **kwargs)
+
 
 class HubAuthenticated(object):
     """Mixin for tornado handlers that are authenticated with JupyterHub
@@ -243,6 +434,14 @@ class HubAuthenticated(object):
             def get(self):
                 ...
 
+    To check the cookie with the Hub without blocking the IOLoop,
+    identify the user in ``prepare`` with :meth:`get_current_user_async`::
+
+        class MyHandler(HubAuthenticated, web.RequestHandler):
+            @gen.coroutine
+            def prepare(self):
+                self.current_user = yield self.get_current_user_async()
+
     """
     hub_users = None # set of allowed users
     hub_groups = None # set of allowed groups
@@ -299,3 +498,17 @@ class HubAuthenticated(object):
             return
         return self.check_hub_user(user_model)
 
+    @gen.coroutine
+    def get_current_user_async(self):
+        """Asynchronous version of :meth:`get_current_user`
+
+        Checks the cookie with the Hub without blocking the IOLoop.
+
+        Returns:
+            user_model (Future): The user model, if a user is identified, None if authentication fails.
+        """
+        user_model = yield self.hub_auth.get_user_async(self)
+        if not user_model:
+            return
+        return self.check_hub_user(user_model)
+
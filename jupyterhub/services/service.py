@@ -57,7 +57,7 @@ from traitlets.config import LoggingConfigurable
 from .. import orm
 from ..traitlets import Command
 from ..spawner import LocalProcessSpawner
-from ..utils import url_path_join
+from ..utils import url_path_join, service_identity_name
 
 class _MockUser(HasTraits):
     name = Unicode()
@@ -182,6 +182,12 @@ class Service(LoggingConfigurable):
     domain = Unicode()
     host = Unicode()
     proc = Any()
+    identity_key = Unicode(
+        help="""Hex-encoded key for verifying signed identity cookies.
+
+        Passed to managed services as JUPYTERHUB_IDENTITY_KEY env.
+        """
+    )
 
     # handles on globals:
     proxy = Any()
@@ -228,6 +234,9 @@ class Service(LoggingConfigurable):
         if self.url:
             env['JUPYTERHUB_SERVICE_URL'] = self.url
             env['JUPYTERHUB_SERVICE_PREFIX'] = self.server.base_url
+        if self.identity_key:
+            env['JUPYTERHUB_IDENTITY_KEY'] = self.identity_key
+            env['JUPYTERHUB_IDENTITY_COOKIE'] = service_identity_name(self.name) + '-identity'
 
         self.spawner = _ServiceSpawner(
             cmd=self.command,
@@ -227,6 +227,8 @@ class SingleUserNotebookApp(NotebookApp):
             parent=self,
             api_token=os.environ.pop('JPY_API_TOKEN'),
             api_url=self.hub_api_url,
+            identity_key=os.environ.pop('JUPYTERHUB_IDENTITY_KEY', ''),
+            identity_cookie_path=self.base_url,
         )
 
     def init_webapp(self):
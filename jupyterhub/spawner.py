@@ -51,6 +51,12 @@ class Spawner(LoggingConfigurable):
     hub = Any()
     authenticator = Any()
     api_token = Unicode()
+    identity_key = Unicode(
+        help="""Hex-encoded key for verifying signed identity cookies.
+
+        Set by the Hub when spawning, and passed as JUPYTERHUB_IDENTITY_KEY env.
+        """
+    )
 
     ip = Unicode('127.0.0.1',
         help="""
@@ -405,6 +411,8 @@ class Spawner(LoggingConfigurable):
                 env[key] = value
 
         env['JPY_API_TOKEN'] = self.api_token
+        if self.identity_key:
+            env['JUPYTERHUB_IDENTITY_KEY'] = self.identity_key
 
         # Put in limit and guarantee info if they exist.
         # Note that this is for use by the humans / notebook extensions in the
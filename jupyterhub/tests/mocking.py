@@ -1,5 +1,6 @@
 """mock utilities for testing"""
 
+from contextlib import contextmanager
 import os
 import sys
 from tempfile import NamedTemporaryFile
@@ -9,6 +10,7 @@ from unittest import mock
 
 import requests
 
+from sqlalchemy import event
 from tornado import gen
 from tornado.concurrent import Future
 from tornado.ioloop import IOLoop
@@ -220,6 +222,24 @@ def public_url(app, user_or_service=None):
         return public_host(app) + app.proxy.public_server.base_url
 
 
+
+@contextmanager
+def count_queries(app):
+    """Count the SQL statements the given JupyterHub instance executes.
+
+    Yields a list, which is filled with the statements on exit.
+    """
+    engine = app.db.get_bind()
+    statements = []
+    def before_execute(conn, cursor, statement, *args):
+        statements.append(statement)
+    event.listen(engine, 'before_cursor_execute', before_execute)
+    try:
+        yield statements
+    finally:
+        event.remove(engine, 'before_cursor_execute', before_execute)
+
+
 # single-user-server mocking:
 
 class MockSingleUserServer(SingleUserNotebookApp):
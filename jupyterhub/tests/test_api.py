@@ -1,5 +1,6 @@
 """Tests for the REST API"""
 
+from datetime import datetime
 import json
 import time
 from queue import Queue
@@ -14,10 +15,11 @@ from tornado import gen
 
 import jupyterhub
 from .. import orm
+from ..apihandlers.users import UserListAPIHandler
 from ..user import User
-from ..utils import url_path_join as ujoin
+from ..utils import url_path_join as ujoin, random_port, verify_identity, service_identity_name
 from . import mocking
-from .mocking import public_host, public_url
+from .mocking import public_host, public_url, count_queries
 
 
 def check_db_locks(func):
@@ -189,6 +191,114 @@ def test_get_users(app):
     assert r.status_code == 403
 
 
+def _add_grouped_users(app, prefix, n):
+    db = app.db
+    group = orm.Group.find(db, name='listing') or orm.Group(name='listing')
+    db.add(group)
+    for i in range(n):
+        user = add_user(db, app=app, name='%s-%i' % (prefix, i))
+        group.users.append(user.orm_user)
+    db.commit()
+
+
+def test_get_users_query_count(app):
+    _add_grouped_users(app, 'cornelius', 10)
+    api_request(app, 'users')
+    with count_queries(app) as before:
+        r = api_request(app, 'users')
+        assert r.status_code == 200
+    _add_grouped_users(app, 'ebenezer', 20)
+    api_request(app, 'users')
+    with count_queries(app) as after:
+        r = api_request(app, 'users')
+        assert r.status_code == 200
+    names = { model['name'] for model in r.json() }
+    assert 'ebenezer-19' in names
+    # listing 20 more users doesn't issue more queries
+    # (with some slack for the Hub's periodic tasks)
+    assert len(after) < len(before) + 10
+    app.db.delete(orm.Group.find(app.db, name='listing'))
+    app.db.commit()
+
+
+def test_get_users_paginated(app):
+    db = app.db
+    for i in range(5):
+        add_user(db, app=app, name='paged-%i' % i)
+    r = api_request(app, 'users')
+    assert r.status_code == 200
+    all_names = [ model['name'] for model in r.json() ]
+
+    # page size is independent of the streamed chunk size
+    with mock.patch.object(UserListAPIHandler, 'page_size', 2):
+        names = []
+        offset = 0
+        while True:
+            r = api_request(app, 'users?offset=%i&limit=3' % offset)
+            assert r.status_code == 200
+            page = [ model['name'] for model in r.json() ]
+            assert len(page) <= 3
+            names.extend(page)
+            offset += 3
+            if len(page) < 3:
+                break
+    assert names == all_names
+
+    # paging by cursor, following the Link header
+    with mock.patch.object(UserListAPIHandler, 'page_size', 2):
+        names = []
+        path = 'users?limit=2&state=stopped'
+        while path:
+            r = api_request(app, path)
+            assert r.status_code == 200
+            page = [ model['name'] for model in r.json() ]
+            assert 0 < len(page) <= 2
+            names.extend(page)
+            link = r.headers.get('Link')
+            if link:
+                assert link.endswith('>; rel="next"')
+                url = link[1:].split('>', 1)[0]
+                assert 'state=stopped' in url
+                path = url.split('/api/', 1)[1]
+            else:
+                path = None
+    stopped = [ model['name'] for model in api_request(app, 'users?state=stopped').json() ]
+    assert names == stopped
+    # no next link when the limit takes exactly the rest of the users
+    r = api_request(app, 'users?limit=%i' % len(all_names))
+    assert 'Link' not in r.headers
+    r = api_request(app, 'users?limit=%i' % (len(all_names) - 1))
+    assert 'Link' in r.headers
+    r = api_request(app, 'users')
+    assert 'Link' not in r.headers
+
+    # state filters partition the user list
+    by_state = {}
+    for state in ('running', 'pending', 'stopped'):
+        r = api_request(app, 'users?state=%s' % state)
+        assert r.status_code == 200
+        by_state[state] = r.json()
+    for model in by_state['running']:
+        assert model['server'] and not model['pending']
+    for model in by_state['stopped']:
+        assert not model['server'] and not model['pending']
+    assert sorted(
+        model['name'] for models in by_state.values() for model in models
+    ) == sorted(all_names)
+
+    user = find_user(db, 'paged-3')
+    user.last_activity = datetime(2000, 1, 1)
+    db.commit()
+    r = api_request(app, 'users?last_activity_before=2001-01-01T00:00:00Z')
+    assert r.status_code == 200
+    assert [ model['name'] for model in r.json() ] == ['paged-3']
+
+    for query in ('offset=-1', 'limit=0', 'limit=x', 'state=asleep', 'last_activity_before=yesterday',
+            'after=x', 'offset=1&after=1'):
+        r = api_request(app, 'users?' + query)
+        assert r.status_code == 400
+
+
 @mark.user
 def test_add_user(app):
     db = app.db
@@ -509,6 +619,13 @@ def test_cookie(app):
     r.raise_for_status()
     reply = r.json()
     assert reply['name'] == name
+    # the reply has a fresh identity, signed for this server
+    key = app.identity_key(user.server.cookie_name)
+    identity = verify_identity(reply['identity'], key, cookie)
+    assert identity == {'name': name, 'admin': False, 'groups': []}
+    assert verify_identity(reply['identity'], app.identity_key('jupyterhub-services'), cookie) is None
+    # login sets the identity cookie with the server's login cookie
+    assert verify_identity(cookies[user.server.cookie_name + '-identity'], key, cookie) == identity
 
     # deprecated cookie in body:
     r = api_request(app, 'authorizations/cookie', user.server.cookie_name, data=cookie)
@@ -517,6 +634,104 @@ def test_cookie(app):
     assert reply['name'] == name
 
 
+def test_cookie_cache(app):
+    db = app.db
+    name = 'wilhelmina'
+    user = add_user(db, app=app, name=name)
+    cookies = app.login_user(name)
+    cookie_name = app.hub.server.cookie_name
+    cookie = quote(cookies[cookie_name][1:-1], safe='')
+    orm.User.cookie_cache.clear()
+    r = api_request(app, 'authorizations/cookie', cookie_name, cookie)
+    r.raise_for_status()
+    assert r.json()['name'] == name
+    assert len(orm.User.cookie_cache) == 1
+
+    # cached: no signature check
+    with mock.patch('tornado.web.decode_signed_value', side_effect=AssertionError("not cached")):
+        r = api_request(app, 'authorizations/cookie', cookie_name, cookie)
+    r.raise_for_status()
+    assert r.json()['name'] == name
+
+    # resetting cookie_id invalidates existing cookies
+    user.cookie_id = 'new-cookie-id'
+    db.commit()
+    assert len(orm.User.cookie_cache) == 0
+    r = api_request(app, 'authorizations/cookie', cookie_name, cookie)
+    assert r.status_code == 404
+
+
+def test_service_identity(app, io_loop):
+    names = ['identity-a', 'identity-b']
+    app.services = [ {
+        'name': name,
+        'api_token': 'token-%s' % name,
+        'url': 'http://127.0.0.1:%i' % random_port(),
+    } for name in names ]
+    app.init_services()
+    io_loop.run_sync(app.init_api_tokens)
+    try:
+        keys = { name: app.identity_key(service_identity_name(name)) for name in names }
+        assert keys['identity-a'] != keys['identity-b']
+        add_user(app.db, app=app, name='shepherd')
+        cookies = app.login_user('shepherd')
+        cookie = cookies['jupyterhub-services'][1:-1]
+
+        # each service gets an identity cookie that only its key verifies
+        identity_a = cookies['jupyterhub-services-identity-a-identity']
+        assert verify_identity(identity_a, keys['identity-a'], cookie)['name'] == 'shepherd'
+        assert verify_identity(identity_a, keys['identity-b'], cookie) is None
+
+        # a refreshed identity is signed for the service that asked
+        r = api_request(app, 'authorizations/cookie', 'jupyterhub-services', quote(cookie, safe=''),
+            headers={'Authorization': 'token token-identity-b'},
+        )
+        r.raise_for_status()
+        identity_b = r.json()['identity']
+        assert verify_identity(identity_b, keys['identity-b'], cookie)['name'] == 'shepherd'
+        assert verify_identity(identity_b, keys['identity-a'], cookie) is None
+        # other callers get no identity for the shared services cookie
+        r = api_request(app, 'authorizations/cookie', 'jupyterhub-services', quote(cookie, safe=''))
+        r.raise_for_status()
+        assert 'identity' not in r.json()
+    finally:
+        app.services = []
+        app.init_services()
+
+
+def test_batch_authorizations(app):
+    db = app.db
+    cookie_name = app.hub.server.cookie_name
+    cookies = []
+    for name in ('sheppard', 'tracey'):
+        add_user(db, app=app, name=name)
+        cookies.append(app.login_user(name)[cookie_name][1:-1])
+    token = find_user(db, 'tracey').new_api_token()
+    orm.User.cookie_cache.clear()
+
+    r = api_request(app, 'authorizations/batch', method='post', data=json.dumps({
+        'cookies': [ {'name': cookie_name, 'value': c} for c in cookies + ['nothintoseehere'] ],
+        'tokens': [token, 'not-a-token'],
+    }))
+    r.raise_for_status()
+    reply = r.json()
+    assert [ model and model['name'] for model in reply['cookies'] ] == ['sheppard', 'tracey', None]
+    assert [ model and model['name'] for model in reply['tokens'] ] == ['tracey', None]
+
+    # verified cookies are cached
+    assert len(orm.User.cookie_cache) == 2
+
+    r = api_request(app, 'authorizations/batch', method='post', data=json.dumps({
+        'cookies': ['not-a-dict'],
+    }))
+    assert r.status_code == 400
+
+    r = api_request(app, 'authorizations/batch', method='post', data='{}',
+        headers={'Authorization': 'token not-a-token'},
+    )
+    assert r.status_code == 403
+
+
 def test_token(app):
     name = 'book'
     user = add_user(app.db, app=app, name=name)
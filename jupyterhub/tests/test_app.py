@@ -1,6 +1,7 @@
 """Test the JupyterHub entry point"""
 
 import binascii
+from datetime import datetime
 import os
 import re
 import sys
@@ -90,6 +91,45 @@ def test_init_tokens(io_loop):
         assert orm.User.find(app.db, 'gman') is None
 
 
+def test_init_tokens_bulk(io_loop):
+    with TemporaryDirectory() as td:
+        db_file = os.path.join(td, 'jupyterhub.sqlite')
+        # enough tokens to need more than one query
+        tokens = { 'bulk-token-%04i' % i: 'user%i' % (i % 10) for i in range(600) }
+        app = MockHub(db_url=db_file, api_tokens=tokens)
+        io_loop.run_sync(lambda : app.initialize([]))
+        db = app.db
+        assert db.query(orm.APIToken).count() == 600
+        assert db.query(orm.User).filter(orm.User.name.like('user%')).count() == 10
+        for token in ['bulk-token-0000', 'bulk-token-0599']:
+            assert orm.APIToken.find(db, token).user.name == tokens[token]
+
+        # a token stored with the salted scheme
+        with patch.object(orm.APIToken, 'hash_key', None):
+            orm.User.find(db, 'user0').new_api_token('legacy-token-0000')
+
+        # reloading doesn't duplicate tokens, old or new
+        tokens['legacy-token-0000'] = 'user0'
+        tokens['fresh-token-0000'] = 'user10'
+        app = MockHub(db_url=db_file, api_tokens=tokens)
+        io_loop.run_sync(lambda : app.initialize([]))
+        db = app.db
+        assert db.query(orm.APIToken).count() == 602
+        assert orm.APIToken.find(db, 'fresh-token-0000').user.name == 'user10'
+
+        # expired tokens are renewed, not duplicated
+        orm.APIToken.find(db, 'bulk-token-0000').expires_at = datetime.utcnow()
+        orm.APIToken.find(db, 'legacy-token-0000').expires_at = datetime.utcnow()
+        db.commit()
+        assert orm.APIToken.find(db, 'bulk-token-0000') is None
+        app = MockHub(db_url=db_file, api_tokens=tokens)
+        io_loop.run_sync(lambda : app.initialize([]))
+        db = app.db
+        assert db.query(orm.APIToken).count() == 602
+        for token in ['bulk-token-0000', 'legacy-token-0000']:
+            assert orm.APIToken.find(db, token).user.name == tokens[token]
+
+
 def test_write_cookie_secret(tmpdir):
     secret_path = str(tmpdir.join('cookie_secret'))
     hub = MockHub(cookie_secret_file=secret_path)
@@ -140,6 +180,36 @@ def test_cookie_secret_env(tmpdir):
     assert not os.path.exists(hub.cookie_secret_file)
 
 
+def test_api_token_hash_key(tmpdir):
+    key_path = str(tmpdir.join('api_token_hash_key'))
+    hub = MockHub(
+        cookie_secret_file=str(tmpdir.join('cookie_secret')),
+        api_token_hash_key_file=key_path,
+    )
+    hub.init_secrets()
+    assert os.path.exists(key_path)
+    assert not os.stat(key_path).st_mode & 0o177
+    key = hub.api_token_hash_key
+    assert key and key != hub.cookie_secret
+
+    # rotating the cookie secret keeps the token key
+    os.remove(hub.cookie_secret_file)
+    hub = MockHub(
+        cookie_secret_file=str(tmpdir.join('cookie_secret')),
+        api_token_hash_key_file=key_path,
+    )
+    hub.init_secrets()
+    assert hub.api_token_hash_key == key
+
+    with patch.dict(os.environ, {'JUPYTERHUB_API_TOKEN_HASH_KEY': 'abc123'}):
+        hub = MockHub(
+            cookie_secret_file=str(tmpdir.join('cookie_secret')),
+            api_token_hash_key_file=key_path,
+        )
+        hub.init_secrets()
+    assert hub.api_token_hash_key == binascii.a2b_hex('abc123')
+
+
 def test_load_groups(io_loop):
     to_load = {
         'blue': ['cyclops', 'rogue', 'wolverine'],
@@ -156,3 +226,20 @@ def test_load_groups(io_loop):
     gold = orm.Group.find(db, name='gold')
     assert gold is not None
     assert sorted([ u.name for u in gold.users ]) == sorted(to_load['gold'])
+
+
+def test_sqlite_pragmas(tmpdir):
+    hub = MockHub(
+        db_url='sqlite:///' + str(tmpdir.join('jupyterhub.sqlite')),
+        sqlite_journal_mode='WAL',
+        sqlite_synchronous='normal',
+        sqlite_cache_size=-4000,
+        sqlite_mmap_size=2**20,
+    )
+    hub.init_db()
+    db = hub.db
+    assert db.execute('PRAGMA journal_mode').scalar() == 'wal'
+    # 1 is NORMAL
+    assert db.execute('PRAGMA synchronous').scalar() == 1
+    assert db.execute('PRAGMA cache_size').scalar() == -4000
+    assert db.execute('PRAGMA mmap_size').scalar() == 2**20
@@ -2,6 +2,7 @@ from glob import glob
 import os
 import shutil
 
+from sqlalchemy import create_engine, inspect
 from sqlalchemy.exc import OperationalError
 from pytest import raises
 
@@ -24,6 +25,39 @@ def test_upgrade(tmpdir):
     print(db_url)
     upgrade(db_url)
 
+def test_upgrade_token_fingerprint(tmpdir):
+    db_url = generate_old_db(str(tmpdir))
+    engine = create_engine(db_url)
+    engine.execute(
+        "INSERT INTO api_tokens (hashed, prefix) VALUES"
+        " ('hmac-sha256:abc123', 'abcd'),"
+        " ('sha512:16384:0123:def456', 'defg')"
+    )
+    upgrade(db_url)
+    rows = engine.execute("SELECT prefix, fingerprint FROM api_tokens ORDER BY prefix").fetchall()
+    assert [ tuple(row) for row in rows ] == [
+        ('abcd', 'abc123'),
+        ('defg', None),
+    ]
+
+
+def test_upgrade_user_indexes(tmpdir):
+    db_url = generate_old_db(str(tmpdir))
+    upgrade(db_url)
+    indexes = { index['name'] for index in inspect(create_engine(db_url)).get_indexes('users') }
+    assert {'ix_users_cookie_id', 'ix_users_last_activity'}.issubset(indexes)
+
+
+def test_upgrade_token_server(tmpdir):
+    db_url = generate_old_db(str(tmpdir))
+    upgrade(db_url)
+    foreign_keys = inspect(create_engine(db_url)).get_foreign_keys('api_tokens')
+    assert any(
+        fk['constrained_columns'] == ['server_id'] and fk['referred_table'] == 'servers'
+        for fk in foreign_keys
+    )
+
+
 def test_upgrade_entrypoint(tmpdir, io_loop):
     generate_old_db(str(tmpdir))
     tmpdir.chdir()
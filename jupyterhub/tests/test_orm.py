@@ -3,11 +3,18 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+import threading
+from unittest import mock
+
 import pytest
 from tornado import gen
+from tornado.httpclient import HTTPError
 
 from .. import orm
-from ..user import User
+from ..dbutil import CommitScheduler, DatabaseExecutor
+from ..user import User, UserDict
 from .mocking import MockSpawner
 
 
@@ -47,6 +54,45 @@ def test_proxy(db):
     assert proxy.auth_token == 'abc-123'
 
 
+def test_proxy_api_request(io_loop):
+    proxy = orm.Proxy(
+        auth_token='abc-123',
+        api_server=orm.Server(ip='127.0.0.1', port=8001),
+    )
+    proxy.log = mock.Mock()
+    proxy.statsd = mock.Mock()
+    proxy.api_retry_delay = 0
+    client = mock.Mock()
+    errors = [HTTPError(599), HTTPError(502)]
+    @gen.coroutine
+    def fetch(req):
+        assert req.headers['Authorization'] == 'token abc-123'
+        if errors:
+            raise errors.pop(0)
+        return 'ok'
+    client.fetch.side_effect = fetch
+    proxy.http_client_factory = lambda : client
+
+    # retried after connection errors and 5xx responses
+    assert io_loop.run_sync(lambda : proxy.api_request('/user/abc', method='POST')) == 'ok'
+    assert client.fetch.call_count == 3
+    assert [ c[0] for c in proxy.statsd.timing.call_args_list ] == [
+        ('proxy.api.post', mock.ANY) ] * 3
+
+    # but not more than api_retries times
+    errors[:] = [HTTPError(599)] * 3
+    with pytest.raises(HTTPError):
+        io_loop.run_sync(lambda : proxy.api_request('', method='GET'))
+    assert errors == []
+
+    # or for other errors
+    errors[:] = [HTTPError(404)]
+    client.fetch.reset_mock()
+    with pytest.raises(HTTPError):
+        io_loop.run_sync(lambda : proxy.api_request('/user/abc', method='DELETE'))
+    assert client.fetch.call_count == 1
+
+
 def test_hub(db):
     hub = orm.Hub(
         server=orm.Server(
@@ -167,6 +213,382 @@ def test_token_find(db):
     assert found is None
 
 
+def test_token_cache(db):
+    user = orm.User(name='jayne')
+    db.add(user)
+    db.commit()
+    token = user.new_api_token()
+    found = orm.APIToken.find(db, token)
+    assert found.user is user
+
+    # cached: no hash comparison on the second lookup
+    cache = orm.APIToken.cache
+    hits = cache.hits
+    with mock.patch.object(orm, 'compare_token', side_effect=AssertionError("not cached")):
+        assert orm.APIToken.find(db, token) is found
+        assert orm.APIToken.find(db, token, kind='user') is found
+        assert orm.APIToken.find(db, token, kind='service') is None
+    assert cache.hits == hits + 3
+
+    # deleting the token drops it from the cache
+    db.delete(found)
+    db.commit()
+    assert orm.APIToken.find(db, token) is None
+
+    # deleting the owner drops its tokens from the cache
+    token = user.new_api_token()
+    assert orm.APIToken.find(db, token) is not None
+    cached = len(cache)
+    assert cached >= 1
+    db.delete(user)
+    db.commit()
+    assert len(cache) == cached - 1
+    # the next lookup misses the cache
+    misses = cache.misses
+    orm.APIToken.find(db, token)
+    assert cache.misses == misses + 1
+
+
+def test_token_async(db, io_loop):
+    user = orm.User(name='simon')
+    db.add(user)
+    db.commit()
+    executor = ThreadPoolExecutor(2)
+    token = io_loop.run_sync(lambda : orm.APIToken.new_async(user=user, executor=executor))
+    assert any(t.match(token) for t in user.api_tokens)
+    orm.APIToken.cache.clear()
+    found = io_loop.run_sync(lambda : orm.APIToken.find_async(db, token, executor=executor))
+    assert found.user is user
+    found = io_loop.run_sync(lambda : orm.APIToken.find_async(db, token, kind='service', executor=executor))
+    assert found is None
+    found = io_loop.run_sync(lambda : orm.APIToken.find_async(db, 'not-a-token', executor=executor))
+    assert found is None
+    with pytest.raises(ValueError):
+        io_loop.run_sync(lambda : orm.APIToken.new_async(token=token, user=user, executor=executor))
+    executor.shutdown()
+
+
+def test_token_find_many(db, io_loop):
+    user = orm.User(name='river')
+    db.add(user)
+    db.commit()
+    with mock.patch.object(orm.APIToken, 'hash_key', None):
+        legacy_token = user.new_api_token()
+    token = user.new_api_token()
+    # another legacy token that none of the lookups can match
+    with mock.patch.object(orm.APIToken, 'hash_key', None):
+        other_token = user.new_api_token()
+    orm.APIToken.cache.clear()
+
+    tokens = [token, legacy_token, 'not-a-token']
+    compared = []
+    real_compare = orm.compare_token
+    def compare_token(hashed, token, **kwargs):
+        compared.append(token)
+        return real_compare(hashed, token, **kwargs)
+
+    with mock.patch.object(orm, 'compare_token', compare_token):
+        found = io_loop.run_sync(lambda : orm.APIToken.find_many_async(db, tokens))
+    assert found[token].match(token)
+    assert found[legacy_token].match(legacy_token)
+    assert 'not-a-token' not in found
+    # only legacy tokens with a submitted prefix are compared
+    assert other_token not in compared
+    assert legacy_token in compared
+
+    # found tokens are cached
+    with mock.patch.object(orm, 'compare_token', side_effect=AssertionError("not cached")):
+        again = io_loop.run_sync(lambda : orm.APIToken.find_many_async(db, [token, legacy_token]))
+    assert again == {token: found[token], legacy_token: found[legacy_token]}
+
+
+def test_token_hmac_upgrade(db):
+    user = orm.User(name='wash')
+    db.add(user)
+    db.commit()
+    with mock.patch.object(orm.APIToken, 'hash_key', None):
+        legacy_token = user.new_api_token()
+        orm_token = orm.APIToken.find(db, legacy_token)
+    assert orm_token.hashed.startswith('sha512:')
+
+    with mock.patch.multiple(orm.APIToken, hash_key=b'hub-secret', commit_scheduler=None):
+        token = user.new_api_token()
+        found = orm.APIToken.find(db, token)
+        assert found.hashed.startswith('hmac-sha256:')
+        assert found.match(token)
+        assert not found.match(legacy_token)
+
+        assert found.fingerprint == found.hashed.split(':')[1]
+
+        # legacy hash is rewritten on first match
+        orm.APIToken.cache.clear()
+        assert orm_token.fingerprint is None
+        found = orm.APIToken.find(db, legacy_token)
+        assert found is orm_token
+        assert found.hashed.startswith('hmac-sha256:')
+        # after which it is found by fingerprint alone
+        assert orm.APIToken._find_candidates(db, legacy_token, None) == [orm_token]
+        orm.APIToken.cache.clear()
+        assert orm.APIToken.find(db, legacy_token) is orm_token
+        # the caller commits the new hash
+        db.commit()
+
+    # hmac hashes never match without the key
+    with mock.patch.object(orm.APIToken, 'hash_key', b'different-secret'):
+        assert not orm_token.match(legacy_token)
+
+
+def test_token_hmac_upgrade_scheduled(db):
+    user = orm.User(name='saffron')
+    db.add(user)
+    db.commit()
+    with mock.patch.object(orm.APIToken, 'hash_key', None):
+        legacy_token = user.new_api_token()
+    scheduler = CommitScheduler(lambda : db, interval=60)
+    with mock.patch.multiple(orm.APIToken, hash_key=b'hub-secret', commit_scheduler=scheduler):
+        orm.APIToken.cache.clear()
+        orm_token = orm.APIToken.find(db, legacy_token)
+        # the new hash is queued, not written mid-lookup
+        assert orm_token.hashed.startswith('sha512:')
+        assert not db.dirty
+        assert scheduler.pending == 1
+        scheduler.flush()
+        db.refresh(orm_token)
+        assert orm_token.hashed.startswith('hmac-sha256:')
+        assert orm_token.fingerprint == orm_token.hashed.split(':')[1]
+        orm.APIToken.cache.clear()
+        assert orm.APIToken.find(db, legacy_token) is orm_token
+        assert scheduler.pending == 0
+
+
+def test_token_expiry(db):
+    user = orm.User(name='book')
+    db.add(user)
+    db.commit()
+    token = user.new_api_token(expires_in=3600)
+    found = orm.APIToken.find(db, token)
+    assert found.user is user
+    assert not found.expired
+
+    # expired tokens are not found, cached or not
+    found.expires_at = datetime.utcnow() - timedelta(seconds=1)
+    db.commit()
+    assert found.expired
+    assert orm.APIToken.find(db, token) is None
+    orm.APIToken.cache.clear()
+    assert orm.APIToken.find(db, token) is None
+
+
+def test_token_reap(db):
+    # start clean, the db is shared with other tests
+    for kind in ('expired', 'ownerless'):
+        while orm.APIToken.reap(db, kind):
+            pass
+    user = orm.User(name='zoe')
+    db.add(user)
+    db.commit()
+    keep = user.new_api_token()
+    keep_expiring = user.new_api_token(expires_in=3600)
+    expired = [ user.new_api_token(expires_in=-1) for i in range(5) ]
+    orm_expired = [ orm.APIToken.find(db, t) for t in expired ]
+    assert orm_expired == [None] * 5
+
+    # reaped in batches
+    assert orm.APIToken.reap(db, 'expired', batch_size=3) == 3
+    assert orm.APIToken.reap(db, 'expired', batch_size=3) == 2
+    assert orm.APIToken.reap(db, 'expired', batch_size=3) == 0
+    assert orm.APIToken.find(db, keep).user is user
+    assert orm.APIToken.find(db, keep_expiring).user is user
+
+    # tokens are orphaned when their owner is deleted
+    other = orm.User(name='hoban')
+    db.add(other)
+    db.commit()
+    orphan = other.new_api_token()
+    orphan_id = orm.APIToken.find(db, orphan).id
+    db.delete(other)
+    db.commit()
+    assert orm.APIToken.reap(db, 'ownerless') == 1
+    assert db.query(orm.APIToken).get(orphan_id) is None
+    assert orm.APIToken.find(db, keep).user is user
+
+    # a server's token is reaped once it is no longer the user's server,
+    # even if the server's row is left behind
+    user.server = orm.Server()
+    db.commit()
+    server_token = orm.APIToken.new(user=user, server=user.server)
+    assert orm.APIToken.reap(db, 'ownerless') == 0
+    user.server = None
+    db.commit()
+    assert orm.APIToken.reap(db, 'ownerless') == 1
+    assert orm.APIToken.find(db, server_token) is None
+    assert orm.APIToken.find(db, keep).user is user
+
+    with pytest.raises(ValueError):
+        orm.APIToken.reap(db, 'everything')
+
+
+def test_user_lookup_indexes():
+    # cookie and activity lookups use indexes, not table scans.
+    # benchmarks/user_lookup.py times them.
+    db = orm.new_session_factory('sqlite:///:memory:')()
+
+    def query_plan(query):
+        sql = query.statement.compile(db.bind, compile_kwargs={'literal_binds': True})
+        return ' '.join(row[-1] for row in db.execute('EXPLAIN QUERY PLAN %s' % sql))
+
+    find_by_cookie = db.query(orm.User).filter(orm.User.cookie_id == 'cookie')
+    assert 'USING INDEX ix_users_cookie_id' in query_plan(find_by_cookie)
+    most_recent = db.query(orm.User).order_by(orm.User.last_activity.desc()).limit(1)
+    assert 'USING INDEX ix_users_last_activity' in query_plan(most_recent)
+
+
+def test_user_dict_names(db):
+    users = UserDict(lambda : db, {
+        'spawner_class': MockSpawner,
+        'config': None,
+    })
+    orm_user = orm.User(name='jayne')
+    db.add(orm_user)
+    db.commit()
+
+    user = users['jayne']
+    assert user.id == orm_user.id
+    # subsequent lookups by name don't hit the db
+    with mock.patch.object(db, 'query', side_effect=AssertionError("queried db")):
+        assert users['jayne'] is user
+
+    # rename
+    user.name = 'cobb'
+    db.commit()
+    with pytest.raises(KeyError):
+        users['jayne']
+    assert users['cobb'] is user
+    with mock.patch.object(db, 'query', side_effect=AssertionError("queried db")):
+        assert users['cobb'] is user
+
+    # delete
+    del users['cobb']
+    assert 'cobb' not in users._name_index
+    with pytest.raises(KeyError):
+        users['cobb']
+
+
+def test_commit_scheduler(db, io_loop):
+    users = [ orm.User(name='zoe-%i' % i) for i in range(3) ]
+    db.add_all(users)
+    db.commit()
+    before = users[0].last_activity
+    statsd = mock.Mock()
+    scheduler = CommitScheduler(lambda : db, interval=0.1, statsd=statsd)
+    later = datetime.utcnow() + timedelta(hours=1)
+    with mock.patch.object(db, 'commit', wraps=db.commit) as commit:
+        for i, user in enumerate(users):
+            scheduler.update_soon(orm.User, user.id, last_activity=later)
+            scheduler.update_soon(orm.User, user.id, last_activity=later + timedelta(seconds=i))
+        assert scheduler.pending == 3
+        assert users[0].last_activity == before
+        io_loop.run_sync(lambda : gen.sleep(0.3))
+        # one commit for all of the updates
+        assert commit.call_count == 1
+    assert scheduler.pending == 0
+    assert [ user.last_activity for user in users ] == [
+        later + timedelta(seconds=i) for i in range(3)
+    ]
+    statsd.incr.assert_called_once_with('db.coalesced', 3)
+
+    # advances don't overwrite newer values committed after they were queued
+    older = later + timedelta(minutes=1)
+    newest = later + timedelta(minutes=2)
+    scheduler.advance_soon(orm.User, users[0].id, 'last_activity', older)
+    scheduler.advance_soon(orm.User, users[1].id, 'last_activity', older)
+    scheduler.advance_soon(orm.User, users[1].id, 'last_activity', later)
+    users[0].last_activity = newest
+    db.commit()
+    assert scheduler.pending == 2
+    scheduler.flush()
+    db.expire_all()
+    assert users[0].last_activity == newest
+    assert users[1].last_activity == older
+    assert users[2].last_activity == later + timedelta(seconds=2)
+
+    # commits are timed
+    session_factory = orm.new_session_factory()
+    scheduler = CommitScheduler(session_factory, session_factory=session_factory, statsd=statsd)
+    session = session_factory()
+    session.add(orm.User(name='zoe'))
+    session.commit()
+    name, ms = statsd.timing.call_args[0]
+    assert name == 'db.commit'
+    assert ms >= 0
+
+
+def test_commit_scheduler_own_session(tmpdir, io_loop):
+    session_factory = orm.new_session_factory('sqlite:///' + str(tmpdir.join('jupyterhub.sqlite')))
+    db = session_factory()
+    user = orm.User(name='inara')
+    db.add(user)
+    db.commit()
+    scheduler_db = session_factory()
+    log = mock.Mock()
+    scheduler = CommitScheduler(lambda : scheduler_db, log=log)
+
+    # a failed flush doesn't roll back the request session
+    db.add(orm.User(name='book'))
+    scheduler.update_soon(orm.User, user.id, name='kaylee')
+    scheduler.advance_soon(orm.User, user.id, 'no_such_column', datetime.utcnow())
+    scheduler.flush()
+    assert scheduler.pending == 0
+    msg, count, dropped = log.error.call_args[0]
+    assert count == 2
+    assert dropped == 'User %i (name), User %i (no_such_column)' % (user.id, user.id)
+    db.commit()
+    assert orm.User.find(db, 'book') is not None
+    assert user.name == 'inara'
+
+    # successful writes are seen by the request session once it expires
+    scheduler.advance_soon(orm.User, user.id, 'last_activity', datetime(2100, 1, 1))
+    scheduler.flush()
+    db.expire_all()
+    assert user.last_activity == datetime(2100, 1, 1)
+
+
+def test_database_executor(tmpdir, io_loop):
+    session_factory = orm.new_session_factory('sqlite:///' + str(tmpdir.join('jupyterhub.sqlite')))
+    db = session_factory()
+    user = orm.User(name='malcolm')
+    db.add(user)
+    db.commit()
+    token = user.new_api_token()
+    db_executor = DatabaseExecutor(session_factory)
+
+    def find(db, name):
+        return threading.get_ident(), db.query(orm.User.id).filter(orm.User.name==name).scalar()
+    thread_id, user_id = io_loop.run_sync(lambda : db_executor.run(find, 'malcolm'))
+    assert thread_id != threading.get_ident()
+    assert user_id == user.id
+
+    # uncommitted writes are rolled back
+    def rename(db):
+        db.query(orm.User).filter(orm.User.id==user_id).first().name = 'mal'
+        db.flush()
+        raise ValueError("oops")
+    with pytest.raises(ValueError):
+        io_loop.run_sync(lambda : db_executor.run(rename))
+    _, found = io_loop.run_sync(lambda : db_executor.run(find, 'mal'))
+    assert found is None
+
+    # token candidates are queried on the db executor
+    orm.APIToken.cache.clear()
+    executor = ThreadPoolExecutor(1)
+    found = io_loop.run_sync(lambda : orm.APIToken.find_async(db, token,
+        executor=executor, db_executor=db_executor))
+    assert found.user is user
+    executor.shutdown()
+    db_executor.shutdown()
+    db.close()
+
+
 def test_spawn_fails(db, io_loop):
     orm_user = orm.User(name='aeofel')
     db.add(orm_user)
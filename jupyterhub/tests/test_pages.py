@@ -1,15 +1,18 @@
 """Tests for HTML pages"""
 
+import re
+import threading
 from urllib.parse import urlencode, urlparse
 
 import requests
+from tornado.web import decode_signed_value
 
-from ..utils import url_path_join as ujoin
+from ..utils import url_path_join as ujoin, LRUCache
 from .. import orm
 
 import mock
-from .mocking import FormSpawner, public_url, public_host
-from .test_api import api_request
+from .mocking import FormSpawner, public_url, public_host, count_queries
+from .test_api import api_request, _add_grouped_users
 
 def get_page(path, app, hub=True, **kw):
     if hub:
@@ -59,6 +62,29 @@ def test_home_auth(app):
     r.raise_for_status()
     assert r.url.endswith('home')
 
+def test_home_auth_db_executor(app):
+    # the test Hub's db is a file, so cookies are looked up on the db_executor's thread
+    assert not app.db_url.endswith(':memory:')
+    cookies = app.login_user('river')
+    run = app.db_executor.run
+    threads = []
+    def spy_run(func, *args, **kwargs):
+        def spy(db, *a, **kw):
+            threads.append(threading.get_ident())
+            return func(db, *a, **kw)
+        return run(spy, *args, **kwargs)
+
+    decode = mock.Mock(wraps=decode_signed_value)
+    # without a cookie cache, the cookie is still only verified once
+    with mock.patch.object(orm.User, 'cookie_cache', LRUCache(max_size=0)), \
+            mock.patch.object(app.db_executor, 'run', spy_run), \
+            mock.patch('tornado.web.decode_signed_value', decode):
+        r = get_page('home', app, cookies=cookies)
+    r.raise_for_status()
+    assert r.url.endswith('home')
+    assert threads and app._thread.ident not in threads
+    assert decode.call_count == 1
+
 def test_admin_no_auth(app):
     r = get_page('admin', app)
     assert r.status_code == 403
@@ -78,6 +104,49 @@ def test_admin(app):
     assert r.url.endswith('/admin')
 
 
+def test_admin_query_count(app):
+    cookies = app.login_user('river')
+    _add_grouped_users(app, 'fiona', 10)
+    get_page('admin?limit=1000', app, cookies=cookies)
+    with count_queries(app) as before:
+        r = get_page('admin?limit=1000', app, cookies=cookies)
+        r.raise_for_status()
+    _add_grouped_users(app, 'gerard', 20)
+    get_page('admin?limit=1000', app, cookies=cookies)
+    with count_queries(app) as after:
+        r = get_page('admin?limit=1000', app, cookies=cookies)
+        r.raise_for_status()
+    assert 'gerard-19' in r.text
+    # listing 20 more users doesn't issue more queries
+    # (with some slack for the Hub's periodic tasks)
+    assert len(after) < len(before) + 10
+    app.db.delete(orm.Group.find(app.db, name='listing'))
+    app.db.commit()
+
+
+def test_admin_paginated(app):
+    cookies = app.login_user('river')
+    r = get_page('admin?limit=1000', app, cookies=cookies)
+    r.raise_for_status()
+    all_names = re.findall(r'data-user="([^"]+)"', r.text)
+    assert 'Users 1&ndash;' not in r.text
+    assert 'User (%i)' % len(all_names) in r.text
+
+    names = []
+    for offset in range(0, len(all_names), 7):
+        r = get_page('admin?sort=name&order=desc&offset=%i&limit=7' % offset, app, cookies=cookies)
+        r.raise_for_status()
+        page = re.findall(r'data-user="([^"]+)"', r.text)
+        assert len(page) == min(7, len(all_names) - offset)
+        assert 'Users %i&ndash;%i of %i' % (offset + 1, offset + len(page), len(all_names)) in r.text
+        names.extend(page)
+    assert names == sorted(all_names, reverse=True)
+
+    for query in ('offset=-1', 'limit=0', 'limit=x'):
+        r = get_page('admin?' + query, app, cookies=cookies)
+        assert r.status_code == 400
+
+
 def test_spawn_redirect(app, io_loop):
     name = 'wash'
     cookies = app.login_user(name)
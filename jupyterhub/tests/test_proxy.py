@@ -1,15 +1,27 @@
 """Test a proxy being started before the Hub"""
 
+from datetime import datetime, timedelta
 import json
 import os
 from queue import Queue
+from unittest import mock
 from subprocess import Popen
 from urllib.parse import urlparse, unquote
 
+import pytest
+from tornado import gen, web
+from tornado.httpclient import AsyncHTTPClient, HTTPError
+from tornado.websocket import WebSocketHandler, websocket_connect
+
 from .. import orm
+from ..proxy import TornadoProxy
+from ..routetable import Route, RouteTable
 from .mocking import MockHub
 from .test_api import api_request
-from ..utils import wait_for_http_server, url_path_join as ujoin
+from ..utils import (
+    wait_for_http_server, url_path_join as ujoin, random_port,
+    parse_iso8601, ISO8601_ms, ISO8601_s,
+)
 
 def test_external_proxy(request, io_loop):
     """Test a proxy started before the Hub"""
@@ -154,4 +166,279 @@ def test_patch_proxy_bad_req(app):
     assert r.status_code == 400
     r = api_request(app, 'proxy', method='patch', data=json.dumps([]))
     assert r.status_code == 400
-    
\ No newline at end of file
+    
+
+def test_update_last_activity(app, io_loop):
+    r = api_request(app, 'users/kaylee', method='post')
+    r.raise_for_status()
+    r = api_request(app, 'users/kaylee/server', method='post')
+    r.raise_for_status()
+    db = app.db
+    kaylee = orm.User.find(db, 'kaylee')
+    kaylee.last_activity = datetime(2000, 1, 1)
+    db.commit()
+    routes = io_loop.run_sync(app.proxy.get_routes)
+    route = [ route for route in routes.values() if route.get('user') == 'kaylee' ][0]
+    io_loop.run_sync(app.update_last_activity)
+    app.commit_scheduler.flush()
+    db.expire_all()
+    assert kaylee.last_activity >= parse_iso8601(route['last_activity'])
+
+
+def test_parse_iso8601():
+    assert parse_iso8601('2017-03-04T05:06:07Z') == datetime(2017, 3, 4, 5, 6, 7)
+    assert parse_iso8601('2017-03-04T05:06:07.089Z') == datetime(2017, 3, 4, 5, 6, 7, 89000)
+    for stamp in ('2017-03-04T05:06:07.089Z', '2017-03-04T05:06:07Z'):
+        fmt = ISO8601_ms if '.' in stamp else ISO8601_s
+        assert parse_iso8601(stamp) == datetime.strptime(stamp, fmt)
+    for bad in ('2017-03-04', '2017-03-04T05:06:07', '2017-03-04 05:06:07Z', '2017-03-04T05:06:07.xZ'):
+        with pytest.raises(ValueError):
+            parse_iso8601(bad)
+
+
+def test_check_routes_diff(app, io_loop):
+    proxy = app.proxy
+    r = api_request(app, 'users/inara', method='post')
+    r.raise_for_status()
+    r = api_request(app, 'users/inara/server', method='post')
+    r.raise_for_status()
+    inara = app.users[orm.User.find(app.db, 'inara')]
+    # nothing to do
+    counts = io_loop.run_sync(lambda : proxy.check_routes(app.users, app._service_map))
+    assert counts == {'added': 0, 'removed': 0, 'retargeted': 0}
+
+    # stale target, e.g. from before a respawn,
+    # and a route for a user that isn't running
+    routes = io_loop.run_sync(proxy.get_routes)
+    inara_prefix = unquote(inara.proxy_path).rstrip('/')
+    routes[inara_prefix]['target'] = 'http://127.0.0.1:1'
+    stale_path = ujoin(app.base_url, 'user/nobody')
+    io_loop.run_sync(lambda : proxy.api_request(stale_path, method='POST',
+        body={'target': 'http://127.0.0.1:2', 'user': 'nobody'}))
+    routes[unquote(stale_path)] = {'target': 'http://127.0.0.1:2', 'user': 'nobody'}
+
+    counts = io_loop.run_sync(lambda : proxy.check_routes(app.users, app._service_map, routes))
+    assert counts == {'added': 0, 'removed': 1, 'retargeted': 1}
+    routes = io_loop.run_sync(proxy.get_routes)
+    assert routes[inara_prefix]['target'] == inara.server.host
+    assert unquote(stale_path) not in routes
+
+
+def test_add_all_users_bounded(app, io_loop):
+    proxy = app.proxy
+    names = ['mal', 'jayne', 'wash']
+    for name in names:
+        r = api_request(app, 'users/%s' % name, method='post')
+        r.raise_for_status()
+        r = api_request(app, 'users/%s/server' % name, method='post')
+        r.raise_for_status()
+    db = app.db
+    for name in names:
+        orm.User.find(db, name).last_activity = datetime(2000, 1, 1)
+    orm.User.find(db, 'wash').last_activity = datetime.utcnow()
+    db.commit()
+
+    added = []
+    in_flight = {'now': 0, 'max': 0}
+    add_user = proxy.add_user
+    @gen.coroutine
+    def counting_add_user(user):
+        added.append(user.name)
+        in_flight['now'] += 1
+        in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        try:
+            yield add_user(user)
+        finally:
+            in_flight['now'] -= 1
+
+    proxy.add_user = counting_add_user
+    try:
+        io_loop.run_sync(lambda : proxy.add_all_users(app.users,
+            concurrency=2, active_since=datetime.utcnow() - timedelta(minutes=1)))
+    finally:
+        del proxy.add_user
+    assert in_flight['max'] == 2
+    assert added[0] == 'wash'
+    assert set(names).issubset(added)
+    routes = io_loop.run_sync(proxy.get_routes)
+    for name in names:
+        assert unquote(app.users[orm.User.find(db, name)].proxy_path).rstrip('/') in routes
+
+
+def test_replay_routes_priority_log(io_loop):
+    proxy = orm.Proxy()
+    # the first, prioritized item finishes last
+    delays = {'first': 0.2, 'second': 0, 'third': 0}
+    restored = []
+    @gen.coroutine
+    def add(name):
+        yield gen.sleep(delays[name])
+        restored.append(name)
+
+    def on_log(msg, *args):
+        if 'recently active' in msg:
+            logged.append(list(restored))
+
+    logged = []
+    with mock.patch.object(proxy, 'log') as log:
+        log.info.side_effect = on_log
+        io_loop.run_sync(lambda : proxy._replay_routes('user',
+            ['first', 'second', 'third'], add, concurrency=3, priority=2))
+    # logged once both prioritized items were restored
+    assert len(logged) == 1
+    assert {'first', 'second'}.issubset(logged[0])
+
+
+class EchoHandler(web.RequestHandler):
+    def get(self, *args):
+        self.write({
+            'name': self.settings['name'],
+            'uri': self.request.uri,
+            'forwarded_for': self.request.headers.get('X-Forwarded-For'),
+        })
+
+    post = get
+
+
+class StreamHandler(web.RequestHandler):
+    @gen.coroutine
+    def get(self):
+        for i in range(64):
+            self.write(b'x' * 16384)
+            yield self.flush()
+
+
+class EchoWebSocket(WebSocketHandler):
+    def open(self):
+        # sent as soon as upstream accepts, possibly before the proxy's client is open
+        self.write_message('%s: welcome' % self.settings['name'])
+
+    def on_message(self, message):
+        self.write_message('%s: %s' % (self.settings['name'], message))
+
+
+def _echo_server(name):
+    """Start an echo server, returning its orm.Server"""
+    server = orm.Server(proto='http', ip='127.0.0.1', port=random_port(), base_url='/')
+    web.Application([
+        (r'.*/ws', EchoWebSocket),
+        (r'.*/stream', StreamHandler),
+        (r'.*', EchoHandler),
+    ], name=name).listen(server.port, address=server.ip)
+    return server
+
+
+def test_tornado_proxy(io_loop):
+    hub = orm.Hub(server=_echo_server('hub'))
+    user_server = _echo_server('user')
+    proxy = orm.Proxy(public_server=orm.Server(proto='http', ip='127.0.0.1', port=random_port(), base_url='/'))
+    backend = proxy.backend = TornadoProxy(proxy=proxy, hub=hub)
+    client = AsyncHTTPClient()
+
+    @gen.coroutine
+    def fetch_json(path, **kwargs):
+        resp = yield client.fetch(proxy.public_server.url.rstrip('/') + path, **kwargs)
+        return json.loads(resp.body.decode('utf8'))
+
+    @gen.coroutine
+    def test():
+        yield backend.start()
+        yield proxy.add_route('/user/river%40serenity', user_server.host,
+            {'user': 'river@serenity', 'server_name': 'lab'},
+        )
+        routes = yield proxy.get_routes()
+        assert sorted(routes) == ['/', '/user/river@serenity']
+        # all of a route's data is kept
+        assert routes['/user/river@serenity']['user'] == 'river@serenity'
+        assert routes['/user/river@serenity']['server_name'] == 'lab'
+        assert routes['/user/river@serenity']['target'] == user_server.host
+        before = parse_iso8601(routes['/user/river@serenity']['last_activity'])
+
+        # longest prefix wins
+        model = yield fetch_json('/user/river%40serenity/tree?x=1')
+        assert model['name'] == 'user'
+        assert model['uri'] == '/user/river%40serenity/tree?x=1'
+        assert model['forwarded_for'] == '127.0.0.1'
+        model = yield fetch_json('/user/river%40serenity', method='POST', body='')
+        assert model['name'] == 'user'
+        model = yield fetch_json('/user/riverside/tree')
+        assert model['name'] == 'hub'
+        routes = yield proxy.get_routes()
+        assert parse_iso8601(routes['/user/river@serenity']['last_activity']) > before
+
+        # streamed responses are relayed in full
+        resp = yield client.fetch(proxy.public_server.url.rstrip('/') + '/user/river%40serenity/stream')
+        assert resp.body == b'x' * 16384 * 64
+
+        # websockets
+        ws_url = proxy.public_server.url.replace('http', 'ws', 1).rstrip('/') + '/user/river%40serenity/ws'
+        ws = yield websocket_connect(ws_url)
+        reply = yield ws.read_message()
+        assert reply == 'user: welcome'
+        ws.write_message('hello')
+        reply = yield ws.read_message()
+        assert reply == 'user: hello'
+        ws.close()
+
+        # routes to servers that aren't running
+        yield proxy.add_route('/user/river%40serenity', 'http://127.0.0.1:%i' % random_port(), {})
+        with pytest.raises(HTTPError) as exc:
+            yield fetch_json('/user/river%40serenity/tree')
+        assert exc.value.code == 503
+
+        yield proxy.delete_route('/user/river%40serenity/')
+        # client is deprecated and ignored
+        with pytest.warns(DeprecationWarning):
+            f = proxy.get_routes(client=client)
+        routes = yield f
+        assert sorted(routes) == ['/']
+        model = yield fetch_json('/user/river%40serenity/tree')
+        assert model['name'] == 'hub'
+        backend.stop()
+
+    io_loop.run_sync(test)
+
+
+def test_route_table():
+    table = RouteTable([Route('/', 'http://hub')])
+    table.add(Route('/user/zoe', 'http://zoe', user='zoe'))
+    table.add(Route('/user/zoe/other', 'http://other'))
+    table.add(Route('/services/cull', 'http://cull', service='cull'))
+    table.add(Route('/zoe.example.com/user/zoe', 'http://zoe-host', user='zoe'))
+    assert len(table) == 5
+    assert '/user/zoe' in table
+    assert '/user' not in table
+
+    def target(path, host=None):
+        return table.match(path, host).target
+
+    assert target('/user/zoe') == 'http://zoe'
+    assert target('/user/zoe/') == 'http://zoe'
+    assert target('/user/zoe/tree/other') == 'http://zoe'
+    assert target('/user/zoe/other/tree') == 'http://other'
+    assert target('/user/zoey/tree') == 'http://hub'
+    assert target('/services/cull/api') == 'http://cull'
+    assert target('/') == 'http://hub'
+    assert target('/user/zoe/tree', host='zoe.example.com') == 'http://zoe-host'
+    assert target('/user/zoe/tree', host='mal.example.com') == 'http://hub'
+    assert table.match('/user/zoe').user == 'zoe'
+
+    # replace a route
+    table.add(Route('/user/zoe/', 'http://zoe2', user='zoe'))
+    assert len(table) == 5
+    assert target('/user/zoe/tree') == 'http://zoe2'
+
+    # remove keeps longer and shorter prefixes
+    assert table.remove('/user/zoe').target == 'http://zoe2'
+    assert table.remove('/user/zoe') is None
+    assert len(table) == 4
+    assert target('/user/zoe/tree') == 'http://hub'
+    assert target('/user/zoe/other/tree') == 'http://other'
+    table.remove('/user/zoe/other')
+    # empty branches are pruned
+    assert sorted(table._root.children) == ['services', 'zoe.example.com']
+
+    table.replace([Route('/user/wash', 'http://wash', user='wash')])
+    assert len(table) == 1
+    assert sorted(route.prefix for route in table) == ['/user/wash']
+    assert table.match('/user/zoe') is None
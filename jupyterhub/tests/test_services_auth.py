@@ -1,4 +1,5 @@
 import json
+import os
 from queue import Queue
 import sys
 from threading import Thread
@@ -9,19 +10,21 @@ from pytest import raises
 import requests
 import requests_mock
 
+from tornado import gen
+from tornado.httpclient import AsyncHTTPClient
 from tornado.ioloop import IOLoop
 from tornado.httpserver import HTTPServer
 from tornado.web import RequestHandler, Application, authenticated, HTTPError
 
-from ..services.auth import _ExpiringDict, HubAuth, HubAuthenticated
-from ..utils import url_path_join
+from ..services.auth import HubAuth, HubAuthenticated
+from ..utils import url_path_join, random_port, LRUCache, sign_identity, verify_identity
 from .mocking import public_url
 
 # mock for sending monotonic counter way into the future
 monotonic_future = mock.patch('time.monotonic', lambda : sys.maxsize)
 
-def test_expiring_dict():
-    cache = _ExpiringDict(max_age=30)
+def test_cookie_cache():
+    cache = LRUCache(max_age=30)
     cache['key'] = 'cached value'
     assert 'key' in cache
     assert cache['key'] == 'cached value'
@@ -56,6 +59,35 @@ def test_expiring_dict():
         assert cache.get('key', 'default') == 'cached value'
 
 
+def test_cookie_cache_bounded():
+    cache = LRUCache(max_size=3, max_age=30)
+    for key in 'abc':
+        cache[key] = key
+    assert cache['a'] == 'a'
+    # least recently used is dropped when full
+    cache['d'] = 'd'
+    assert 'b' not in cache
+    assert len(cache) == 3
+
+    # expired entries are swept on insert, even if they are never looked up
+    cache = LRUCache(max_size=100, max_age=30)
+    for i in range(10):
+        cache['old-%i' % i] = i
+    with monotonic_future:
+        for i in range(10):
+            cache['new-%i' % i] = i
+        assert len(cache) == 10
+        assert all('new-%i' % i in cache for i in range(10))
+
+    assert cache['new-0'] == 0
+    assert cache.get('nokey') is None
+    stats = cache.stats
+    assert stats['hits'] == 1
+    assert stats['misses'] == 1
+    assert stats['evictions'] == 10
+    assert stats['size'] == 10
+
+
 def test_hub_auth():
     start = time.monotonic()
     auth = HubAuth(cookie_name='foo')
@@ -70,6 +102,7 @@ def test_hub_auth():
     # check cache
     user_model = auth.user_for_cookie('bar')
     assert user_model == mock_model
+    assert auth.cookie_cache_stats['hits'] == 1
 
     with requests_mock.Mocker() as m:
         m.get(url, status_code=404)
@@ -98,6 +131,140 @@ def test_hub_auth():
     assert exc_info.value.status_code == 500
 
 
+def test_hub_auth_batch():
+    auth = HubAuth(cookie_name='foo')
+    url = url_path_join(auth.api_url, "authorizations/batch")
+    auth.cookie_cache['cached'] = {'name': 'wash'}
+    with requests_mock.Mocker() as m:
+        m.post(url, text=json.dumps({
+            'cookies': [{'name': 'zoe'}, None],
+        }))
+        user_models = auth.users_for_cookies(['cached', 'good', 'bad', 'good'])
+        sent = m.request_history[0].json()
+    assert sent == {'cookies': [
+        {'name': 'foo', 'value': 'good'},
+        {'name': 'foo', 'value': 'bad'},
+    ]}
+    assert user_models == {
+        'cached': {'name': 'wash'},
+        'good': {'name': 'zoe'},
+        'bad': None,
+    }
+    # filled the cache
+    assert auth.user_for_cookie('good') == {'name': 'zoe'}
+
+    with requests_mock.Mocker() as m:
+        m.post(url, status_code=404)
+        with raises(HTTPError) as exc_info:
+            auth.users_for_cookies(['other'])
+    assert exc_info.value.status_code == 500
+
+
+def test_identity():
+    key = b'identity-key'
+    model = {'name': 'kaylee', 'admin': False, 'groups': ['mechanics']}
+    identity = sign_identity(model, key, 'login-cookie', max_age=60)
+    assert verify_identity(identity, key, 'login-cookie') == model
+    # wrong key, wrong cookie, tampered, or garbage
+    assert verify_identity(identity, b'other-key', 'login-cookie') is None
+    assert verify_identity(identity, key, 'other-cookie') is None
+    payload, signature = identity.split('.')
+    assert verify_identity(payload[:-2] + '.' + signature, key, 'login-cookie') is None
+    assert verify_identity('not-an-identity', key, 'login-cookie') is None
+    # expired
+    with mock.patch('time.time', lambda : sys.maxsize):
+        assert verify_identity(identity, key, 'login-cookie') is None
+
+
+def test_hub_auth_identity():
+    key = b'identity-key'
+    # the key is read from the environment set after import
+    with mock.patch.dict(os.environ, {'JUPYTERHUB_IDENTITY_KEY': key.hex()}):
+        auth = HubAuth(cookie_name='foo')
+        assert auth.identity_key == key.hex()
+    model = {'name': 'inara', 'admin': True, 'groups': []}
+
+    class Handler(object):
+        def __init__(self, cookies):
+            self.cookies = cookies
+            self.request = mock.Mock(protocol='http')
+            self.set_cookie = mock.Mock()
+
+        def get_cookie(self, name):
+            return self.cookies.get(name)
+
+    # verified locally, no request to the Hub
+    handler = Handler({
+        'foo': 'bar',
+        'foo-identity': sign_identity(model, key, 'bar', max_age=60),
+    })
+    with requests_mock.Mocker():
+        assert auth.get_user(handler) == model
+
+    # invalid identity: ask the Hub, and set the fresh identity it sends
+    url = url_path_join(auth.api_url, "authorizations/cookie/foo/bar")
+    reply = dict(model, identity=sign_identity(model, key, 'bar', max_age=60))
+    handler = Handler({
+        'foo': 'bar',
+        'foo-identity': sign_identity(model, b'wrong-key', 'bar', max_age=60),
+    })
+    with requests_mock.Mocker() as m:
+        m.get(url, text=json.dumps(reply))
+        assert auth.get_user(handler)['name'] == 'inara'
+    handler.set_cookie.assert_called_once_with(
+        'foo-identity', reply['identity'], path=auth.identity_cookie_path,
+    )
+
+
+def test_hub_auth_async(io_loop):
+    requested = []
+    class CookieHandler(RequestHandler):
+        @gen.coroutine
+        def get(self, cookie):
+            requested.append(cookie)
+            yield gen.sleep(0.1)
+            if cookie != 'bar':
+                raise HTTPError(404)
+            self.finish(json.dumps({'name': 'river'}))
+
+    port = random_port()
+    server = HTTPServer(Application([
+        (r'/hub/api/authorizations/cookie/foo/([^/]+)', CookieHandler),
+    ]))
+    server.listen(port, '127.0.0.1')
+    auth = HubAuth(cookie_name='foo', api_url='http://127.0.0.1:%i/hub/api' % port)
+
+    # concurrent lookups share one request
+    @gen.coroutine
+    def lookups():
+        models = yield [ auth.user_for_cookie_async('bar') for i in range(5) ]
+        return models
+    assert io_loop.run_sync(lookups) == [{'name': 'river'}] * 5
+    assert requested == ['bar']
+    # requests go through a dedicated client, not the IOLoop's shared one
+    assert auth.http_client is not AsyncHTTPClient()
+
+    # check cache
+    assert io_loop.run_sync(lambda : auth.user_for_cookie_async('bar')) == {'name': 'river'}
+    assert requested == ['bar']
+
+    assert io_loop.run_sync(lambda : auth.user_for_cookie_async('baz')) is None
+    assert requested == ['bar', 'baz']
+    assert io_loop.run_sync(lambda : auth.user_for_cookie_async('bar', use_cache=False)) == {'name': 'river'}
+    assert requested == ['bar', 'baz', 'bar']
+
+    class Handler(HubAuthenticated):
+        hub_auth = auth
+        def get_cookie(self, name):
+            return 'bar'
+    assert io_loop.run_sync(Handler().get_current_user_async) == {'name': 'river'}
+
+    server.stop()
+    with raises(HTTPError) as exc_info:
+        io_loop.run_sync(lambda : auth.user_for_cookie_async('bar', use_cache=False))
+    assert exc_info.value.status_code == 500
+
+
 def test_hub_authenticated(request):
     auth = HubAuth(cookie_name='jubal')
     mock_model = {
@@ -1,6 +1,7 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from binascii import b2a_hex
 from datetime import datetime, timedelta
 from urllib.parse import quote, urlparse
 
@@ -20,10 +21,14 @@ class UserDict(dict):
     """Like defaultdict, but for users
     
     Getting by a user id OR an orm.User instance returns a User wrapper around the orm user.
+
+    Getting by name uses an in-memory name->id index,
+    only querying the database for names that have not been seen yet.
     """
     def __init__(self, db_factory, settings):
         self.db_factory = db_factory
         self.settings = settings
+        self._name_index = {}
         super().__init__()
     
     @property
@@ -35,10 +40,33 @@ class UserDict(dict):
             key = key.id
         return dict.__contains__(self, key)
     
+    def __setitem__(self, id, user):
+        dict.__setitem__(self, id, user)
+        self._name_index[user.name] = id
+    
+    def _id_for_name(self, name):
+        """Return the id of a cached user by name, or None
+        
+        Index entries left behind by renames are dropped here.
+        """
+        id = self._name_index.get(name)
+        if id is None:
+            return None
+        user = dict.get(self, id)
+        if user is None or user.name != name:
+            self._name_index.pop(name, None)
+            return None
+        return id
+    
     def __getitem__(self, key):
         if isinstance(key, User):
             key = key.id
         elif isinstance(key, str):
+            id = self._id_for_name(key)
+            if id is not None:
+                user = dict.__getitem__(self, id)
+                user.db = self.db
+                return user
             orm_user = self.db.query(orm.User).filter(orm.User.name==key).first()
             if orm_user is None:
                 raise KeyError("No such user: %s" % key)
@@ -52,6 +80,7 @@ class UserDict(dict):
                 return user
             user = dict.__getitem__(self, orm_user.id)
             user.db = self.db
+            self._name_index[user.name] = user.id
             return user
         elif isinstance(key, int):
             id = key
@@ -67,6 +96,7 @@ class UserDict(dict):
     def __delitem__(self, key):
         user = self[key]
         user_id = user.id
+        self._name_index.pop(user.name, None)
         db = self.db
         db.delete(user.orm_user)
         db.commit()
@@ -206,7 +236,9 @@ class User(HasTraits):
         db.add(self.server)
         db.commit()
         
-        api_token = self.new_api_token()
+        api_token = yield orm.APIToken.new_async(user=self.orm_user, server=self.server,
+            executor=self.settings.get('token_hash_executor'),
+        )
         db.commit()
         
         spawner = self.spawner
@@ -214,6 +246,10 @@ class User(HasTraits):
         # we are starting a new server, make sure it doesn't restore state
         spawner.clear_state()
         spawner.api_token = api_token
+        identity_key = self.settings.get('identity_key')
+        key = identity_key(self.cookie_name) if identity_key else None
+        if key:
+            spawner.identity_key = b2a_hex(key).decode('ascii')
 
         # trigger pre-spawn hook on authenticator
         authenticator = self.authenticator
@@ -306,6 +342,9 @@ class User(HasTraits):
             status = yield spawner.poll()
             if status is None:
                 yield self.spawner.stop()
+            orm_token = yield orm.APIToken.find_async(self.db, api_token,
+                executor=self.settings.get('token_hash_executor'),
+            )
             spawner.clear_state()
             self.state = spawner.get_state()
             self.last_activity = datetime.utcnow()
@@ -313,7 +352,6 @@ class User(HasTraits):
             if self.server:
                 # cleanup server entry from db
                 self.db.delete(self.server)
-            orm_token = orm.APIToken.find(self.db, api_token)
             if orm_token:
                 self.db.delete(orm_token)
             self.server = None
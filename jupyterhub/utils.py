@@ -3,13 +3,19 @@
 # Copyright (c) Jupyter Development Team.
 # Distributed under the terms of the Modified BSD License.
 
+from base64 import urlsafe_b64encode, urlsafe_b64decode
 from binascii import b2a_hex
+from collections import OrderedDict
+from datetime import datetime
 import errno
 import hashlib
+import hmac
 from hmac import compare_digest
+import json
 import os
 import socket
 from threading import Thread
+import time
 import uuid
 import warnings
 
@@ -30,6 +36,30 @@ def random_port():
 ISO8601_ms = '%Y-%m-%dT%H:%M:%S.%fZ'
 ISO8601_s = '%Y-%m-%dT%H:%M:%SZ'
 
+def parse_iso8601(timestamp):
+    """Parse a UTC ISO8601 timestamp, as sent by the proxy, to a naive datetime
+
+    Accepts `YYYY-MM-DDTHH:MM:SS[.fraction]Z`, the formats of ISO8601_ms and ISO8601_s,
+    several times faster than datetime.strptime.
+    Raises ValueError for anything else.
+    """
+    if (len(timestamp) < 20 or timestamp[-1] != 'Z'
+        or timestamp[4] != '-' or timestamp[7] != '-' or timestamp[10] != 'T'
+        or timestamp[13] != ':' or timestamp[16] != ':'
+    ):
+        raise ValueError("Not an ISO8601 timestamp: %r" % timestamp)
+    microsecond = 0
+    if len(timestamp) > 20:
+        fraction = timestamp[20:-1]
+        if timestamp[19] != '.' or not fraction.isdigit():
+            raise ValueError("Not an ISO8601 timestamp: %r" % timestamp)
+        microsecond = int(fraction[:6].ljust(6, '0'))
+    return datetime(
+        int(timestamp[0:4]), int(timestamp[5:7]), int(timestamp[8:10]),
+        int(timestamp[11:13]), int(timestamp[14:16]), int(timestamp[17:19]),
+        microsecond,
+    )
+
 def can_connect(ip, port):
     """Check if we can connect to an ip:port
     
@@ -97,6 +127,30 @@ def wait_for_http_server(url, timeout=10):
 
 # Decorators for authenticated Handlers
 
+@gen.coroutine
+def run_bounded(jobs, concurrency=10):
+    """Run jobs, with at most `concurrency` of them in progress at once
+
+    `jobs` is an iterable of functions that return Futures.
+    It is consumed lazily, so it can be a generator.
+
+    Returns a list of (job, exception) for the jobs that failed.
+    """
+    jobs = iter(jobs)
+    failed = []
+
+    @gen.coroutine
+    def worker():
+        for job in jobs:
+            try:
+                yield job()
+            except Exception as e:
+                failed.append((job, e))
+
+    yield [ worker() for i in range(max(concurrency, 1)) ]
+    return failed
+
+
 def auth_decorator(check_auth):
     """Make an authentication decorator
 
@@ -170,19 +224,234 @@ def hash_token(token, salt=8, rounds=16384, algorithm='sha512'):
     return "{algorithm}:{rounds}:{salt}:{digest}".format(**locals())
 
 
-def compare_token(compare, token):
+def hmac_token(token, key):
+    """hash a token with a keyed HMAC-SHA256, and return it as `hmac-sha256:hash`
+
+    Unlike :func:`hash_token`, this is a single pass.
+    That is appropriate for high-entropy random tokens (as from :func:`new_token`),
+    where repeated rounds add cost without adding security.
+    Since there is no salt, the result can be looked up by equality.
+    """
+    digest = hmac.new(key, token.encode('utf8', 'replace'), hashlib.sha256).hexdigest()
+    return "hmac-sha256:{digest}".format(digest=digest)
+
+
+# Keyed token hash schemes, by the prefix of the stored hash.
+# Each is a callable of (token, key) returning the stored hash.
+# Stored hashes without a registered prefix use :func:`hash_token`.
+token_hash_schemes = {
+    'hmac-sha256': hmac_token,
+}
+
+
+def token_hash_scheme(hashed):
+    """Return the registered scheme of a stored hash, or None for `algorithm:rounds:salt:hash`"""
+    scheme = hashed.split(':', 1)[0]
+    if scheme in token_hash_schemes:
+        return scheme
+
+
+def compare_token(compare, token, key=None):
     """compare a token with a hashed token
     
-    uses the same algorithm and salt of the hashed token for comparison
+    uses the same scheme (and algorithm and salt) of the hashed token for comparison.
+    Keyed schemes need the `key` used to create the hash, and never match without it.
     """
-    algorithm, srounds, salt, _ = compare.split(':')
-    hashed = hash_token(token, salt=salt, rounds=int(srounds), algorithm=algorithm).encode('utf8')
-    compare = compare.encode('utf8')
-    if compare_digest(compare, hashed):
+    scheme = token_hash_scheme(compare)
+    if scheme is not None:
+        if key is None:
+            return False
+        hashed = token_hash_schemes[scheme](token, key)
+    else:
+        algorithm, srounds, salt, _ = compare.split(':')
+        hashed = hash_token(token, salt=salt, rounds=int(srounds), algorithm=algorithm)
+    if compare_digest(compare.encode('utf8'), hashed.encode('utf8')):
         return True
     return False
 
 
+def _b64encode(data):
+    return urlsafe_b64encode(data).rstrip(b'=').decode('ascii')
+
+
+def _b64decode(data):
+    data = data.encode('ascii')
+    return urlsafe_b64decode(data + b'=' * (-len(data) % 4))
+
+
+def _bind_cookie(cookie):
+    """Short digest of the login cookie an identity is bound to"""
+    return hashlib.sha256(cookie.encode('utf8', 'replace')).hexdigest()[:16]
+
+
+def service_identity_name(service_name):
+    """The name of a service's identity key, and of its identity cookie with `-identity`
+
+    Services share the `jupyterhub-services` login cookie,
+    so their identities are signed with a key per service instead of per cookie.
+    """
+    return 'jupyterhub-services-%s' % service_name
+
+
+def sign_identity(user_model, key, cookie, max_age):
+    """Sign a compact user identity, for verification without asking the Hub
+
+    The identity has the user's name, admin status and groups,
+    expires after `max_age` seconds,
+    and is only valid alongside the login cookie value `cookie`.
+
+    Returns `payload.signature`, both base64url-encoded, safe for use as a cookie value.
+    """
+    payload = _b64encode(json.dumps({
+        'name': user_model['name'],
+        'admin': user_model['admin'],
+        'groups': user_model['groups'],
+        'exp': int(time.time() + max_age),
+        'cookie': _bind_cookie(cookie),
+    }, separators=(',', ':')).encode('utf8'))
+    signature = hmac.new(key, payload.encode('ascii'), hashlib.sha256).digest()
+    return payload + '.' + _b64encode(signature)
+
+
+def verify_identity(identity, key, cookie):
+    """Verify an identity from :func:`sign_identity`
+
+    Returns the user model (name, admin, groups),
+    or None if the signature is wrong, the identity has expired,
+    or it was issued for a different login cookie.
+    """
+    try:
+        payload, signature = identity.split('.')
+        signature = _b64decode(signature)
+        expected = hmac.new(key, payload.encode('ascii'), hashlib.sha256).digest()
+    except ValueError:
+        return None
+    if not compare_digest(signature, expected):
+        return None
+    model = json.loads(_b64decode(payload).decode('utf8'))
+    if model.pop('exp') < time.time():
+        return None
+    if model.pop('cookie') != _bind_cookie(cookie):
+        return None
+    return model
+
+
+class LRUCache(object):
+    """Bounded in-process cache with optional expiry
+
+    At most `max_size` entries are kept,
+    evicting the least-recently-used entry when full.
+    Entries expire `max_age` seconds after they are stored,
+    measured with a monotonic timer (time.monotonic).
+    Expired entries are removed when they are next looked up,
+    and by a sweep of the whole cache that runs after
+    as many entries are stored as the cache held at the last sweep,
+    so entries that are never looked up again don't linger.
+
+    A max_age of 0 means entries never expire.
+
+    Lookups and evictions are counted in `hits`, `misses` and `evictions`.
+    """
+
+    def __init__(self, max_size=1024, max_age=0):
+        self.max_size = max_size
+        self.max_age = max_age
+        self._data = OrderedDict()
+        self._stored_since_sweep = 0
+        self._sweep_interval = 1
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def _expired(self, timestamp, now=None):
+        if now is None:
+            now = time.monotonic()
+        return self.max_age > 0 and timestamp + self.max_age < now
+
+    def _entry(self, key):
+        """Get the (timestamp, value) entry for a key, dropping it if expired"""
+        entry = self._data.get(key)
+        if entry is not None and self._expired(entry[0]):
+            del self._data[key]
+            self.evictions += 1
+            return None
+        return entry
+
+    def __contains__(self, key):
+        return self._entry(key) is not None
+
+    def __getitem__(self, key):
+        """Return the cached value for key, if present and not expired"""
+        entry = self._entry(key)
+        if entry is None:
+            self.misses += 1
+            raise KeyError(key)
+        self.hits += 1
+        self._data.move_to_end(key)
+        return entry[1]
+
+    def get(self, key, default=None):
+        """Return the cached value for key, if present and not expired"""
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __setitem__(self, key, value):
+        self.set(key, value)
+
+    def set(self, key, value):
+        """Store a value, evicting the oldest entries if over capacity"""
+        self._data[key] = (time.monotonic(), value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_size:
+            self._data.popitem(last=False)
+            self.evictions += 1
+        self._stored_since_sweep += 1
+        if self._stored_since_sweep >= self._sweep_interval:
+            self.sweep()
+
+    def sweep(self):
+        """Remove all expired entries"""
+        self._stored_since_sweep = 0
+        if self.max_age:
+            now = time.monotonic()
+            for key in [ key for key, (timestamp, _) in self._data.items() if self._expired(timestamp, now) ]:
+                del self._data[key]
+                self.evictions += 1
+        # sweeping n entries once every n stores keeps the cost per store constant
+        self._sweep_interval = max(len(self._data), 1)
+
+    def pop(self, key, default=None):
+        """Remove a key, returning its value"""
+        entry = self._data.pop(key, None)
+        if entry is None:
+            return default
+        return entry[1]
+
+    def discard_where(self, predicate):
+        """Remove every entry whose value satisfies predicate(value)"""
+        for key in [ key for key, (_, value) in self._data.items() if predicate(value) ]:
+            del self._data[key]
+
+    def clear(self):
+        self._data.clear()
+
+    @property
+    def stats(self):
+        """Size and hit/miss/eviction counts, e.g. for reporting metrics"""
+        return {
+            'size': len(self._data),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+        }
+
+
 def url_path_join(*pieces):
     """Join components of url into a relative url
 
@@ -205,3 +474,12 @@ def url_path_join(*pieces):
 
     return result
 
+
+
+def chunks(items, size=500):
+    """Split a list into chunks, e.g. small enough for a SQL IN clause
+
+    SQLite limits a statement to 999 bound parameters.
+    """
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
@@ -185,6 +185,23 @@ require(["jquery", "bootstrap", "moment", "jhapi", "utils"], function ($, bs, mo
     $("#stop-all-servers-dialog").find(".stop-all-button").click(function () {
         // stop all clicks all the active stop buttons
         $('.stop-server').not('.hidden').click();
+        // and stops running servers of users on other pages
+        var shown = {};
+        $(".user-row").map(function (i, row) {
+            shown[$(row).data('user')] = true;
+        });
+        api.list_users({
+            // jhapi sets processData: false, so serialize the query here
+            data: $.param({state: 'running'}),
+            success: function (users) {
+                users.map(function (user) {
+                    // only users with a running server get a stop request
+                    if (!shown[user.name] && user.server) {
+                        api.stop_server(user.name);
+                    }
+                });
+            }
+        });
     });
 
     $("#shutdown-hub").click(function () {